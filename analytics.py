@@ -0,0 +1,92 @@
+# Statistics of a user's daily spending for the Expense Flow screen. The
+# per-day totals are laid out once as a dense array, with a zero for every day
+# without expenses, and each statistic is a vectorised pass over it: trailing
+# 7 and 30 day means, this month's pace and month-end forecast, and the days
+# whose spending stands out from the weeks before them.
+from datetime import date as Date
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Trailing windows, in days, of the means drawn over the daily line
+ROLLING_WINDOWS = (7, 30)
+# A day is flagged when its total is more than ANOMALY_Z standard deviations
+# above the mean of the ANOMALY_WINDOW days before it
+ANOMALY_WINDOW = 30
+ANOMALY_Z = 3.0
+# The trailing mean the rest of the month is forecast from
+FORECAST_WINDOW = 30
+
+
+def dense_series(rows, end=None):
+    # (days, cents) from ExpenseRepository.daily_series rows: datetime64[D]
+    # days from the first row's through end (or the last row's, if later),
+    # and each day's total in cents, 0 on days without expenses
+    if not rows:
+        return np.empty(0, dtype="datetime64[D]"), np.empty(0, dtype=np.int64)
+    dates, totals = zip(*rows)
+    days = np.array(dates, dtype="datetime64[D]")
+    first, last = days[0], days[-1]
+    if end is not None:
+        last = max(last, np.datetime64(end, "D"))
+    cents = np.zeros((last - first).astype(np.int64) + 1, dtype=np.int64)
+    # daily_series has one row per date, so a plain scatter fills the gaps
+    cents[(days - first).astype(np.int64)] = totals
+    return np.arange(first, last + 1), cents
+
+
+def rolling_mean(values, window):
+    # Mean of each day and the window - 1 days before it, from one cumulative
+    # sum; the first days average over the days there are
+    sums = np.concatenate(([0], np.cumsum(values)))
+    ends = np.arange(1, len(values) + 1)
+    counts = np.minimum(ends, window)
+    return (sums[ends] - sums[ends - counts]) / counts
+
+
+def z_scores(values, window=ANOMALY_WINDOW):
+    # How many standard deviations each day is above the mean of the window
+    # days before it. Days without a full window before them, or after a
+    # window that did not vary, score 0.
+    scores = np.zeros(len(values))
+    if len(values) <= window:
+        return scores
+    # Row i is the window of days i .. i + window - 1, preceding day i + window
+    previous = sliding_window_view(values[:-1].astype(float), window)
+    mean = previous.mean(axis=1)
+    deviation = previous.std(axis=1)
+    np.divide(values[window:] - mean, deviation, out=scores[window:], where=deviation > 0)
+    return scores
+
+
+def month_to_date(days, cents, today, baseline):
+    # (spent, pace, forecast) for today's month in cents: spent from its first
+    # day through today, the average per day so far, and spent plus the days
+    # left at baseline, the trailing mean per day as of today
+    month = today.astype("datetime64[M]")
+    first = month.astype("datetime64[D]")
+    elapsed = (today - first).astype(np.int64) + 1
+    remaining = ((month + 1).astype("datetime64[D]") - today).astype(np.int64) - 1
+    spent = int(cents[(days >= first) & (days <= today)].sum())
+    position = np.searchsorted(days, today)
+    daily = float(baseline[position]) if position < len(days) and days[position] == today else 0.0
+    return spent, spent / elapsed, spent + remaining * daily
+
+
+class DailyAnalysis:
+    # Everything the Expense Flow screen draws, computed once per load from the
+    # daily_series rows. The series runs through today, so the trailing means
+    # and the forecast count the quiet days since the last expense.
+
+    def __init__(self, rows, today=None):
+        self.today = np.datetime64(today or Date.today(), "D")
+        self.days, self.cents = dense_series(rows, self.today)
+        self.means = {window: rolling_mean(self.cents, window) for window in ROLLING_WINDOWS}
+        self.scores = z_scores(self.cents)
+        # Indexes into days of the flagged days
+        self.anomalies = np.flatnonzero(self.scores > ANOMALY_Z)
+        baseline = self.means.get(FORECAST_WINDOW)
+        if baseline is None:
+            baseline = rolling_mean(self.cents, FORECAST_WINDOW)
+        self.month_spent, self.month_pace, self.month_forecast = month_to_date(
+            self.days, self.cents, self.today, baseline)
@@ -0,0 +1,258 @@
+# Online backups of the expense database with SQLite's backup API, safe to
+# take while the app or server.py is writing:
+#
+#     python backup.py snapshot                     # one snapshot into backups/
+#     python backup.py schedule --every 6h --keep 28
+#     python backup.py list
+#     python backup.py restore backups/ohhwow-20240501-120000.db
+#
+# The copy runs a few pages per step inside one read transaction. In WAL mode
+# that transaction does not hold up writers, and it pins the version being
+# copied, so their commits never force the backup to start over. A snapshot
+# is a database file named after the time it was taken, plus the year
+# archives it lists; archives never change, so they are hard-linked where
+# the file system allows instead of copied again.
+import argparse
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+import db
+
+BACKUP_DIR = "backups"
+# Pages copied per backup step (4 MB with SQLite's default 4 KB pages)
+PAGES_PER_STEP = 1024
+# Seconds to sleep between steps, leaving the disk to other work in between
+STEP_PAUSE = 0.0
+# Snapshots kept by prune, newest first
+KEEP = 7
+# Seconds between scheduled snapshots
+INTERVAL = 24 * 60 * 60
+
+
+def snapshot_path(directory, when):
+    # Named after when, or the first free second after it
+    root, ext = os.path.splitext(os.path.basename(db.DB_NAME))
+    while True:
+        path = os.path.join(directory, f"{root}-{when:%Y%m%d-%H%M%S}{ext}")
+        if not os.path.exists(path) and not os.path.exists(path + ".partial"):
+            return path
+        when += timedelta(seconds=1)
+
+
+def list_snapshots(directory=BACKUP_DIR):
+    # The current database's snapshots in directory, oldest first
+    root, ext = os.path.splitext(os.path.basename(db.DB_NAME))
+    pattern = re.compile(re.escape(root) + r"-\d{8}-\d{6}" + re.escape(ext) + "$")
+    try:
+        names = sorted(name for name in os.listdir(directory) if pattern.match(name))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in names]
+
+
+def snapshot_years(path):
+    # The archived years a database or snapshot lists. Raises ValueError for a
+    # file that is not an expense database.
+    conn = sqlite3.connect(db.read_only_uri(path), uri=True)
+    try:
+        tables = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if not {"users", "expenses"} <= tables:
+            raise ValueError(f"{path} is not an expense database")
+        if "archives" not in tables:
+            # Made before archives existed
+            return []
+        return [year for year, in conn.execute("SELECT year FROM archives ORDER BY year")]
+    except sqlite3.DatabaseError as error:
+        raise ValueError(f"{path} is not an expense database ({error})") from None
+    finally:
+        conn.close()
+
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def copy_pages(source, target_path, pages=PAGES_PER_STEP, pause=STEP_PAUSE, progress=None):
+    # Copies source's main database into a new file at target_path, pages at a
+    # time; progress(copied, total) is called after each step
+    def step(status, remaining, total):
+        if progress is not None:
+            progress(total - remaining, total)
+        if pause:
+            time.sleep(pause)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target, pages=pages, progress=step)
+        # A copy is a single file, without the WAL files reading it would leave next to it
+        target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+
+
+def snapshot(directory=BACKUP_DIR, pages=PAGES_PER_STEP, pause=STEP_PAUSE, progress=None):
+    # Takes a snapshot of the current database and its archives and returns
+    # (path, pages copied, seconds). The file only gets its final name once
+    # complete, so list_snapshots never returns one half written.
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(directory, datetime.now())
+    partial = path + ".partial"
+    started = time.perf_counter()
+    conn = db.get_connection()
+    years = []
+    conn.execute("BEGIN")
+    try:
+        try:
+            # Reading starts the transaction the whole copy is taken from
+            years = [year for year, in conn.execute("SELECT year FROM archives")]
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            copy_pages(conn, partial, pages, pause, progress)
+        finally:
+            conn.rollback()
+        for year in years:
+            _link_or_copy(db.archive_path(year), db.archive_path(year, path))
+    except BaseException:
+        for name in [partial] + [db.archive_path(year, path) for year in years]:
+            if os.path.exists(name):
+                db.remove_archive_file(name)
+        raise
+    os.replace(partial, path)
+    return path, page_count, time.perf_counter() - started
+
+
+def prune(directory=BACKUP_DIR, keep=KEEP):
+    # Removes all but the newest keep snapshots, with their archives; returns how many went
+    snapshots = list_snapshots(directory)
+    removed = snapshots[:max(len(snapshots) - keep, 0)]
+    for path in removed:
+        for year in snapshot_years(path):
+            if os.path.exists(db.archive_path(year, path)):
+                db.remove_archive_file(db.archive_path(year, path))
+        os.remove(path)
+    return len(removed)
+
+
+def snapshot_due(directory=BACKUP_DIR, interval=INTERVAL):
+    snapshots = list_snapshots(directory)
+    return not snapshots or time.time() - os.path.getmtime(snapshots[-1]) >= interval
+
+
+def scheduled_snapshot(directory=BACKUP_DIR, interval=INTERVAL, keep=KEEP, pause=STEP_PAUSE):
+    # A snapshot when the newest is interval seconds old or there is none,
+    # then prune; returns snapshot's result, or None when none was due
+    if not snapshot_due(directory, interval):
+        return None
+    result = snapshot(directory, pause=pause)
+    prune(directory, keep)
+    return result
+
+
+def restore(path, directory=BACKUP_DIR, pages=PAGES_PER_STEP):
+    # Replaces the current database and its archives with a snapshot's. The
+    # current state is snapshotted into directory first, so a restore can be
+    # undone. Close the app and server.py before restoring. Returns that
+    # safety snapshot's path.
+    years = snapshot_years(path)
+    missing = [db.archive_path(year, path) for year in years if not os.path.exists(db.archive_path(year, path))]
+    if missing:
+        raise ValueError(f"the snapshot's archive {missing[0]} is missing")
+    safety = snapshot(directory, pages)[0]
+    current = [year for year, in db.get_connection().execute("SELECT year FROM archives")]
+    db.close_all_connections()
+    source = sqlite3.connect(db.read_only_uri(path), uri=True)
+    target = sqlite3.connect(db.DB_NAME)
+    try:
+        # Through the backup API rather than a file copy, so the target's WAL is dealt with
+        source.backup(target, pages=pages)
+    finally:
+        target.close()
+        source.close()
+    for year in set(current) | set(years):
+        if os.path.exists(db.archive_path(year)):
+            db.remove_archive_file(db.archive_path(year))
+    for year in years:
+        _link_or_copy(db.archive_path(year, path), db.archive_path(year))
+    # The snapshot may predate migrations, which run again on the next connection
+    db.use_database(db.DB_NAME)
+    return safety
+
+
+def duration(value):
+    # Seconds from "90", "90s", "30m", "6h" or "1d"
+    match = re.fullmatch(r"(\d+)([smhd]?)", value)
+    if match is None:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a duration such as 30m, 6h or 1d")
+    return int(match.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+
+
+def report(path, pages, seconds):
+    print(f"Saved {path}: {pages:,} pages in {seconds:.2f}s ({pages / max(seconds, 1e-9):,.0f} pages/s).")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Back up and restore the expense database while it is in use.")
+    parser.add_argument("--db", default=db.DB_NAME, help="database file (default: %(default)s)")
+    parser.add_argument("--dir", default=BACKUP_DIR, help="where snapshots are kept (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    take = commands.add_parser("snapshot", help="take one snapshot now")
+    take.add_argument("--pages", type=int, default=PAGES_PER_STEP, help="pages copied per step")
+    take.add_argument("--pause", type=float, default=STEP_PAUSE, help="seconds to sleep between steps")
+    schedule = commands.add_parser("schedule", help="keep taking snapshots until interrupted")
+    schedule.add_argument("--every", type=duration, default=INTERVAL, help="e.g. 30m, 6h, 1d (default: 1d)")
+    schedule.add_argument("--keep", type=int, default=KEEP, help="snapshots kept (default: %(default)s)")
+    schedule.add_argument("--pause", type=float, default=STEP_PAUSE, help="seconds to sleep between steps")
+    keep = commands.add_parser("prune", help="remove all but the newest snapshots")
+    keep.add_argument("--keep", type=int, default=KEEP, help="snapshots kept (default: %(default)s)")
+    commands.add_parser("list", help="list the snapshots")
+    back = commands.add_parser("restore", help="replace the database with a snapshot (close the app first)")
+    back.add_argument("snapshot", help="snapshot file, as listed")
+    args = parser.parse_args(argv)
+
+    db.use_database(args.db)
+
+    if args.command == "snapshot":
+        report(*snapshot(args.dir, args.pages, args.pause))
+        return 0
+
+    if args.command == "schedule":
+        try:
+            while True:
+                result = scheduled_snapshot(args.dir, args.every, args.keep, args.pause)
+                if result is not None:
+                    report(*result)
+                time.sleep(min(args.every, 60))
+        except KeyboardInterrupt:
+            return 0
+
+    if args.command == "prune":
+        print(f"Removed {prune(args.dir, args.keep)} snapshots.")
+        return 0
+
+    if args.command == "list":
+        snapshots = list_snapshots(args.dir)
+        for path in snapshots:
+            years = snapshot_years(path)
+            print(f"{path}  {os.path.getsize(path) / 2 ** 20:,.1f} MB"
+                  + (f"  archives {', '.join(map(str, years))}" if years else ""))
+        print(f"{len(snapshots)} snapshots." if snapshots else "No snapshots.")
+        return 0
+
+    if args.command == "restore":
+        try:
+            safety = restore(args.snapshot, args.dir)
+        except (ValueError, sqlite3.Error, OSError) as error:
+            print(f"Could not restore {args.snapshot}: {error}")
+            return 1
+        print(f"Restored {args.snapshot}. The database as it was is in {safety}.")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
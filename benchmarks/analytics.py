@@ -0,0 +1,50 @@
+# Times analytics.DailyAnalysis, from daily_series rows to the rolling means,
+# month pace, forecast and anomaly flags, over 12 years of daily totals by
+# default with about one day in five left without expenses. Fails when the
+# median goes over --budget.
+#
+#     python -m benchmarks.analytics [--years 12] [--budget 0.02]
+import argparse
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+import analytics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Daily spending analytics benchmark.")
+    parser.add_argument("--years", type=int, default=12, help="years of daily totals")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--budget", type=float, default=0.02,
+                        help="maximum median time in seconds of a full analysis")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    today = date.today()
+    start = today - timedelta(days=365 * args.years)
+    # (yyyy-mm-dd, cents) rows as ExpenseRepository.daily_series returns them,
+    # with the gaps the dense series has to fill
+    rows = [((start + timedelta(days=i)).isoformat(), int(total))
+            for i, total in enumerate(rng.gamma(2.0, 2000.0, 365 * args.years))
+            if rng.random() > 0.2]
+
+    analytics.DailyAnalysis(rows, today)  # The first run pays for NumPy's lazy set-up
+    timings = []
+    for run in range(args.runs):
+        started = time.perf_counter()
+        analysis = analytics.DailyAnalysis(rows, today)
+        timings.append(time.perf_counter() - started)
+    median = statistics.median(timings)
+    verdict = "ok" if median <= args.budget else "OVER BUDGET"
+    print(f"{len(rows):,} rows, {len(analysis.days):,} days, {len(analysis.anomalies):,} flagged: "
+          f"median {median * 1000:.2f} ms, min {min(timings) * 1000:.2f} ms, "
+          f"budget {args.budget * 1000:.0f} ms ({verdict})")
+    return 1 if median > args.budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
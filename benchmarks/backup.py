@@ -0,0 +1,94 @@
+# Times backup.snapshot on a synthetic database (built once with datagen and
+# kept in --data-dir) while a writer thread keeps adding and deleting an
+# expense, and reports the snapshot's duration and pages per second next to
+# the writer's commit latency with and without the backup running.
+#
+#     python -m benchmarks.backup --rows 1000000 --pages 1024
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import backup
+import db
+from benchmarks import datagen
+from benchmarks.repository import percentile
+from repository import ExpenseRepository
+
+USERS = 10
+YEARS = 10
+
+
+def write_latencies(stop):
+    # Commit latencies of add + delete pairs until stop is set
+    repository = ExpenseRepository(1)
+    timings = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        repository.delete(repository.add(100, "Backup benchmark", "Food", "2024-01-01"))
+        timings.append(time.perf_counter() - started)
+        time.sleep(0.001)
+    db.close_connection()
+    return timings
+
+
+def measure_writes(seconds=None, during=None):
+    # Runs the writer for seconds, or for as long as during() takes
+    stop = threading.Event()
+    timings = []
+    thread = threading.Thread(target=lambda: timings.extend(write_latencies(stop)))
+    thread.start()
+    result = time.sleep(seconds) if during is None else during()
+    stop.set()
+    thread.join()
+    return timings, result
+
+
+def describe(name, timings):
+    print(f"{name:<22}{len(timings):>8}{percentile(timings, 0.50) * 1000:>10.2f}"
+          f"{percentile(timings, 0.99) * 1000:>10.2f}{max(timings) * 1000:>10.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Online backup benchmark.")
+    parser.add_argument("--rows", type=int, default=1000000, help="size of the generated database")
+    parser.add_argument("--pages", type=int, default=backup.PAGES_PER_STEP, help="pages copied per step")
+    parser.add_argument("--pause", type=float, default=backup.STEP_PAUSE, help="seconds between steps")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "expense-benchmarks"),
+                        help="where generated databases are kept between runs")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    source = os.path.join(args.data_dir, f"expenses_{args.rows}.db")
+    if not os.path.exists(source):
+        print(f"Generating {args.rows:,} rows in {source} ...")
+        datagen.generate(source, USERS, args.rows, YEARS)
+    scratch = tempfile.mkdtemp(prefix="expense-backup-")
+    try:
+        # The benchmark writes, so it works on a copy of the generated database
+        path = os.path.join(scratch, "expenses.db")
+        shutil.copy(source, path)
+        db.use_database(path)
+        db.init_database()
+        directory = os.path.join(scratch, "backups")
+
+        quiet, _ = measure_writes(seconds=2.0)
+        busy, (snapshot, pages, seconds) = measure_writes(
+            during=lambda: backup.snapshot(directory, args.pages, args.pause))
+        size = os.path.getsize(snapshot) / 2 ** 20
+        print(f"Snapshot of {args.rows:,} rows: {pages:,} pages ({size:,.0f} MB) in {seconds:.2f}s, "
+              f"{pages / seconds:,.0f} pages/s, {size / seconds:,.0f} MB/s, {args.pages} pages per step")
+        print(f"{'writer commits':<22}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        describe("without backup", quiet)
+        describe("during backup", busy)
+    finally:
+        db.close_all_connections()
+        shutil.rmtree(scratch, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
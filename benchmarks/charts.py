@@ -0,0 +1,82 @@
+# Times redraws of the Expense Flow and Expense Analysis charts with the
+# headless Agg canvas, using 10 years of daily totals by default. Updates that
+# keep the axis limits only blit the line and must fit in a 30 fps frame;
+# updates that change them re-lay out ticks and labels and get --layout-budget.
+#
+#     python -m benchmarks.charts [--years 10] [--budget 0.033] [--layout-budget 0.15]
+import argparse
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+import analytics
+import charts
+
+
+def time_redraws(chart, update, runs):
+    update(chart, -1)  # The first draw builds font caches, which a user pays only once
+    timings = []
+    for run in range(runs):
+        started = time.perf_counter()
+        update(chart, run)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chart redraw benchmark.")
+    parser.add_argument("--years", type=int, default=10, help="years of daily data to plot")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget", type=float, default=0.033,
+                        help="maximum median time in seconds of an update within the current axis limits")
+    parser.add_argument("--layout-budget", type=float, default=0.15,
+                        help="maximum median time in seconds of a redraw that changes the axes")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    start = date.today() - timedelta(days=365 * args.years)
+    # yyyy-mm-dd strings, as ExpenseRepository.daily_series returns them
+    dates = [(start + timedelta(days=i)).isoformat() for i in range(365 * args.years)]
+    totals = rng.gamma(2.0, 20.0, len(dates))
+    categories = {name: float(rng.uniform(100, 5000))
+                  for name in ["Food", "Transportation", "Education", "Entertainment", "Shopping", "Other"]}
+
+    def edited(run):
+        # The same series after one more expense today, as after an edit
+        changed = totals.copy()
+        changed[-1] += run + 1
+        return changed
+
+    def rescaled(run):
+        # Alternating scales, so every update moves the y limits
+        return totals * (2 if run % 2 else 1)
+
+    # Overlays as the Expense Flow screen draws them
+    averages = {f"{window}-day average": analytics.rolling_mean(totals, window)
+                for window in analytics.ROLLING_WINDOWS}
+    anomalies = np.flatnonzero(analytics.z_scores(totals) > analytics.ANOMALY_Z)
+
+    cases = [
+        (f"daily flow, {len(dates):,} days, edit", charts.DailyFlowChart(), args.budget,
+         lambda chart, run: chart.update(dates, edited(run))),
+        (f"daily flow with averages and anomalies, {len(dates):,} days, edit", charts.DailyFlowChart(), args.budget,
+         lambda chart, run: chart.update(dates, edited(run), averages, anomalies)),
+        (f"daily flow, {len(dates):,} days, new limits", charts.DailyFlowChart(), args.layout_budget,
+         lambda chart, run: chart.update(dates, rescaled(run))),
+        ("category pie", charts.CategoryPieChart(), args.layout_budget,
+         lambda chart, run: chart.update(categories)),
+    ]
+    failed = False
+    for name, chart, budget, update in cases:
+        median = statistics.median(time_redraws(chart, update, args.runs))
+        verdict = "ok" if median <= budget else "OVER BUDGET"
+        print(f"{name}: median redraw {median * 1000:.1f} ms, budget {budget * 1000:.0f} ms ({verdict})")
+        failed = failed or median > budget
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+# Builds a synthetic expense database for benchmarking and load tests.
+#
+#     python -m benchmarks.datagen bench.db --users 10 --rows 1000000 --years 10
+#
+# Users are named user1..userN with the password "password". Expenses are
+# spread over the users and over the date span ending today, with amounts and
+# categories skewed roughly like real spending.
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+import db
+
+CATEGORIES = ["Food", "Transportation", "Education", "Entertainment", "Shopping", "Other"]
+CATEGORY_WEIGHTS = [40, 20, 5, 10, 15, 10]
+DESCRIPTIONS = ["Coffee", "Groceries", "Lunch", "Dinner", "Uber ride", "Bus pass", "Train ticket",
+                "Textbook", "Course fee", "Cinema", "Concert", "Streaming", "Clothes", "Shoes",
+                "Electronics", "Gift", "Pharmacy", "Haircut", "Gym", "Phone bill"]
+PASSWORD = "password"
+
+
+def expense_rows(user_ids, rows, years, seed=0, chunk_size=100000):
+    # Streams (user_id, amount in cents, description, category, date) tuples, drawing
+    # each column a chunk at a time. Chunks come out in date order, which keeps
+    # the bulk load writing to neighbouring index pages.
+    rng = random.Random(seed)
+    first_day = date.today() - timedelta(days=365 * years)
+    day_count = 365 * years
+    days = [(first_day + timedelta(days=offset)).isoformat() for offset in range(day_count)]
+    for start in range(0, rows, chunk_size):
+        n = min(chunk_size, rows - start)
+        chunk = list(zip(rng.choices(user_ids, k=n),
+                         [round(rng.lognormvariate(2.5, 1.0) * 100) for _ in range(n)],
+                         [f"{description} #{rng.randrange(10000)}" for description in rng.choices(DESCRIPTIONS, k=n)],
+                         rng.choices(CATEGORIES, CATEGORY_WEIGHTS, k=n),
+                         rng.choices(days, k=n)))
+        chunk.sort(key=lambda row: row[4])
+        yield from chunk
+
+
+def generate(path, users=10, rows=10000, years=10, seed=0):
+    # Creates a fresh database at path and returns the ids of the generated users
+    if os.path.exists(path):
+        raise FileExistsError(f"{path} already exists")
+    db.use_database(path)
+    conn = db.get_connection()
+    with conn:
+        conn.executemany("INSERT INTO users (username, password) VALUES (?, ?)",
+                         [(f"user{n}", PASSWORD) for n in range(1, users + 1)])
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+    db.bulk_load_expenses(expense_rows(user_ids, rows, years, seed))
+    conn.execute("ANALYZE")
+    return user_ids
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic expense database.")
+    parser.add_argument("output", help="database file to create")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=10000, help="total expenses across all users")
+    parser.add_argument("--years", type=int, default=10, help="date span ending today")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    try:
+        generate(args.output, args.users, args.rows, args.years, args.seed)
+    except FileExistsError as error:
+        print(error)
+        return 1
+    seconds = time.perf_counter() - started
+    print(f"Generated {args.rows:,} expenses for {args.users} users in {seconds:.1f}s ({args.output}).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+# Headless latency benchmarks for every ExpenseRepository operation, run
+# against synthetic databases of increasing size (built once with datagen and
+# kept in --data-dir for later runs).
+#
+#     python -m benchmarks.repository --rows 10000 1000000 10000000
+#     python -m benchmarks.repository --rows 10000 --json results.json
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import db
+from benchmarks import datagen
+from repository import ExpenseRepository
+
+USERS = 10
+YEARS = 10
+
+
+def run(func, rounds):
+    # Returns the per-call timings in seconds, after one warm-up call
+    func()
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def benchmarks(repository):
+    # (name, callable) pairs; write operations clean up after themselves
+    first_page = repository.list_expenses()
+    daily = repository.daily_series()
+    middle_day = daily[len(daily) // 2][0] if daily else "2000-01-01"
+    last_year = int(daily[-1][0][:4]) if daily else 2000
+    if daily:
+        repository.set_budget_target(int(statistics.median(total for _, total in daily)))
+
+    def add_update_delete():
+        expense_id = repository.add(1250, "Benchmark", "Food", middle_day)
+        repository.update(expense_id, 1350, "Benchmark", "Shopping", middle_day)
+        repository.delete(expense_id)
+
+    return [
+        ("add + update + delete", add_update_delete),
+        ("list: first page", lambda: repository.list_expenses()),
+        ("list: page from the middle", lambda: repository.list_expenses(after=(middle_day, 0))),
+        ("list: one year", lambda: repository.list_expenses(year=last_year)),
+        ("list: one month of one year", lambda: repository.list_expenses(month=6, year=last_year)),
+        ("list: one month of every year", lambda: repository.list_expenses(month=6)),
+        ("list: next page", lambda: repository.list_expenses(
+            after=(first_page[-1][4], first_page[-1][0]) if first_page else None)),
+        ("filter: categories, date range", lambda: repository.list_filtered(
+            db.ExpenseFilter(categories=["Food", "Shopping"], start=f"{last_year}-03-01", end=f"{last_year}-08-31"))),
+        ("filter: amount range", lambda: repository.list_filtered(db.ExpenseFilter(min_amount=5000, max_amount=20000))),
+        ("sort: amount, largest first", lambda: repository.list_filtered(db.ExpenseFilter(), "amount", True)),
+        ("sort: category", lambda: repository.list_filtered(db.ExpenseFilter(), "category")),
+        ("sort: description", lambda: repository.list_filtered(db.ExpenseFilter(), "description")),
+        ("total", repository.total),
+        ("total: one category in a year", lambda: repository.filtered_total(
+            db.ExpenseFilter(categories=["Food"], year=last_year))),
+        ("category breakdown", repository.category_breakdown),
+        ("daily series", repository.daily_series),
+        ("budget check on save", lambda: repository.budget_check(middle_day, "Food")),
+        ("budget exceedances", repository.budget_exceedances),
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ExpenseRepository latency benchmarks.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000], help="database sizes to test")
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "expense-benchmarks"),
+                        help="where generated databases are kept between runs")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = []
+    for rows in args.rows:
+        path = os.path.join(args.data_dir, f"expenses_{rows}.db")
+        if not os.path.exists(path):
+            print(f"Generating {rows:,} rows in {path} ...")
+            datagen.generate(path, USERS, rows, YEARS)
+        db.use_database(path)
+        repository = ExpenseRepository(user_id=1)
+
+        print(f"\n{rows:,} rows ({USERS} users, {YEARS} years)")
+        print(f"{'operation':<32}{'min ms':>10}{'median ms':>12}{'p95 ms':>10}")
+        for name, func in benchmarks(repository):
+            timings = run(func, args.rounds)
+            result = {"rows": rows, "operation": name, "min": min(timings),
+                      "median": statistics.median(timings), "p95": percentile(timings, 0.95)}
+            results.append(result)
+            print(f"{name:<32}{result['min'] * 1000:>10.3f}{result['median'] * 1000:>12.3f}"
+                  f"{result['p95'] * 1000:>10.3f}")
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
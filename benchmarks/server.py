@@ -0,0 +1,174 @@
+# Load test for server.py: starts a server over a synthetic database (or uses
+# --url), then runs concurrent clients, each on its own keep-alive connection,
+# doing a mix of the desktop app's reads and writes. Reports requests per
+# second and latency percentiles per operation, and how many writes each
+# commit carried.
+#
+#     python -m benchmarks.server --clients 32 --duration 10 --write-share 0.2
+#     python -m benchmarks.server --url http://127.0.0.1:8765
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode, urlsplit
+
+from benchmarks import datagen
+from benchmarks.repository import percentile
+
+USERS = 10
+YEARS = 5
+
+
+class Connection:
+    # A minimal HTTP/1.1 keep-alive client, so the clients cost little next to the server
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.token = None
+
+    @classmethod
+    async def open(cls, host, port):
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def request(self, method, path, body=None, **query):
+        if query:
+            path += "?" + urlencode({name: value for name, value in query.items() if value is not None})
+        data = json.dumps(body).encode() if body is not None else b""
+        auth = f"Authorization: Bearer {self.token}\r\n" if self.token else ""
+        self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: bench\r\n{auth}"
+                          f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        payload = json.loads(await self.reader.readexactly(length))
+        if status >= 400:
+            raise RuntimeError(f"{method} {path}: {status} {payload.get('error')}")
+        return payload
+
+    def close(self):
+        self.writer.close()
+
+
+async def client(host, port, user, deadline, write_share, seed, timings):
+    rng = random.Random(seed)
+    conn = await Connection.open(host, port)
+    conn.token = (await conn.request("POST", "/login", {"username": user, "password": datagen.PASSWORD}))["token"]
+    this_year = time.localtime().tm_year
+    added = []
+    while time.perf_counter() < deadline:
+        if rng.random() < write_share:
+            if added and rng.random() < 0.5:
+                name, call = "delete", ("DELETE", f"/expenses/{added.pop()}")
+            else:
+                name, call = "add", ("POST", "/expenses", {"amount": rng.randrange(100, 10000),
+                                                           "description": "Load test", "category": "Food",
+                                                           "date": f"{this_year}-01-{rng.randrange(1, 29):02d}"})
+            query = {}
+        else:
+            name = rng.choice(["list", "list month", "total", "categories", "daily", "budget status"])
+            call, query = {
+                "list": (("GET", "/expenses"), {}),
+                "list month": (("GET", "/expenses"), {"month": rng.randrange(1, 13),
+                                                      "year": this_year - rng.randrange(YEARS)}),
+                "total": (("GET", "/total"), {"year": this_year - rng.randrange(YEARS)}),
+                "categories": (("GET", "/categories"), {}),
+                "daily": (("GET", "/daily"), {}),
+                "budget status": (("GET", "/budget/exceedances"), {}),
+            }[name]
+        started = time.perf_counter()
+        result = await conn.request(*call, **query)
+        timings.setdefault(name, []).append(time.perf_counter() - started)
+        if name == "add":
+            added.append(result["id"])
+    # Leave the database as it was
+    for expense_id in added:
+        await conn.request("DELETE", f"/expenses/{expense_id}")
+    conn.close()
+
+
+async def run_load(host, port, clients, duration, write_share):
+    timings = {}
+    deadline = time.perf_counter() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(client(host, port, f"user{n % USERS + 1}", deadline, write_share, n, timings)
+                           for n in range(clients)))
+    elapsed = time.perf_counter() - started
+    stats_conn = await Connection.open(host, port)
+    stats = await stats_conn.request("GET", "/stats")
+    stats_conn.close()
+    return timings, elapsed, stats
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(path, port):
+    server = subprocess.Popen([sys.executable, "server.py", "--db", path, "--port", str(port)],
+                              stdout=subprocess.DEVNULL)
+    for _ in range(200):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("server.py did not start")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="server.py load test.")
+    parser.add_argument("--url", help="an already running server.py over a datagen database")
+    parser.add_argument("--rows", type=int, default=100000, help="size of the generated database")
+    parser.add_argument("--clients", type=int, default=32, help="concurrent connections")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--write-share", type=float, default=0.2, help="fraction of requests that write")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "expense-benchmarks"),
+                        help="where generated databases are kept between runs")
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.url:
+        url = urlsplit(args.url if "//" in args.url else "http://" + args.url)
+        host, port = url.hostname, url.port
+    else:
+        os.makedirs(args.data_dir, exist_ok=True)
+        path = os.path.join(args.data_dir, f"server_{args.rows}.db")
+        if not os.path.exists(path):
+            print(f"Generating {args.rows:,} rows in {path} ...")
+            datagen.generate(path, USERS, args.rows, YEARS)
+        host, port = "127.0.0.1", free_port()
+        server = start_server(path, port)
+    try:
+        timings, elapsed, stats = asyncio.run(run_load(host, port, args.clients, args.duration, args.write_share))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    everything = [seconds for values in timings.values() for seconds in values]
+    print(f"{len(everything):,} requests from {args.clients} clients in {elapsed:.1f}s: "
+          f"{len(everything) / elapsed:,.0f} requests/s, {stats['writes_per_commit']} writes per commit")
+    print(f"{'operation':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, values in sorted(timings.items()) + [("all", everything)]:
+        print(f"{name:<16}{len(values):>8}{percentile(values, 0.50) * 1000:>10.2f}"
+              f"{percentile(values, 0.95) * 1000:>10.2f}{percentile(values, 0.99) * 1000:>10.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
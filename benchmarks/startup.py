@@ -0,0 +1,61 @@
+# Measures how long it takes to import the login window's module in a fresh
+# interpreter, and fails if it got slower than the budget or started pulling in
+# the charting/calendar stacks again.
+#
+#     python -m benchmarks.startup [--runs 7] [--budget 0.5]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be loaded before the user opens a screen that needs them
+HEAVY_MODULES = ["matplotlib", "mplcursors", "tkcalendar", "numpy", "track_main"]
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import login
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def measure(runs):
+    timings = []
+    loaded = set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", PROBE], cwd=REPO_ROOT, check=True,
+                                capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result["seconds"])
+        loaded.update(result["loaded"])
+    return timings, sorted(loaded)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold-start benchmark for login.py.")
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--budget", type=float, default=0.5, help="maximum median import time in seconds")
+    args = parser.parse_args(argv)
+
+    timings, loaded = measure(args.runs)
+    median = statistics.median(timings)
+    print(f"import login: median {median * 1000:.0f} ms, min {min(timings) * 1000:.0f} ms, "
+          f"max {max(timings) * 1000:.0f} ms over {args.runs} runs")
+
+    failed = False
+    if loaded:
+        print(f"FAIL: heavy modules loaded at start-up: {', '.join(loaded)}")
+        failed = True
+    if median > args.budget:
+        print(f"FAIL: median start-up time is over the {args.budget:.2f}s budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+import numpy as np
+import matplotlib
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+
+# Below this many points the daily line keeps one marker per day
+MARKER_LIMIT = 400
+# Horizontal pixels per plotted vertex once a series is downsampled
+PIXELS_PER_POINT = 2
+
+
+def lttb(x, y, threshold):
+    # Largest-Triangle-Three-Buckets: keeps the threshold points that best
+    # preserve the visual shape of the line, always including both end points
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+    sizes = ends - starts
+    # Average of the next bucket is the third corner of each triangle; the
+    # last bucket's is the final point
+    next_x = np.append(np.add.reduceat(x[:n - 1], starts)[1:] / sizes[1:], x[-1])[:, None]
+    next_y = np.append(np.add.reduceat(y[:n - 1], starts)[1:] / sizes[1:], y[-1])[:, None]
+    # Buckets as rows of a padded matrix. Twice the triangle's area is
+    # |px * p + py * q + r| for previous point (px, py), so p, q and r are
+    # computed for every point at once and only the argmax chain is a loop.
+    index = starts[:, None] + np.arange(sizes.max())
+    padding = index >= ends[:, None]
+    index[padding] = n - 1
+    bucket_x, bucket_y = x[index], y[index]
+    p = bucket_y - next_y
+    q = next_x - bucket_x
+    r = bucket_x * next_y - next_x * bucket_y
+    p[padding] = q[padding] = r[padding] = 0
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    previous_x, previous_y = x[0], y[0]
+    for i in range(threshold - 2):
+        chosen = starts[i] + int(np.abs(previous_x * p[i] + previous_y * q[i] + r[i]).argmax())
+        keep[i + 1] = chosen
+        previous_x, previous_y = x[chosen], y[chosen]
+    return x[keep], y[keep]
+
+
+class ChartView:
+    # One figure and canvas for the lifetime of a screen. Updates change the
+    # existing artists and redraw, instead of building a new figure per click.
+
+    def __init__(self, master=None, figsize=(8, 6), offscreen=False):
+        # matplotlib.figure.Figure rather than pyplot, so figures are not kept
+        # alive in pyplot's global registry. An offscreen chart is only ever
+        # saved to files, so updates leave the drawing to save.
+        self.figure = Figure(figsize=figsize)
+        self.offscreen = offscreen
+        self.ax = self.figure.add_subplot()
+        if master is None:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self.canvas = FigureCanvasAgg(self.figure)
+            self.widget = None
+        else:
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+            self.canvas = FigureCanvasTkAgg(self.figure, master=master)
+            self.widget = self.canvas.get_tk_widget()
+
+    def show(self):
+        self.widget.pack(side="left", fill="both", expand=True)
+
+    def hide(self):
+        self.widget.pack_forget()
+
+    def width_pixels(self):
+        if self.widget is not None and self.widget.winfo_width() > 1:
+            return self.widget.winfo_width()
+        return int(self.figure.get_figwidth() * self.figure.dpi)
+
+    def redraw(self):
+        if self.offscreen:
+            return
+        if self.widget is None:
+            self.canvas.draw()
+        else:
+            self.canvas.draw_idle()
+
+    def save(self, path):
+        # Writes the chart as it stands to a PNG or PDF file, by path's extension
+        self.figure.savefig(path)
+
+
+class CategoryPieChart(ChartView):
+    def __init__(self, master=None, offscreen=False):
+        super().__init__(master, figsize=(8, 6), offscreen=offscreen)
+
+    def update(self, category_totals):
+        # A pie has one wedge per category, so rebuilding it is cheap
+        self.ax.clear()
+        self.ax.pie(list(category_totals.values()), labels=list(category_totals.keys()),
+                    autopct='%1.1f%%', startangle=140)
+        self.ax.set_title('Expense Categories Distribution')
+        self.redraw()
+
+
+class DailyFlowChart(ChartView):
+    # Most of a full draw is tick and label layout. The lines are animated,
+    # i.e. left out of full draws, and blitted over a saved background instead,
+    # so an update that keeps the axis limits redraws only the lines.
+
+    def __init__(self, master=None, offscreen=False):
+        super().__init__(master, figsize=(10, 6), offscreen=offscreen)
+        self.line, = self.ax.plot([], [], marker='o', linestyle='-', animated=True, label="Daily total")
+        # Overlays: a line per average, by label, and markers on flagged days
+        self.averages = {}
+        self.marks, = self.ax.plot([], [], linestyle='', marker='o', markersize=8, color="red",
+                                   animated=True, label="Unusual day")
+        self.legend_labels = ()
+        self.background = None
+        # Last downsampling of each line, by line
+        self.downsampled = {}
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+        self.ax.set_title('Daily Expenses Trend')
+        self.ax.set_xlabel('Date')
+        self.ax.set_ylabel('Total Expenses ($)')
+        self.ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))  # Format the x-axis as dates
+        self.ax.tick_params(axis='x', labelrotation=45)  # Rotate x-axis labels for better readability
+        self.figure.subplots_adjust(bottom=0.2)
+        self.cursor = None
+        if self.widget is not None:
+            # Add cursor hover functionality using mplcursors
+            import mplcursors
+            self.cursor = mplcursors.cursor(self.line, hover=True)
+            self.cursor.connect("add", self.format_annotation)
+
+    def format_annotation(self, selection):
+        day = mdates.num2date(selection.target[0]).strftime('%Y-%m-%d')
+        selection.annotation.set_text(f"{day}\n${selection.target[1]:,.2f}")
+
+    def artists(self):
+        # The animated artists, in drawing order
+        return [*self.averages.values(), self.line, self.marks]
+
+    def draw_artists(self):
+        for artist in self.artists():
+            self.ax.draw_artist(artist)
+
+    def on_draw(self, event):
+        # After every full draw (including resizes): save the background
+        # without the lines, then draw the lines on top
+        if not self.line.get_animated():
+            return
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_artists()
+
+    def save(self, path):
+        # Full draws leave the lines out, so they are drawn with the rest for the file
+        for artist in self.artists():
+            artist.set_animated(False)
+        try:
+            super().save(path)
+        finally:
+            for artist in self.artists():
+                artist.set_animated(True)
+
+    def downsample(self, line, x, y):
+        # No point drawing more vertices than the canvas can show apart. The
+        # last result of each line is kept, as the same series is often shown again.
+        threshold = self.width_pixels() // PIXELS_PER_POINT
+        if line in self.downsampled:
+            last_threshold, last_x, last_y, result = self.downsampled[line]
+            if last_threshold == threshold and np.array_equal(last_x, x) and np.array_equal(last_y, y):
+                return result
+        result = lttb(x, y, threshold)
+        self.downsampled[line] = threshold, x, y, result
+        return result
+
+    def update_overlays(self, x, y, averages, anomalies):
+        # Returns whether the legend changed, which needs a full draw
+        for label, values in averages.items():
+            if label not in self.averages:
+                self.averages[label], = self.ax.plot([], [], linestyle='-', linewidth=1.5, animated=True,
+                                                     label=label)
+            self.averages[label].set_data(*self.downsample(self.averages[label], x, np.asarray(values, dtype=float)))
+        for label, line in self.averages.items():
+            if label not in averages:
+                line.set_data([], [])
+        self.marks.set_data(x[anomalies], y[anomalies])
+        labels = tuple(averages) + (("Unusual day",) if len(anomalies) else ())
+        if labels == self.legend_labels:
+            return False
+        self.legend_labels = labels
+        if labels:
+            self.ax.legend(handles=[self.line] + [self.averages[label] for label in averages]
+                                   + ([self.marks] if len(anomalies) else []), loc="upper left")
+        elif self.ax.get_legend() is not None:
+            self.ax.get_legend().remove()
+        return True
+
+    def update(self, dates, totals, averages=None, anomalies=None):
+        # dates are yyyy-mm-dd strings, dates or datetime64 values in ascending
+        # order. averages maps a legend label to a series on the same dates,
+        # drawn over the totals; anomalies are indexes of days to mark.
+        x = mdates.date2num(np.asarray(dates, dtype="datetime64[D]"))
+        y = np.asarray(totals, dtype=float)
+        anomalies = np.asarray(anomalies if anomalies is not None else [], dtype=np.int64)
+        legend_changed = self.update_overlays(x, y, averages or {}, anomalies)
+        x, y = self.downsample(self.line, x, y)
+        self.line.set_data(x, y)
+        self.line.set_marker('o' if len(x) <= MARKER_LIMIT else '')
+        limits = self.ax.get_xlim(), self.ax.get_ylim()
+        self.ax.relim()
+        self.ax.autoscale_view(scaley=False)
+        # A y limit on a round tick value stays put while the totals change a little
+        with matplotlib.rc_context({"axes.autolimit_mode": "round_numbers"}):
+            self.ax.autoscale_view(scalex=False)
+        if len(y) and y.min() >= 0:
+            self.ax.set_ylim(bottom=0, auto=None)
+        if (self.background is not None and not legend_changed
+                and (self.ax.get_xlim(), self.ax.get_ylim()) == limits):
+            self.canvas.restore_region(self.background)
+            self.draw_artists()
+            self.canvas.blit(self.ax.bbox)
+        else:
+            self.redraw()
@@ -1,8 +1,68 @@
+import argparse
+import atexit
+import calendar
+import contextlib
+import csv
+import os
+import pathlib
+import re
 import sqlite3
+import stat
+import struct
+import sys
+import threading
+import time
+from array import array
+from datetime import date as Date, datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
-def connect_to_database():
-    conn = sqlite3.connect('ohhwow.db')
-    cursor = conn.cursor()
+DB_NAME = 'ohhwow.db'
+
+# Number of prepared statements sqlite3 keeps per connection
+STATEMENT_CACHE_SIZE = 256
+# Class of every connection opened here; instrumentation.enable() swaps in a timing subclass
+connection_factory = sqlite3.Connection
+# Largest single amount accepted ($10 billion), far enough below the int64 limit
+# that SUM() over millions of rows cannot overflow
+MAX_CENTS = 10 ** 12
+# Rows sampled per index when the planner statistics are refreshed, so doing
+# it on close or after an import takes milliseconds at any size
+ANALYSIS_LIMIT = 1000
+# Seconds between PRAGMA optimize runs on a connection that stays open
+OPTIMIZE_INTERVAL = 60 * 60
+
+_local = threading.local()
+_connections = []
+_lock = threading.Lock()
+# Bumped by close_all_connections so every thread notices its connection is gone
+_generation = 0
+_schema_ready = False
+# Set by use_database(path, read_only=True): connections open the file with
+# mode=ro and never touch the schema
+_read_only = False
+
+
+# Money is stored and summed as integer cents; these two convert at the edges
+def to_cents(amount):
+    # Dollars as typed or parsed (int, float or string) to integer cents,
+    # rounding half away from zero. Raises ValueError for anything else,
+    # including amounts too large for an SQLite integer.
+    try:
+        cents = int((Decimal(str(amount).strip()) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except (InvalidOperation, ValueError):
+        raise ValueError(f"invalid amount '{amount}'") from None
+    if not -MAX_CENTS <= cents <= MAX_CENTS:
+        raise ValueError(f"amount '{amount}' is out of range")
+    return cents
+
+
+def format_cents(cents):
+    # Integer cents as a dollar string with two decimals, exact at any size
+    dollars, remainder = divmod(abs(int(cents)), 100)
+    return f"{'-' if cents < 0 else ''}{dollars}.{remainder:02d}"
+
+
+def create_tables(cursor):
     cursor.execute('''CREATE TABLE IF NOT EXISTS users (
                         id INTEGER PRIMARY KEY,
                         username TEXT UNIQUE,
@@ -22,9 +82,1240 @@ def connect_to_database():
                         user_id INTEGER,
                         target_amount INTEGER,
                         time_period TEXT,
+                        category TEXT,
                         FOREIGN KEY(user_id) REFERENCES users(id)
                     )''')
-    conn.commit()
-    
-    return conn, cursor
+    # Older files have spending_targets without the category column
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(spending_targets)")]
+    if "category" not in columns:
+        cursor.execute("ALTER TABLE spending_targets ADD COLUMN category TEXT")
+    # Years moved out to archive files by archive_year, with the name each
+    # file is attached under and the count and sum of the expenses it holds
+    cursor.execute('''CREATE TABLE IF NOT EXISTS archives (
+                        year INTEGER PRIMARY KEY,
+                        schema_name TEXT NOT NULL,
+                        rows INTEGER NOT NULL,
+                        total INTEGER NOT NULL
+                    )''')
+    # Rules for expenses that repeat every `every` units (RECURRING_UNITS) from
+    # start_date until end_date (inclusive, NULL for no end).
+    # materialize_recurring adds their occurrences as expenses; materialized
+    # counts the occurrences added so far and next_date is the date of the
+    # next one, NULL once the rule has ended.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS recurring_expenses (
+                        id INTEGER PRIMARY KEY,
+                        user_id INTEGER,
+                        amount INTEGER NOT NULL,
+                        description TEXT,
+                        category TEXT,
+                        start_date TEXT NOT NULL,
+                        unit TEXT NOT NULL,
+                        every INTEGER NOT NULL DEFAULT 1,
+                        end_date TEXT,
+                        materialized INTEGER NOT NULL DEFAULT 0,
+                        next_date TEXT,
+                        FOREIGN KEY(user_id) REFERENCES users(id)
+                    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_recurring_expenses_next ON recurring_expenses(next_date)")
+
+
+def _migrate_date_indexes(cursor):
+    # Older versions could store dates such as 2024-1-5 from the edit dialog;
+    # rewrite them as yyyy-mm-dd so range predicates compare correctly
+    cursor.execute("SELECT id, date FROM expenses "
+                   "WHERE date NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'")
+    fixes = []
+    for expense_id, date in cursor.fetchall():
+        try:
+            fixes.append((datetime.strptime(date, '%Y-%m-%d').strftime('%Y-%m-%d'), expense_id))
+        except (TypeError, ValueError):
+            pass
+    cursor.executemany("UPDATE expenses SET date=? WHERE id=?", fixes)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses(user_id, date)")
+    # Serves the "any year, one month" filter, which no date range can express
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_month "
+                   "ON expenses(user_id, substr(date, 6, 2), date)")
+
+
+# Values of spending_targets.time_period; a NULL category means all categories
+BUDGET_PERIODS = ("daily", "weekly", "monthly")
+
+
+def period_start_sql(date, period="time_period"):
+    # SQL for the first day of the day, week (from Monday) or month that holds
+    # date, for the given time_period. Dates SQLite cannot parse stay as they are.
+    return (f"CASE {period} WHEN 'weekly' THEN COALESCE(date({date}, 'weekday 0', '-6 days'), {date}) "
+            f"WHEN 'monthly' THEN substr({date}, 1, 8) || '01' ELSE {date} END")
+
+
+def create_aggregate_tables(cursor):
+    # Per-day and per-category running totals, kept in step with expenses by
+    # triggers so the summary screens never have to GROUP BY the whole table.
+    # budget_totals holds the running total of every spending target for each
+    # of its periods, so checking a budget is a primary key lookup.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS daily_totals (
+                        user_id INTEGER,
+                        date TEXT,
+                        total INTEGER NOT NULL DEFAULT 0,
+                        count INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (user_id, date)
+                    ) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS category_totals (
+                        user_id INTEGER,
+                        category TEXT,
+                        total INTEGER NOT NULL DEFAULT 0,
+                        count INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (user_id, category)
+                    ) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS budget_totals (
+                        target_id INTEGER REFERENCES spending_targets(id) ON DELETE CASCADE,
+                        period_start TEXT,
+                        total INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (target_id, period_start)
+                    ) WITHOUT ROWID''')
+
+    add_new = f'''
+        INSERT INTO daily_totals (user_id, date, total, count) VALUES (NEW.user_id, NEW.date, NEW.amount, 1)
+            ON CONFLICT (user_id, date) DO UPDATE SET total = total + excluded.total, count = count + 1;
+        INSERT INTO category_totals (user_id, category, total, count) VALUES (NEW.user_id, NEW.category, NEW.amount, 1)
+            ON CONFLICT (user_id, category) DO UPDATE SET total = total + excluded.total, count = count + 1;
+        INSERT INTO budget_totals (target_id, period_start, total)
+            SELECT id, {period_start_sql("NEW.date")}, NEW.amount FROM spending_targets
+            WHERE user_id = NEW.user_id AND (category IS NULL OR category = NEW.category)
+            ON CONFLICT (target_id, period_start) DO UPDATE SET total = total + excluded.total;
+    '''
+    remove_old = f'''
+        UPDATE daily_totals SET total = total - OLD.amount, count = count - 1
+            WHERE user_id = OLD.user_id AND date = OLD.date;
+        DELETE FROM daily_totals WHERE user_id = OLD.user_id AND date = OLD.date AND count <= 0;
+        UPDATE category_totals SET total = total - OLD.amount, count = count - 1
+            WHERE user_id = OLD.user_id AND category = OLD.category;
+        DELETE FROM category_totals WHERE user_id = OLD.user_id AND category = OLD.category AND count <= 0;
+        UPDATE budget_totals SET total = total - OLD.amount
+            WHERE (target_id, period_start) IN (
+                SELECT id, {period_start_sql("OLD.date")} FROM spending_targets
+                WHERE user_id = OLD.user_id AND (category IS NULL OR category = OLD.category));
+    '''
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS expenses_totals_insert AFTER INSERT ON expenses "
+                   f"BEGIN {add_new} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS expenses_totals_delete AFTER DELETE ON expenses "
+                   f"BEGIN {remove_old} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS expenses_totals_update "
+                   f"AFTER UPDATE OF user_id, amount, category, date ON expenses "
+                   f"BEGIN {remove_old} {add_new} END")
+
+
+AGGREGATE_TRIGGERS = ["expenses_totals_insert", "expenses_totals_delete", "expenses_totals_update"]
+
+
+def fill_aggregates(cursor):
+    # Archived expenses count too, so the archives are attached before the
+    # first write opens the transaction
+    source = expense_source(cursor.connection)
+    cursor.execute("DELETE FROM daily_totals")
+    cursor.execute("DELETE FROM category_totals")
+    cursor.execute("INSERT INTO daily_totals (user_id, date, total, count) "
+                   f"SELECT user_id, date, SUM(amount), COUNT(*) FROM {source} GROUP BY user_id, date")
+    cursor.execute("INSERT INTO category_totals (user_id, category, total, count) "
+                   f"SELECT user_id, category, SUM(amount), COUNT(*) FROM {source} GROUP BY user_id, category")
+    cursor.execute("DELETE FROM budget_totals")
+    fill_budget_totals(cursor)
+
+
+def budget_totals_sql(source="expenses"):
+    return (f"SELECT t.id, {period_start_sql('e.date', 't.time_period')}, SUM(e.amount) "
+            f"FROM spending_targets t JOIN {source} e "
+            f"ON e.user_id = t.user_id AND (t.category IS NULL OR e.category = t.category) ")
+
+
+def fill_budget_totals(cursor, target_id=None):
+    # Computes the per-period totals of every target, or of one new target,
+    # over live and archived expenses
+    totals_sql = budget_totals_sql(expense_source(cursor.connection))
+    if target_id is None:
+        cursor.execute(f"INSERT INTO budget_totals (target_id, period_start, total) {totals_sql} "
+                       f"GROUP BY 1, 2")
+    else:
+        # Rows left by a deleted target whose id was reused, if it was deleted
+        # without foreign keys enforced
+        cursor.execute("DELETE FROM budget_totals WHERE target_id = ?", (target_id,))
+        cursor.execute(f"INSERT INTO budget_totals (target_id, period_start, total) {totals_sql} "
+                       f"WHERE t.id = ? GROUP BY 1, 2", (target_id,))
+
+
+def add_aggregates_after(cursor, last_id):
+    # For loaders that drop AGGREGATE_TRIGGERS to skip the per-row work: adds
+    # every expense with an id above last_id to the summary tables with one
+    # statement each and puts the triggers back. Call it in the same
+    # transaction as the inserts.
+    for table, column in (("daily_totals", "date"), ("category_totals", "category")):
+        cursor.execute(f"INSERT INTO {table} (user_id, {column}, total, count) "
+                       f"SELECT user_id, {column}, SUM(amount), COUNT(*) FROM expenses WHERE id > ? "
+                       f"GROUP BY user_id, {column} "
+                       f"ON CONFLICT (user_id, {column}) DO UPDATE "
+                       f"SET total = total + excluded.total, count = count + excluded.count", (last_id,))
+    cursor.execute(f"INSERT INTO budget_totals (target_id, period_start, total) {budget_totals_sql()} "
+                   f"WHERE e.id > ? GROUP BY 1, 2 "
+                   f"ON CONFLICT (target_id, period_start) DO UPDATE SET total = total + excluded.total", (last_id,))
+    create_aggregate_tables(cursor)
+
+
+def rebuild_aggregates(conn):
+    with conn:
+        fill_aggregates(conn.cursor())
+
+
+def create_search_index(cursor):
+    # Full-text index over expense descriptions and categories. It is an
+    # external-content table, so the text itself is stored only in expenses;
+    # the triggers keep the index in step. Prefixes of up to three letters
+    # are indexed like words, so search-as-you-type is fast from the first key.
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5("
+                   "description, category, content='expenses', content_rowid='id', prefix='1 2 3')")
+    add_new = ("INSERT INTO expenses_fts (rowid, description, category) "
+               "VALUES (NEW.id, NEW.description, NEW.category);")
+    remove_old = ("INSERT INTO expenses_fts (expenses_fts, rowid, description, category) "
+                  "VALUES ('delete', OLD.id, OLD.description, OLD.category);")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS expenses_search_insert AFTER INSERT ON expenses "
+                   f"BEGIN {add_new} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS expenses_search_delete AFTER DELETE ON expenses "
+                   f"BEGIN {remove_old} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS expenses_search_update "
+                   f"AFTER UPDATE OF description, category ON expenses "
+                   f"BEGIN {remove_old} {add_new} END")
+
+
+SEARCH_TRIGGERS = ["expenses_search_insert", "expenses_search_delete", "expenses_search_update"]
+
+
+def fts5_available(cursor):
+    return any(option == "ENABLE_FTS5" for (option,) in cursor.execute("PRAGMA compile_options"))
+
+
+def search_available(cursor, schema="main"):
+    # False for databases set up by an SQLite build without FTS5, and for
+    # archives made from one
+    return cursor.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name='expenses_fts'").fetchone() is not None
+
+
+def index_expenses_after(cursor, last_id):
+    # For loaders that drop SEARCH_TRIGGERS to skip the per-row work: indexes
+    # every expense with an id above last_id in one statement and puts the
+    # triggers back. Call it in the same transaction as the inserts.
+    if search_available(cursor):
+        cursor.execute("INSERT INTO expenses_fts (rowid, description, category) "
+                       "SELECT id, description, category FROM expenses WHERE id > ?", (last_id,))
+        create_search_index(cursor)
+
+
+def rebuild_search_index(conn):
+    # Also creates the index for a database first opened without FTS5
+    with conn:
+        create_search_index(conn.cursor())
+        conn.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+
+
+def search_query(text):
+    # Turns what the user typed into an FTS5 query in which every word has to
+    # match as a prefix, so "ub rid" finds "Uber ride". Quoting each word keeps
+    # FTS5 operators and punctuation in the input from being parsed as syntax.
+    # Returns None when there is nothing to search for.
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text)) or None
+
+
+def bulk_load_expenses(rows, batch_size=100000):
+    # Loads (user_id, amount in cents, description, category, date) rows in a single
+    # transaction for seeding or restoring large databases. The per-row trigger
+    # work is skipped during the load: the summary tables are rebuilt in one
+    # pass at the end and the new rows are added to the search index in one
+    # statement. Other writers are locked out until it commits.
+    conn = get_connection()
+    cursor = conn.cursor()
+    count = 0
+    # fill_aggregates reads the archives, which cannot be attached once the transaction is open
+    expense_schemas(conn)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        last_id = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM expenses").fetchone()[0]
+        for trigger in AGGREGATE_TRIGGERS + SEARCH_TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                cursor.executemany("INSERT INTO expenses (user_id, amount, description, category, date) "
+                                   "VALUES (?, ?, ?, ?, ?)", batch)
+                count += len(batch)
+                batch.clear()
+        cursor.executemany("INSERT INTO expenses (user_id, amount, description, category, date) "
+                           "VALUES (?, ?, ?, ?, ?)", batch)
+        count += len(batch)
+        fill_aggregates(cursor)
+        create_aggregate_tables(cursor)
+        index_expenses_after(cursor, last_id)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return count
+
+
+RECURRING_UNITS = ("day", "week", "month", "year")
+
+
+def recurring_date(start, unit, every, index):
+    # The date of a rule's index-th occurrence, 0 being start. Months and
+    # years count from start, so a rule on the 31st falls on the last day of
+    # shorter months and is back on the 31st after them.
+    if unit == "day":
+        return start + timedelta(days=every * index)
+    if unit == "week":
+        return start + timedelta(weeks=every * index)
+    year, month = divmod(start.month - 1 + every * index * (12 if unit == "year" else 1), 12)
+    year, month = start.year + year, month + 1
+    return start.replace(year=year, month=month, day=min(start.day, calendar.monthrange(year, month)[1]))
+
+
+def recurring_dates(start_date, unit, every, end_date=None, index=0):
+    # Lazily yields a rule's occurrence dates as yyyy-mm-dd strings, from the
+    # index-th on, until end_date or without end
+    start = Date.fromisoformat(start_date)
+    while True:
+        date = recurring_date(start, unit, every, index).isoformat()
+        if end_date is not None and date > end_date:
+            return
+        yield date
+        index += 1
+
+
+def materialize_recurring(today=None, user_id=None, commit=True):
+    # Adds every occurrence of the recurring expenses (one user's, or
+    # everyone's) dated up to today as an ordinary expense and returns how many
+    # were added. Catching up after months away is one executemany of all the
+    # missed occurrences in one transaction, with the rules' progress recorded
+    # in the same transaction, so running it again adds nothing twice. A
+    # quiet run is one indexed query. Later occurrences are not stored;
+    # recurring_dates generates them when a forecast asks.
+    today = (today or Date.today()).isoformat()
+    user_clause, user_params = (" AND user_id=?", [user_id]) if user_id is not None else ("", [])
+    conn = get_connection()
+    if commit:
+        # Immediate, so two apps catching up at once cannot both read the same rules as due
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        rules = conn.execute("SELECT id, user_id, amount, description, category, start_date, unit, every, "
+                             "end_date, materialized FROM recurring_expenses WHERE next_date <= ?" + user_clause,
+                             [today] + user_params).fetchall()
+        rows, progress = [], []
+        for rule_id, owner, amount, description, category, start_date, unit, every, end_date, index in rules:
+            next_date = None
+            for date in recurring_dates(start_date, unit, every, end_date, index):
+                if date > today:
+                    next_date = date
+                    break
+                rows.append((owner, amount, description, category, date))
+                index += 1
+            progress.append((index, next_date, rule_id))
+        conn.executemany("INSERT INTO expenses (user_id, amount, description, category, date) "
+                         "VALUES (?, ?, ?, ?, ?)", rows)
+        conn.executemany("UPDATE recurring_expenses SET materialized=?, next_date=? WHERE id=?", progress)
+        if commit:
+            conn.commit()
+    except BaseException:
+        if commit:
+            conn.rollback()
+        raise
+    return len(rows)
+
+
+def verify_aggregates(conn):
+    # Returns (table, key, stored, actual) for every summary row that disagrees
+    # with the live and archived expenses
+    mismatches = []
+    source = expense_source(conn)
+    for table, column in (("daily_totals", "date"), ("category_totals", "category")):
+        actual = {(row[0], row[1]): (row[2], row[3]) for row in conn.execute(
+            f"SELECT user_id, {column}, SUM(amount), COUNT(*) FROM {source} GROUP BY user_id, {column}")}
+        stored = {(row[0], row[1]): (row[2], row[3]) for row in conn.execute(
+            f"SELECT user_id, {column}, total, count FROM {table}")}
+        for key in actual.keys() | stored.keys():
+            expected, found = actual.get(key, (0, 0)), stored.get(key, (0, 0))
+            if expected != found:
+                mismatches.append((table, key, found, expected))
+    actual = {(row[0], row[1]): row[2] for row in conn.execute(budget_totals_sql(source) + "GROUP BY 1, 2")}
+    stored = {(row[0], row[1]): row[2] for row in conn.execute("SELECT target_id, period_start, total "
+                                                               "FROM budget_totals WHERE total != 0")}
+    for key in actual.keys() | stored.keys():
+        if actual.get(key, 0) != stored.get(key, 0):
+            mismatches.append(("budget_totals", key, stored.get(key, 0), actual.get(key, 0)))
+    return mismatches
+
+
+# Closed years can be moved out of the live database into a compacted,
+# read-only file each. Queries reach them through expense_schemas, which
+# attaches a year's file to a connection the first time a date range needs
+# it. The summary tables go on counting archived expenses, so totals,
+# charts and budgets never need the archives.
+ARCHIVE_COLUMNS = "id, user_id, amount, description, category, date"
+
+
+def archive_path(year, path=None):
+    # ohhwow.db keeps 2019 in ohhwow.2019.db, next to it; path is another
+    # database than the current one, e.g. a backup
+    root, ext = os.path.splitext(path or DB_NAME)
+    return f"{root}.{int(year)}{ext}"
+
+
+def read_only_uri(path):
+    # For sqlite3.connect(..., uri=True) and ATTACH, opening path without write access
+    return pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+
+
+def remove_archive_file(path):
+    # Archive files are made read-only on disk. POSIX removes them anyway;
+    # elsewhere they need write permission back first. Not chmod-ing first
+    # matters where a backup hard-links the file: the permission is shared.
+    for name in (path, path + "-journal"):
+        if os.path.exists(name):
+            try:
+                os.remove(name)
+            except PermissionError:
+                os.chmod(name, stat.S_IREAD | stat.S_IWRITE)
+                os.remove(name)
+
+
+def expense_schemas(conn, year=None, years=None):
+    # The schemas holding expenses dated in year, or in the (first, last)
+    # years, either of which may be None for an open end, or in any year:
+    # "main", then each archive that can hold some, attached on first use.
+    # Call it before opening a transaction; SQLite cannot ATTACH inside one.
+    archives = conn.execute("SELECT year, schema_name FROM archives ORDER BY year").fetchall()
+    if not archives:
+        return ["main"]
+    first, last = (int(year), int(year)) if year is not None else years or (None, None)
+    current = {schema for _, schema in archives}
+    wanted = [schema for archived, schema in archives
+              if (first is None or archived >= first) and (last is None or archived <= last)]
+    attached = {name for _, name, _ in conn.execute("PRAGMA database_list")}
+    if not conn.in_transaction:
+        # Files another process has since unarchived, or archived again
+        for name in attached - current:
+            if name.startswith("archive_"):
+                conn.execute(f"DETACH DATABASE {name}")
+    for archived, schema in archives:
+        if schema in wanted and schema not in attached:
+            conn.execute(f"ATTACH DATABASE ? AS {schema}", (read_only_uri(archive_path(archived)),))
+    return ["main"] + wanted
+
+
+def expense_source(conn):
+    # Every expense, live or archived, as something to SELECT ... FROM
+    schemas = expense_schemas(conn)
+    if len(schemas) == 1:
+        return "expenses"
+    return "(" + " UNION ALL ".join(f"SELECT {ARCHIVE_COLUMNS} FROM {schema}.expenses" for schema in schemas) + ")"
+
+
+def _create_archive_tables(cursor, schema):
+    # The expenses table without its foreign key (users stays in the live
+    # database), the same indexes under the same names, and a search index
+    # if the live database has one. No triggers: archives are never written.
+    cursor.execute(f'''CREATE TABLE {schema}.expenses (
+                        id INTEGER PRIMARY KEY,
+                        user_id INTEGER,
+                        amount INTEGER,
+                        description TEXT,
+                        category TEXT,
+                        date TEXT
+                    )''')
+    cursor.execute(f"CREATE INDEX {schema}.idx_expenses_user_date ON expenses(user_id, date)")
+    cursor.execute(f"CREATE INDEX {schema}.idx_expenses_user_month ON expenses(user_id, substr(date, 6, 2), date)")
+    cursor.execute(f"CREATE INDEX {schema}.idx_expenses_user_category ON expenses(user_id, category, date, amount)")
+    cursor.execute(f"CREATE INDEX {schema}.idx_expenses_user_amount ON expenses(user_id, amount)")
+    cursor.execute(f"CREATE INDEX {schema}.idx_expenses_user_description ON expenses(user_id, description)")
+    if search_available(cursor):
+        cursor.execute(f"CREATE VIRTUAL TABLE {schema}.expenses_fts USING fts5("
+                       f"description, category, content='expenses', content_rowid='id', prefix='1 2 3')")
+
+
+def archive_year(year, vacuum=False):
+    # Moves the expenses dated in a year before this one into archive_path(year).
+    # The year is first copied into the new file, compacted and made durable.
+    # Then one transaction checks the copy against the live rows, deletes them
+    # and records the archive, so a failure at any point leaves every expense
+    # where it was. With vacuum the live file is compacted afterwards.
+    # Returns the number of expenses moved.
+    year = int(year)
+    if year >= Date.today().year:
+        raise ValueError(f"{year} is not over yet; only earlier years can be archived")
+    conn = get_connection()
+    archived = [row[0] for row in conn.execute("SELECT year FROM archives")]
+    if year in archived:
+        raise ValueError(f"{year} is already archived")
+    limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(archived) >= limit:
+        raise ValueError(f"SQLite can attach at most {limit} archives; unarchive a year first")
+    start, end = f"{year:04d}-01-01", f"{year + 1:04d}-01-01"
+    count, total, newest = conn.execute("SELECT COUNT(*), COALESCE(SUM(amount), 0), MAX(id) FROM expenses "
+                                        "WHERE date >= ? AND date < ?", (start, end)).fetchone()
+    if not count:
+        raise ValueError(f"there are no expenses dated {year}")
+    # SQLite hands out the highest id plus one, so moving the highest id away
+    # would let a new expense take an id the archive already uses
+    if newest == conn.execute("SELECT MAX(id) FROM expenses").fetchone()[0]:
+        raise ValueError(f"the most recently added expense is dated {year}; "
+                         f"archive it once a later expense has been added")
+
+    path = archive_path(year)
+    schema = f"archive_{year}_{int(time.time())}"
+    # A file without an archives row is left from an archiving that did not commit
+    remove_archive_file(path)
+    conn.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+    try:
+        conn.execute(f"PRAGMA {schema}.journal_mode=DELETE")
+        cursor = conn.cursor()
+        with conn:
+            _create_archive_tables(cursor, schema)
+            cursor.execute(f"INSERT INTO {schema}.expenses SELECT {ARCHIVE_COLUMNS} FROM main.expenses "
+                           f"WHERE date >= ? AND date < ? ORDER BY user_id, date", (start, end))
+            if search_available(cursor):
+                cursor.execute(f"INSERT INTO {schema}.expenses_fts (expenses_fts) VALUES ('rebuild')")
+        conn.execute("PRAGMA analysis_limit=1000")
+        conn.execute(f"ANALYZE {schema}")
+        conn.execute(f"VACUUM {schema}")
+    except BaseException:
+        conn.execute(f"DETACH DATABASE {schema}")
+        remove_archive_file(path)
+        raise
+    conn.execute(f"DETACH DATABASE {schema}")
+    os.chmod(path, stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
+
+    conn.execute(f"ATTACH DATABASE ? AS {schema}", (read_only_uri(path),))
+    cursor = conn.cursor()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        live = cursor.execute("SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM main.expenses "
+                              "WHERE date >= ? AND date < ?", (start, end)).fetchone()
+        copied = cursor.execute(f"SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM {schema}.expenses").fetchone()
+        if live != copied:
+            raise ValueError(f"expenses dated {year} changed while they were copied; run it again")
+        # The summary rows keep counting the archived expenses
+        for trigger in AGGREGATE_TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cursor.execute("DELETE FROM main.expenses WHERE date >= ? AND date < ?", (start, end))
+        create_aggregate_tables(cursor)
+        cursor.execute("INSERT INTO archives (year, schema_name, rows, total) VALUES (?, ?, ?, ?)",
+                       (year, schema, copied[0], copied[1]))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        conn.execute(f"DETACH DATABASE {schema}")
+        remove_archive_file(path)
+        raise
+    analyze(conn)
+    if vacuum:
+        conn.execute("VACUUM")
+    return copied[0]
+
+
+def unarchive_year(year):
+    # Moves an archived year back into the live database in one transaction,
+    # then deletes its file. Expenses keep their ids unless a live expense has
+    # taken one meanwhile. Returns the number of expenses moved back.
+    conn = get_connection()
+    row = conn.execute("SELECT schema_name, rows FROM archives WHERE year=?", (int(year),)).fetchone()
+    if row is None:
+        raise ValueError(f"{year} is not archived")
+    schema, rows = row
+    expense_schemas(conn, year)
+    cursor = conn.cursor()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # The summary rows have counted these expenses all along
+        for trigger in AGGREGATE_TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        moved = cursor.execute(
+            f"INSERT INTO main.expenses ({ARCHIVE_COLUMNS}) "
+            f"SELECT CASE WHEN EXISTS (SELECT 1 FROM main.expenses WHERE id = a.id) THEN NULL ELSE a.id END, "
+            f"a.user_id, a.amount, a.description, a.category, a.date FROM {schema}.expenses a").rowcount
+        if moved != rows:
+            raise ValueError(f"the archive of {year} holds {moved} expenses, not {rows}")
+        create_aggregate_tables(cursor)
+        cursor.execute("DELETE FROM archives WHERE year=?", (int(year),))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.execute(f"DETACH DATABASE {schema}")
+    remove_archive_file(archive_path(year))
+    analyze(conn)
+    return moved
+
+
+def _migrate_aggregate_tables(cursor):
+    create_aggregate_tables(cursor)
+    fill_aggregates(cursor)
+
+
+def _migrate_amount_cents(cursor):
+    # Amounts used to be whatever the caller passed: floats, and strings from
+    # the edit dialog. Rounding to 2 places first keeps values like 0.285 from
+    # landing a cent low after the multiplication. The summary tables are
+    # rebuilt once instead of letting the update trigger fire per row.
+    for trigger in AGGREGATE_TRIGGERS:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("UPDATE expenses SET amount = CAST(ROUND(ROUND(CAST(amount AS REAL), 2) * 100) AS INTEGER) "
+                   "WHERE amount IS NOT NULL")
+    cursor.execute("UPDATE spending_targets "
+                   "SET target_amount = CAST(ROUND(ROUND(CAST(target_amount AS REAL), 2) * 100) AS INTEGER) "
+                   "WHERE target_amount IS NOT NULL")
+    create_aggregate_tables(cursor)
+    fill_aggregates(cursor)
+
+
+def _migrate_search_index(cursor):
+    # Without FTS5 the app runs without search; 'python db.py rebuild-search'
+    # adds the index later on a build that has it
+    if not fts5_available(cursor):
+        return
+    create_search_index(cursor)
+    cursor.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+
+
+def _migrate_budget_periods(cursor):
+    # Targets gain a period the app uses (the one target it could set so far
+    # was checked per day) and a category, added by create_tables. The
+    # aggregate triggers are recreated with the budget_totals upkeep in them.
+    cursor.execute("UPDATE spending_targets SET time_period = 'daily' "
+                   "WHERE time_period IS NULL OR time_period NOT IN ('daily', 'weekly', 'monthly')")
+    cursor.execute("DELETE FROM spending_targets WHERE id NOT IN "
+                   "(SELECT MAX(id) FROM spending_targets GROUP BY user_id, time_period, IFNULL(category, ''))")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_spending_targets_period "
+                   "ON spending_targets (user_id, time_period, IFNULL(category, ''))")
+    for trigger in AGGREGATE_TRIGGERS:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    create_aggregate_tables(cursor)
+    cursor.execute("DELETE FROM budget_totals")
+    fill_budget_totals(cursor)
+
+
+def _migrate_filter_indexes(cursor):
+    # Serve the Expense Records filters and sorts (SORT_KEYS). The category
+    # index walks a category in date order and sorts by category; with amount
+    # in it, a category's total is read from the index alone. The amount index
+    # does the same for amount ranges and the amount sort.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_category "
+                   "ON expenses(user_id, category, date, amount)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_amount ON expenses(user_id, amount)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_description ON expenses(user_id, description)")
+
+
+def _migrate_stale_statistics(cursor):
+    # The filter index migration used to run ANALYZE once, leaving statistics
+    # of the table as it was then (often next to empty) that nothing updated.
+    # They are dropped; optimize() gathers them from the real data.
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+        cursor.execute("DELETE FROM main.sqlite_stat1")
+
+
+# Applied in order; PRAGMA user_version records how many have run
+MIGRATIONS = [
+    _migrate_date_indexes,
+    _migrate_aggregate_tables,
+    _migrate_amount_cents,
+    _migrate_search_index,
+    _migrate_budget_periods,
+    _migrate_filter_indexes,
+    _migrate_stale_statistics,
+]
+
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        # Explicit BEGIN so the schema changes and the version bump commit together
+        conn.execute("BEGIN")
+        try:
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version={number}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+def _open_connection():
+    # check_same_thread is off only so close_all_connections() can close every
+    # connection at exit; each connection is still used by a single thread
+    # uri allows archives to be attached read-only (mode=ro); plain paths still work
+    conn = sqlite3.connect(read_only_uri(DB_NAME) if _read_only else DB_NAME, check_same_thread=False, uri=True,
+                           cached_statements=STATEMENT_CACHE_SIZE, factory=connection_factory)
+    if _read_only:
+        conn.execute("PRAGMA query_only=ON")
+    else:
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")  # about 16 MB of page cache
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def init_database():
+    # Run the schema setup once per process instead of on every connection.
+    # A read-only process relies on one that can write having done it.
+    global _schema_ready
+    with _lock:
+        if _schema_ready or _read_only:
+            return
+        conn = _open_connection()
+        try:
+            create_tables(conn.cursor())
+            conn.commit()
+            migrate(conn)
+        finally:
+            conn.close()
+        _schema_ready = True
+
+
+def optimize(conn):
+    # Lets SQLite refresh the planner statistics of the tables that changed a
+    # lot since they were gathered, or that have none. Run as connections
+    # close and every OPTIMIZE_INTERVAL on those that stay open. Archives are
+    # analyzed when they are written and never change.
+    if _read_only or conn.in_transaction:
+        return
+    try:
+        conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+        conn.execute("PRAGMA main.optimize")
+    except sqlite3.Error:
+        # Statistics are an optimisation; a busy database can have them next time
+        pass
+
+
+def analyze(conn):
+    # Gathers the planner statistics of the live tables now, after a bulk
+    # change such as an import, archiving or unarchiving a year
+    conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+    conn.execute("ANALYZE main")
+
+
+def get_connection():
+    # One long-lived connection per thread, created on first use
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.generation != _generation:
+        init_database()
+        conn = _open_connection()
+        _local.conn = conn
+        _local.optimized = time.monotonic()
+        with _lock:
+            _local.generation = _generation
+            _connections.append(conn)
+    elif time.monotonic() - _local.optimized >= OPTIMIZE_INTERVAL:
+        _local.optimized = time.monotonic()
+        optimize(conn)
+    return conn
+
+
+def close_connection():
+    # Close the calling thread's connection, e.g. when a worker thread finishes
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    with _lock:
+        if conn in _connections:
+            _connections.remove(conn)
+    optimize(conn)
+    conn.close()
+
+
+def close_all_connections():
+    # Other threads drop their closed connection on their next get_connection()
+    global _generation
+    with _lock:
+        connections = list(_connections)
+        _connections.clear()
+        _generation += 1
+    for conn in connections:
+        try:
+            optimize(conn)
+            conn.close()
+        except sqlite3.Error:
+            pass
+    _local.conn = None
+
+
+atexit.register(close_all_connections)
+
+
+def use_database(path, read_only=False):
+    # Points the module at another database file, e.g. for the command line
+    # tools. read_only is for processes that only report on it.
+    global DB_NAME, _schema_ready, _read_only
+    close_all_connections()
+    with _lock:
+        DB_NAME = path
+        _schema_ready = False
+        _read_only = read_only
+
+
+
+def date_filter(month, year):
+    # Builds an index friendly "AND ..." clause for the month/year filter.
+    # month is 1-12 or None for all months, year is a year or None for all years.
+    if year is not None and month is not None:
+        start = f"{int(year):04d}-{month:02d}-01"
+        end = f"{int(year) + month // 12:04d}-{month % 12 + 1:02d}-01"
+        return " AND date >= ? AND date < ?", [start, end]
+    if year is not None:
+        return " AND date >= ? AND date < ?", [f"{int(year):04d}-01-01", f"{int(year) + 1:04d}-01-01"]
+    if month is not None:
+        return " AND substr(date, 6, 2) = ?", [f"{month:02d}"]
+    return "", []
+
+
+# Columns Expense Records can be sorted by, each with the columns it orders on.
+# The expense id follows them to break ties, so a sort order is also the
+# keyset the next page starts after. Each ordering is that of an index, so
+# paging through a sorted view walks the index instead of sorting.
+SORT_KEYS = {
+    "date": ("date",),
+    "amount": ("amount",),
+    "category": ("category", "date", "amount"),
+    "description": ("description",),
+}
+# Position of each column in (id, amount, description, category, date) rows
+ROW_COLUMNS = {"id": 0, "amount": 1, "description": 2, "category": 3, "date": 4}
+
+
+class ExpenseFilter:
+    # The criteria Expense Records can combine; each one left as None (or
+    # empty) does not narrow the rows. month and year work as in date_filter,
+    # start and end are yyyy-mm-dd dates and min_amount and max_amount are
+    # cents, all inclusive. text is matched like ExpenseRepository.list_matching.
+    # Raises ValueError for criteria that cannot be right.
+
+    FIELDS = ("month", "year", "start", "end", "categories", "min_amount", "max_amount", "text")
+
+    def __init__(self, month=None, year=None, start=None, end=None, categories=(),
+                 min_amount=None, max_amount=None, text=None):
+        if month is not None and month not in range(1, 13):
+            raise ValueError(f"month must be 1-12, not {month}")
+        for name, value in (("start", start), ("end", end)):
+            if value is not None:
+                try:
+                    datetime.strptime(value, "%Y-%m-%d")
+                except (TypeError, ValueError):
+                    raise ValueError(f"{name} must be a yyyy-mm-dd date, not {value!r}") from None
+        for name, value in (("min_amount", min_amount), ("max_amount", max_amount)):
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+                raise ValueError(f"{name} must be cents, not {value!r}")
+        if isinstance(categories, str) or not all(isinstance(category, str) for category in categories):
+            raise ValueError("categories must be a list of category names")
+        self.month = month
+        self.year = int(year) if year is not None else None
+        self.start = start
+        self.end = end
+        self.categories = tuple(categories)
+        self.min_amount = min_amount
+        self.max_amount = max_amount
+        self.text = text or None
+
+    def to_dict(self):
+        values = {name: getattr(self, name) for name in self.FIELDS}
+        values["categories"] = list(self.categories)
+        return values
+
+    @classmethod
+    def from_dict(cls, values):
+        unknown = set(values) - set(cls.FIELDS)
+        if unknown:
+            raise ValueError(f"unknown filter fields: {', '.join(sorted(unknown))}")
+        return cls(**values)
+
+    def __eq__(self, other):
+        return isinstance(other, ExpenseFilter) and self.to_dict() == other.to_dict()
+
+    def search(self):
+        return search_query(self.text) if self.text else None
+
+    def beyond_month_year(self):
+        # True when something other than month, year and text narrows the rows
+        return bool(self.start or self.end or self.categories
+                    or self.min_amount is not None or self.max_amount is not None)
+
+    def years(self):
+        # (first, last) year the rows can be dated in, None for an open end
+        first = last = self.year
+        if self.start is not None:
+            first = max(first or 0, int(self.start[:4]))
+        if self.end is not None:
+            last = min(last if last is not None else int(self.end[:4]), int(self.end[:4]))
+        return first, last
+
+    def matches(self, amount, category, date):
+        # Whether an expense meets every criterion but text, which only FTS5 can judge
+        return ((self.month is None or int(date[5:7]) == self.month)
+                and (self.year is None or date[:4] == f"{self.year:04d}")
+                and (self.start is None or date >= self.start)
+                and (self.end is None or date <= self.end)
+                and (not self.categories or category in self.categories)
+                and (self.min_amount is None or amount >= self.min_amount)
+                and (self.max_amount is None or amount <= self.max_amount))
+
+    def where(self):
+        # " AND ..." over the columns of expenses, and its parameters. The text
+        # criterion reads {schema}.expenses_fts, so format {schema} with the
+        # schema the expenses table is read from.
+        clause, params = date_filter(self.month, self.year)
+        if self.start is not None:
+            clause += " AND date >= ?"
+            params.append(self.start)
+        if self.end is not None:
+            clause += " AND date <= ?"
+            params.append(self.end)
+        if self.categories:
+            clause += f" AND category IN ({', '.join('?' * len(self.categories))})"
+            params += self.categories
+        if self.min_amount is not None:
+            clause += " AND amount >= ?"
+            params.append(self.min_amount)
+        if self.max_amount is not None:
+            clause += " AND amount <= ?"
+            params.append(self.max_amount)
+        query = self.search()
+        if query is not None:
+            clause += " AND id IN (SELECT rowid FROM {schema}.expenses_fts WHERE expenses_fts MATCH ?)"
+            params.append(query)
+        return clause, params
+
+
+def sort_columns(sort):
+    if sort not in SORT_KEYS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_KEYS)}")
+    return SORT_KEYS[sort] + ("id",)
+
+
+def order_by(sort, descending=False):
+    return ", ".join(column + (" DESC" if descending else "") for column in sort_columns(sort))
+
+
+def after_clause(sort, descending=False):
+    # " AND ..." for the rows after a page ending at the keyset sort_key() gave
+    columns = sort_columns(sort)
+    return f" AND ({', '.join(columns)}) {'<' if descending else '>'} ({', '.join('?' * len(columns))})"
+
+
+def sort_key(row, sort):
+    # The keyset of an (id, amount, description, category, date) row in a sort order
+    return tuple(row[ROW_COLUMNS[column]] for column in sort_columns(sort))
+
+
+def transaction(conn, commit=True):
+    # "with transaction(conn):" commits or rolls back like "with conn:". With
+    # commit False the caller owns the transaction, e.g. the server's writer,
+    # which runs many requests in one.
+    return conn if commit else contextlib.nullcontext(conn)
+
+
+def authenticate(username, password):
+    return get_connection().execute("SELECT * FROM users WHERE username=? AND password=?",
+                                    (username, password)).fetchone()
+
+
+def find_user_id(username):
+    row = get_connection().execute("SELECT id FROM users WHERE username=?", (username,)).fetchone()
+    return row[0] if row else None
+
+
+def register_user(username, password, commit=True):
+    # Returns False when the username is already taken
+    conn = get_connection()
+    if conn.execute("SELECT 1 FROM users WHERE username=?", (username,)).fetchone():
+        return False
+    with transaction(conn, commit):
+        conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
+    return True
+
+
+# Rows pulled from SQLite per fetchmany() call while exporting
+EXPORT_ARRAYSIZE = 5000
+COLUMNAR_MAGIC = b"EXPCOL\x02"
+# Version 1 files stored amounts as float64 dollars
+COLUMNAR_MAGIC_V1 = b"EXPCOL\x01"
+EXPORT_COLUMNS = ["id", "amount", "description", "category", "date"]
+
+
+def iter_expenses(user_id, expense_filter=None, arraysize=EXPORT_ARRAYSIZE):
+    # Yields lists of the rows meeting an ExpenseFilter (every row without
+    # one) in (date, id) order, arraysize rows at a time, so the caller never
+    # holds more than one chunk of the table in memory. Archived years are
+    # read from their files.
+    expense_filter = expense_filter or ExpenseFilter()
+    clause, params = expense_filter.where()
+    conn = get_connection()
+    schemas = expense_schemas(conn, years=expense_filter.years())
+    if expense_filter.search() is not None:
+        schemas = [schema for schema in schemas if search_available(conn, schema)]
+    if not schemas:
+        return
+    cursor = conn.cursor()
+    cursor.arraysize = arraysize
+    cursor.execute(" UNION ALL ".join(f"SELECT id, amount, description, category, date FROM {schema}.expenses "
+                                      f"WHERE user_id=?" + clause.format(schema=schema) for schema in schemas)
+                   + " ORDER BY date, id", ([user_id] + params) * len(schemas))
+    while True:
+        rows = cursor.fetchmany()
+        if not rows:
+            break
+        yield rows
+
+
+def export_csv(path, user_id, expense_filter=None):
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(EXPORT_COLUMNS)
+        for rows in iter_expenses(user_id, expense_filter):
+            writer.writerows((row[0], format_cents(row[1] or 0), row[2], row[3], row[4]) for row in rows)
+            count += len(rows)
+    return count
+
+
+def _write_array(out, values):
+    # The columnar format is little-endian whatever machine wrote it
+    if sys.byteorder == "big":
+        values.byteswap()
+    values.tofile(out)
+
+
+def _read_array(data, typecode, count):
+    values = array(typecode)
+    values.frombytes(data.read(values.itemsize * count))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def export_columnar(path, user_id, expense_filter=None):
+    # Compact binary export. After the magic header the file is a series of
+    # blocks, each starting with its row count (0 ends the file):
+    #   new categories: count, then (length, utf-8 bytes) for each
+    #   id int64[n], amount in cents int64[n], date ordinal int32[n],
+    #   category code uint16[n], description length uint32[n], description bytes
+    # Category codes refer to every category declared so far in the file.
+    categories = {}
+    day_ordinals = {}
+    count = 0
+    with open(path, "wb") as out:
+        out.write(COLUMNAR_MAGIC)
+        for rows in iter_expenses(user_id, expense_filter):
+            new_categories = []
+            codes = array("H")
+            for row in rows:
+                category = row[3] or ""
+                if category not in categories:
+                    categories[category] = len(categories)
+                    new_categories.append(category.encode("utf-8"))
+                codes.append(categories[category])
+            ordinals = array("i")
+            for row in rows:
+                if row[4] not in day_ordinals:
+                    try:
+                        day_ordinals[row[4]] = Date.fromisoformat(row[4]).toordinal()
+                    except (TypeError, ValueError):
+                        day_ordinals[row[4]] = 0
+                ordinals.append(day_ordinals[row[4]])
+            descriptions = [(row[2] or "").encode("utf-8") for row in rows]
+
+            out.write(struct.pack("<II", len(rows), len(new_categories)))
+            for name in new_categories:
+                out.write(struct.pack("<H", len(name)) + name)
+            _write_array(out, array("q", [row[0] for row in rows]))
+            _write_array(out, array("q", [row[1] or 0 for row in rows]))
+            _write_array(out, ordinals)
+            _write_array(out, codes)
+            _write_array(out, array("I", [len(text) for text in descriptions]))
+            out.write(b"".join(descriptions))
+            count += len(rows)
+        out.write(struct.pack("<I", 0))
+    return count
+
+
+def read_columnar(path):
+    # Streams (id, amount in cents, description, category, date) tuples back
+    # out of an export_columnar file
+    categories = []
+    with open(path, "rb") as data:
+        magic = data.read(len(COLUMNAR_MAGIC))
+        if magic not in (COLUMNAR_MAGIC, COLUMNAR_MAGIC_V1):
+            raise ValueError(f"{path} is not a columnar expense export")
+        while True:
+            (count,) = struct.unpack("<I", data.read(4))
+            if count == 0:
+                break
+            (new_categories,) = struct.unpack("<I", data.read(4))
+            for _ in range(new_categories):
+                (length,) = struct.unpack("<H", data.read(2))
+                categories.append(data.read(length).decode("utf-8"))
+            ids = _read_array(data, "q", count)
+            if magic == COLUMNAR_MAGIC_V1:
+                amounts = [to_cents(amount) for amount in _read_array(data, "d", count)]
+            else:
+                amounts = _read_array(data, "q", count)
+            ordinals = _read_array(data, "i", count)
+            codes = _read_array(data, "H", count)
+            lengths = _read_array(data, "I", count)
+            blob = data.read(sum(lengths))
+            offset = 0
+            for i in range(count):
+                description = blob[offset:offset + lengths[i]].decode("utf-8")
+                offset += lengths[i]
+                day = Date.fromordinal(ordinals[i]).isoformat() if ordinals[i] else None
+                yield ids[i], amounts[i], description, categories[codes[i]], day
+
+
+EXPORT_FORMATS = {"csv": export_csv, "columnar": export_columnar}
+
+
+def query_plan(sql, params=()):
+    conn = get_connection()
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def check_query_plans():
+    # Every month/year filter shape must be answered from an index, not a scan
+    problems = []
+    for month, year in [(None, None), (None, 2024), (3, None), (3, 2024), (12, 2024)]:
+        clause, params = date_filter(month, year)
+        sql = "SELECT id, amount, description, category, date FROM expenses WHERE user_id=?" + clause
+        plan = query_plan(sql, [1] + params)
+        if not any("USING" in step and "INDEX" in step for step in plan):
+            problems.append((sql, plan))
+        # The next-page query must walk the index in order instead of sorting
+        sql += " AND (date, id) > (?, ?) ORDER BY date, id LIMIT ?"
+        plan = query_plan(sql, [1] + params + ["2024-01-01", 0, 200])
+        if any("TEMP B-TREE" in step for step in plan):
+            problems.append((sql, plan))
+
+    # The common ExpenseFilter shapes: the page and the total each start from an index
+    shapes = [ExpenseFilter(start="2024-03-01", end="2024-03-31"),
+              ExpenseFilter(categories=["Food"]),
+              ExpenseFilter(categories=["Food", "Shopping"], year=2024),
+              ExpenseFilter(min_amount=1000, max_amount=5000),
+              ExpenseFilter(categories=["Food"], min_amount=1000, month=3)]
+    if search_available(get_connection()):
+        shapes.append(ExpenseFilter(text="coffee", year=2024))
+    for expense_filter in shapes:
+        clause, params = expense_filter.where()
+        clause = clause.format(schema="main")
+        for sql in ("SELECT id, amount, description, category, date FROM expenses WHERE user_id=?" + clause
+                    + " ORDER BY " + order_by("date") + " LIMIT 200",
+                    "SELECT SUM(amount) FROM expenses WHERE user_id=?" + clause):
+            plan = query_plan(sql, [1] + params)
+            if any(step.startswith("SCAN expenses") for step in plan):
+                problems.append((sql, plan))
+    # Every indexed sort pages along its index, either way round
+    for sort in SORT_KEYS:
+        for descending in (False, True):
+            sql = ("SELECT id, amount, description, category, date FROM expenses WHERE user_id=?"
+                   + after_clause(sort, descending) + " ORDER BY " + order_by(sort, descending) + " LIMIT 200")
+            plan = query_plan(sql, [1] + [None] * len(sort_columns(sort)))
+            if any("TEMP B-TREE" in step for step in plan):
+                problems.append((sql, plan))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintenance commands for the expense database.")
+    parser.add_argument("--db", default=DB_NAME, help="database file (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("check-plans", help="check that the filter queries use an index")
+    commands.add_parser("rebuild-aggregates", help="recompute the daily and category totals from expenses")
+    commands.add_parser("rebuild-search", help="rebuild the full-text search index from expenses")
+    commands.add_parser("verify-aggregates", help="compare the daily and category totals with expenses")
+    archive = commands.add_parser("archive", help="move a closed year's expenses into a read-only file")
+    archive.add_argument("year", type=int)
+    archive.add_argument("--vacuum", action="store_true", help="compact the live database afterwards")
+    unarchive = commands.add_parser("unarchive", help="move an archived year back into the live database")
+    unarchive.add_argument("year", type=int)
+    commands.add_parser("archives", help="list the archived years")
+    commands.add_parser("catch-up", help="add every user's recurring expenses that have come due")
+    export = commands.add_parser("export", help="stream a user's expenses to a file")
+    export.add_argument("output", help="file to write")
+    export.add_argument("--user", required=True, help="username whose expenses are exported")
+    export.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+    export.add_argument("--month", type=int, choices=range(1, 13), metavar="1-12")
+    export.add_argument("--year", type=int)
+    args = parser.parse_args(argv)
+
+    use_database(args.db)
+
+    if args.command == "check-plans":
+        failures = check_query_plans()
+        for sql, plan in failures:
+            print(f"Full scan: {sql}\n    {plan}")
+        print("All filter queries use an index." if not failures else f"{len(failures)} queries scan the table.")
+        return 1 if failures else 0
+
+    if args.command == "rebuild-aggregates":
+        rebuild_aggregates(get_connection())
+        print("Daily and category totals rebuilt.")
+        return 0
+
+    if args.command == "rebuild-search":
+        try:
+            rebuild_search_index(get_connection())
+        except sqlite3.OperationalError as error:
+            print(f"Could not build the search index: {error}")
+            return 1
+        print("Search index rebuilt.")
+        return 0
+
+    if args.command == "verify-aggregates":
+        mismatches = verify_aggregates(get_connection())
+        for table, key, found, expected in mismatches:
+            print(f"{table} {key}: stored {found}, expected {expected}")
+        print("Totals match expenses." if not mismatches else f"{len(mismatches)} totals are out of date.")
+        return 1 if mismatches else 0
+
+    if args.command in ("archive", "unarchive"):
+        try:
+            if args.command == "archive":
+                count = archive_year(args.year, args.vacuum)
+                print(f"Moved {count:,} expenses to {archive_path(args.year)}.")
+            else:
+                count = unarchive_year(args.year)
+                print(f"Moved {count:,} expenses back from the {args.year} archive.")
+        except (ValueError, sqlite3.Error, OSError) as error:
+            print(f"Could not {args.command} {args.year}: {error}")
+            return 1
+        return 0
+
+    if args.command == "archives":
+        archives = get_connection().execute("SELECT year, rows, total FROM archives ORDER BY year").fetchall()
+        for year, rows, total in archives:
+            print(f"{year}  {archive_path(year)}  {rows:,} expenses  {format_cents(total)}")
+        print(f"{len(archives)} archived years." if archives else "No archived years.")
+        return 0
+
+    if args.command == "catch-up":
+        count = materialize_recurring()
+        print(f"Added {count:,} recurring expenses.")
+        return 0
+
+    if args.command == "export":
+        user_id = find_user_id(args.user)
+        if user_id is None:
+            print(f"No user named '{args.user}'.")
+            return 1
+        count = EXPORT_FORMATS[args.format](args.output, user_id, ExpenseFilter(args.month, args.year))
+        print(f"Exported {count:,} expenses to {args.output}.")
+        return 0
+
 
+if __name__ == "__main__":
+    sys.exit(main())
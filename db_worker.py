@@ -0,0 +1,121 @@
+import contextlib
+import queue
+import threading
+
+import db
+
+
+class DatabaseWorker:
+    # Runs database jobs on a background thread so the Tk mainloop never waits
+    # on SQL. Results come back to the Tk thread by polling with after().
+    #
+    # Jobs submitted with the same key supersede each other: an older job that
+    # has not started yet is skipped, and the result of one that has already run
+    # is dropped, so only the latest request for a view is ever rendered.
+    #
+    # tracking() collects the jobs a piece of code submits, together with the
+    # jobs their callbacks submit in turn, into a set that empties as they are
+    # delivered, so a caller can wait for its own jobs and no one else's.
+
+    def __init__(self, widget, on_busy=None, poll_ms=20):
+        self.widget = widget
+        self.on_busy = on_busy
+        self.poll_ms = poll_ms
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.tracked = ()
+        self.polling = False
+        self.thread = threading.Thread(target=self._run, name="db-worker", daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args, callback=None, key=None):
+        with self.lock:
+            generation = self.generations.get(key, 0) + 1
+            self.generations[key] = generation
+        job = object()
+        for jobs in self.tracked:
+            jobs.add(job)
+        self.requests.put((key, generation, func, args, callback, (job, self.tracked)))
+        self.in_flight += 1
+        if not self.polling:
+            self.polling = True
+            if self.on_busy:
+                self.on_busy(True)
+            self.widget.after(self.poll_ms, self._poll)
+
+    def cancel(self, key=None):
+        # Drop pending results for one key, or for every keyed job when key is None
+        with self.lock:
+            keys = [key] if key is not None else [k for k in self.generations if k is not None]
+            for k in keys:
+                self.generations[k] = self.generations.get(k, 0) + 1
+
+    @contextlib.contextmanager
+    def tracking(self):
+        jobs = set()
+        outer = self.tracked
+        self.tracked = outer + (jobs,)
+        try:
+            yield jobs
+        finally:
+            self.tracked = outer
+
+    def stop(self):
+        self.requests.put(None)
+
+    def _is_current(self, key, generation):
+        if key is None:
+            return True
+        with self.lock:
+            return self.generations.get(key) == generation
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            key, generation, func, args, callback, job = request
+            if not self._is_current(key, generation):
+                self.results.put((key, generation, None, None, None, job))
+                continue
+            try:
+                self.results.put((key, generation, callback, func(*args), None, job))
+            except Exception as error:
+                self.results.put((key, generation, callback, None, error, job))
+        db.close_connection()
+
+    def _poll(self):
+        while True:
+            try:
+                key, generation, callback, result, error, (job, tracked) = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.in_flight -= 1
+            if not self._is_current(key, generation):
+                for jobs in tracked:
+                    jobs.discard(job)
+                continue
+            if error is None and callback is not None:
+                # Jobs the callback submits belong to the same trackers
+                outer, self.tracked = self.tracked, tracked
+                try:
+                    callback(result)
+                except Exception as callback_error:
+                    error = callback_error
+                finally:
+                    self.tracked = outer
+            for jobs in tracked:
+                jobs.discard(job)
+            # Report but keep polling, otherwise one failure would stall every later job
+            if error is not None:
+                self.widget.report_callback_exception(type(error), error, error.__traceback__)
+
+        if self.in_flight:
+            self.widget.after(self.poll_ms, self._poll)
+        else:
+            self.polling = False
+            if self.on_busy:
+                self.on_busy(False)
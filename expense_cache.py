@@ -0,0 +1,190 @@
+import threading
+from datetime import date as Date
+
+import numpy as np
+
+import db
+
+# Day numbers are days since 1970-01-01, the same unit as numpy's datetime64[D]
+EPOCH_ORDINAL = Date(1970, 1, 1).toordinal()
+LOAD_CHUNK_SIZE = 50000
+
+
+def day_number(text):
+    try:
+        return Date.fromisoformat(text).toordinal() - EPOCH_ORDINAL
+    except (TypeError, ValueError):
+        return 0
+
+
+class ExpenseCache:
+    # A user's expenses held column by column in NumPy arrays (id, amount, day
+    # number, category code), kept sorted by id. Totals and breakdowns are single
+    # vectorised passes, and add/update/delete patch the arrays in place instead
+    # of reloading from the database.
+
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.amounts = np.empty(0, dtype=np.int64)  # cents
+        self.days = np.empty(0, dtype=np.int32)
+        self.codes = np.empty(0, dtype=np.int32)
+        self.size = 0
+        self.categories = []
+        self.category_codes = {}
+        self.ready = False
+        self.loading = False
+        self.lock = threading.Lock()
+        # Changes made while a load is running, replayed once it is installed.
+        # A cache that is not loading ignores them; its next load reads them.
+        self.pending = []
+
+    @classmethod
+    def load(cls, user_id, chunk_size=LOAD_CHUNK_SIZE):
+        # Builds a filled cache. It reads every row of the user, archived years
+        # included, so it is meant
+        # for a thread (and connection) of its own, not the worker that serves
+        # the screens. Rows come in index order, without a sort in SQLite, and
+        # are put in id order with one argsort at the end.
+        cache = cls()
+        conn = db.get_connection()
+        schemas = db.expense_schemas(conn)
+        cursor = conn.cursor()
+        cursor.arraysize = chunk_size
+        cursor.execute(" UNION ALL ".join(f"SELECT id, COALESCE(amount, 0), category, "
+                                          f"COALESCE(CAST(julianday(date) - 2440587.5 AS INTEGER), 0) "
+                                          f"FROM {schema}.expenses INDEXED BY idx_expenses_user_date WHERE user_id=?"
+                                          for schema in schemas), (user_id,) * len(schemas))
+        chunks = []
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                break
+            ids, amounts, categories, days = zip(*rows)
+            chunks.append((np.array(ids, dtype=np.int64),
+                           np.array(amounts, dtype=np.int64),
+                           np.array(days, dtype=np.int32),
+                           np.array([cache.category_code(category) for category in categories], dtype=np.int32)))
+        if chunks:
+            ids, amounts, days, codes = (np.concatenate(column) for column in zip(*chunks))
+            order = np.argsort(ids, kind="stable")
+            cache.ids, cache.amounts, cache.days, cache.codes = ids[order], amounts[order], days[order], codes[order]
+            cache.size = len(cache.ids)
+        cache.ready = True
+        return cache
+
+    def install(self, loaded):
+        # Takes over the arrays of a freshly loaded cache, then replays the
+        # changes that happened while it was loading
+        with self.lock:
+            self.ids, self.amounts, self.days, self.codes = loaded.ids, loaded.amounts, loaded.days, loaded.codes
+            self.size = loaded.size
+            self.categories, self.category_codes = loaded.categories, loaded.category_codes
+            self.ready = True
+            self.loading = False
+            pending, self.pending = self.pending, []
+        for change in pending:
+            change()
+
+    def invalidate(self):
+        # Called as a load starts
+        with self.lock:
+            self.ready = False
+            self.loading = True
+
+    def category_code(self, category):
+        code = self.category_codes.get(category)
+        if code is None:
+            code = self.category_codes[category] = len(self.categories)
+            self.categories.append(category)
+        return code
+
+    def _position(self, expense_id):
+        position = int(np.searchsorted(self.ids[:self.size], expense_id))
+        if position < self.size and self.ids[position] == expense_id:
+            return position
+        return None
+
+    def add(self, expense_id, amount, category, date):
+        with self.lock:
+            if not self.ready:
+                if self.loading:
+                    self.pending.append(lambda: self.add(expense_id, amount, category, date))
+                return
+            if self._position(expense_id) is not None:
+                return
+            if self.size == len(self.ids):
+                # Grow geometrically so a run of adds stays amortised O(1)
+                capacity = max(16, 2 * len(self.ids))
+                for name in ("ids", "amounts", "days", "codes"):
+                    column = getattr(self, name)
+                    grown = np.empty(capacity, dtype=column.dtype)
+                    grown[:self.size] = column[:self.size]
+                    setattr(self, name, grown)
+            # New ids come from SQLite's rowid, so they almost always go at the end
+            position = int(np.searchsorted(self.ids[:self.size], expense_id))
+            for column, value in ((self.ids, expense_id), (self.amounts, amount),
+                                  (self.days, day_number(date)), (self.codes, self.category_code(category))):
+                column[position + 1:self.size + 1] = column[position:self.size]
+                column[position] = value
+            self.size += 1
+
+    def update(self, expense_id, amount, category, date):
+        with self.lock:
+            if not self.ready:
+                if self.loading:
+                    self.pending.append(lambda: self.update(expense_id, amount, category, date))
+                return
+            position = self._position(expense_id)
+            if position is None:
+                return
+            self.amounts[position] = amount
+            self.days[position] = day_number(date)
+            self.codes[position] = self.category_code(category)
+
+    def delete(self, expense_id):
+        with self.lock:
+            if not self.ready:
+                if self.loading:
+                    self.pending.append(lambda: self.delete(expense_id))
+                return
+            position = self._position(expense_id)
+            if position is None:
+                return
+            for column in (self.ids, self.amounts, self.days, self.codes):
+                column[position:self.size - 1] = column[position + 1:self.size]
+            self.size -= 1
+
+    def total(self):
+        with self.lock:
+            return int(self.amounts[:self.size].sum())
+
+    def category_breakdown(self):
+        # (category, total) pairs in category order, like ExpenseRepository.category_breakdown.
+        # np.add.at rather than bincount, whose weights are summed as float64.
+        with self.lock:
+            codes = self.codes[:self.size]
+            totals = np.zeros(len(self.categories), dtype=np.int64)
+            np.add.at(totals, codes, self.amounts[:self.size])
+            counts = np.bincount(codes, minlength=len(self.categories))
+            categories = list(self.categories)
+        return sorted((categories[code], int(totals[code])) for code in np.flatnonzero(counts))
+
+    def range_total(self, start, end):
+        # Sum of expenses dated start <= date < end, both yyyy-mm-dd strings
+        with self.lock:
+            days = self.days[:self.size]
+            mask = (days >= day_number(start)) & (days < day_number(end))
+            return int(self.amounts[:self.size][mask].sum())
+
+    def filtered_total(self, month=None, year=None):
+        # Total for the same month/year choices as the Expense Records filter
+        if year is not None:
+            start_month, end_month = (month, month + 1) if month is not None else (1, 13)
+            start = f"{int(year):04d}-{start_month:02d}-01"
+            end = f"{int(year) + (end_month - 1) // 12:04d}-{(end_month - 1) % 12 + 1:02d}-01"
+            return self.range_total(start, end)
+        if month is None:
+            return self.total()
+        with self.lock:
+            months = self.days[:self.size].astype("datetime64[D]").astype("datetime64[M]").astype(np.int64) % 12 + 1
+            return int(self.amounts[:self.size][months == month].sum())
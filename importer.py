@@ -0,0 +1,291 @@
+import argparse
+import csv
+import itertools
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from functools import lru_cache
+
+import db
+
+# Header names accepted for each expense field, compared case-insensitively.
+# Bank exports rarely agree on these, so the common spellings are listed here
+# and anything else can be given explicitly with --map.
+COLUMN_ALIASES = {
+    "amount": ["amount", "debit", "value", "amount ($)", "amount(usd)"],
+    "description": ["description", "memo", "payee", "details", "narrative", "name"],
+    "category": ["category", "type"],
+    "date": ["date", "transaction date", "posted date", "posting date", "booking date"],
+}
+DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y", "%Y/%m/%d", "%d.%m.%Y", "%d-%m-%Y"]
+# Unless it is given, the date format is the one that reads the most of the
+# first rows' dates; every row of the file is then read with it
+DATE_SAMPLE_ROWS = 1000
+DEFAULT_CATEGORY = "Other"
+BATCH_SIZE = 50000
+# Statements disagree on whether spending is negative or positive, so unless it
+# is given the sign most of the first rows carry is taken to mean spending
+SIGN_SAMPLE_ROWS = 1000
+SPENDING_SIGNS = ("negative", "positive")
+IMPORT_CACHE_SIZE = -200000  # about 200 MB of page cache while importing
+
+
+class StatementError(Exception):
+    pass
+
+
+class AmbiguousDatesError(StatementError):
+    # The sampled dates read equally well in several formats, e.g. 05/03/2023
+    # as MM/DD and as DD/MM; formats lists them, for the caller to pick one
+    def __init__(self, formats):
+        choices = " or ".join(f"{format_label(fmt)} (--date-format {fmt})" for fmt in formats)
+        super().__init__(f"The dates could be {choices}.")
+        self.formats = formats
+
+
+def format_label(date_format):
+    # "%d/%m/%Y" -> "DD/MM/YYYY"
+    return date_format.replace("%d", "DD").replace("%m", "MM").replace("%Y", "YYYY")
+
+
+def find_columns(header, mapping=None):
+    # Works out the index of the CSV column that feeds each expense field
+    mapping = dict(mapping or {})
+    lowered = {name.strip().lower(): index for index, name in enumerate(header)}
+    columns = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        if field in mapping:
+            if mapping[field] not in header:
+                raise StatementError(f"Column '{mapping[field]}' for {field} is not in the file.")
+            columns[field] = header.index(mapping[field])
+            continue
+        for alias in aliases:
+            if alias in lowered:
+                columns[field] = lowered[alias]
+                break
+    missing = [field for field in ("amount", "date") if field not in columns]
+    if missing:
+        raise StatementError(f"Could not find a column for: {', '.join(missing)}. Use --map field=column.")
+    return columns
+
+
+def parse_amount(text):
+    # Returns signed integer cents; accounting-style (12.50) is negative
+    text = text.strip().replace("$", "").replace(",", "")
+    if text.startswith("(") and text.endswith(")"):
+        return -db.to_cents(text[1:-1])
+    return db.to_cents(text)
+
+
+# Statements repeat the same few thousand dates, so strptime runs once per distinct value
+@lru_cache(maxsize=65536)
+def parse_date(text, date_format):
+    text = text.strip()
+    try:
+        return datetime.strptime(text, date_format).strftime('%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"unrecognised date '{text}'") from None
+
+
+def detect_date_format(values):
+    # The one format of DATE_FORMATS that reads the most of values. A file
+    # gets a single format, never one per value, as 05/03/2023 would
+    # otherwise be read as May 3 and 13/03/2023 as March 13.
+    values = [value for value in values if value]
+    counts = {}
+    for fmt in DATE_FORMATS:
+        for value in values:
+            try:
+                parse_date(value, fmt)
+            except ValueError:
+                continue
+            counts[fmt] = counts.get(fmt, 0) + 1
+    if not counts:
+        example = f" such as '{values[0]}'" if values else ""
+        raise StatementError(f"Could not recognise the dates{example}. Use --date-format.")
+    best = max(counts.values())
+    formats = [fmt for fmt, count in counts.items() if count == best]
+    if len(formats) > 1:
+        raise AmbiguousDatesError(formats)
+    return formats[0]
+
+
+def _cell(row, column):
+    if column is None or column >= len(row):
+        return ""
+    return row[column].strip()
+
+
+def read_rows(lines, mapping=None, date_format=None, errors=None, spending=None):
+    # Streams (amount, description, category, date) tuples from CSV lines, with
+    # amounts as positive cents. spending is "negative" or "positive", the sign
+    # the statement uses for money going out; None works it out from the first
+    # SIGN_SAMPLE_ROWS rows. Rows with the other sign are credits (salary,
+    # refunds) and are skipped, not stored as expenses. Skipped and invalid
+    # rows are recorded, when given a list, in errors as (line number, message).
+    if spending is not None and spending not in SPENDING_SIGNS:
+        raise ValueError(f"spending must be one of {SPENDING_SIGNS}")
+    rows = _parse_rows(lines, mapping, date_format, errors)
+    sample = []
+    if spending is None:
+        for row in rows:
+            sample.append(row)
+            if len(sample) >= SIGN_SAMPLE_ROWS:
+                break
+        negative = sum(1 for row in sample if row[1] < 0)
+        positive = sum(1 for row in sample if row[1] > 0)
+        spending = "positive" if positive > negative else "negative"
+    sign = 1 if spending == "positive" else -1
+    for rows_part in (sample, rows):
+        for line, amount, description, category, date in rows_part:
+            if amount * sign < 0:
+                if errors is not None:
+                    errors.append((line, f"credit of {db.format_cents(abs(amount))} skipped"))
+                continue
+            yield amount * sign, description, category, date
+
+
+def _parse_rows(lines, mapping, date_format, errors):
+    # (line number, signed cents, description, category, date) per valid row
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = find_columns(header, mapping)
+    amount_column, date_column = columns["amount"], columns["date"]
+    description_column = columns.get("description")
+    category_column = columns.get("category")
+    # line_num is read as each row comes, as quoted fields can span lines
+    rows = ((reader.line_num, row) for row in reader)
+    if date_format is None:
+        sample = list(itertools.islice(rows, DATE_SAMPLE_ROWS))
+        date_format = detect_date_format([_cell(row, date_column) for line, row in sample])
+        rows = itertools.chain(sample, rows)
+    for line, row in rows:
+        if not row:
+            continue
+        try:
+            amount = parse_amount(row[amount_column])
+            date = parse_date(row[date_column], date_format)
+        except (ValueError, IndexError) as error:
+            if errors is not None:
+                errors.append((line, str(error)))
+            continue
+        description = _cell(row, description_column)
+        category = _cell(row, category_column) or DEFAULT_CATEGORY
+        yield line, amount, description, category, date
+
+
+def import_expenses(user_id, rows, batch_size=BATCH_SIZE, progress=None):
+    # Inserts rows with executemany, committing once per batch. progress, if
+    # given, is called after each batch with (rows imported, rows per second).
+    conn = db.get_connection()
+    started = time.perf_counter()
+    imported = 0
+    batch = []
+
+    def flush():
+        nonlocal imported
+        # Date order keeps the index and daily_totals writes on neighbouring pages
+        batch.sort(key=lambda row: row[4])
+        # The summary and search triggers are dropped for the batch, and its rows
+        # added to the totals and the index with a few set-based statements
+        # afterwards, all in one transaction so other connections never see the
+        # triggers missing
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM expenses").fetchone()[0]
+            for trigger in db.AGGREGATE_TRIGGERS + db.SEARCH_TRIGGERS:
+                conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            conn.executemany("INSERT INTO expenses (user_id, amount, description, category, date) "
+                             "VALUES (?, ?, ?, ?, ?)", batch)
+            db.add_aggregates_after(conn.cursor(), last_id)
+            db.index_expenses_after(conn.cursor(), last_id)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        imported += len(batch)
+        batch.clear()
+        if progress:
+            progress(imported, imported / max(time.perf_counter() - started, 1e-9))
+
+    cache_size = conn.execute("PRAGMA cache_size").fetchone()[0]
+    conn.execute(f"PRAGMA cache_size={IMPORT_CACHE_SIZE}")
+    try:
+        for amount, description, category, date in rows:
+            batch.append((user_id, amount, description, category, date))
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    finally:
+        conn.execute(f"PRAGMA cache_size={cache_size}")
+    # A large import changes which index serves a filter best
+    db.analyze(conn)
+    return imported, time.perf_counter() - started
+
+
+def import_file(path, user_id, mapping=None, date_format=None, batch_size=BATCH_SIZE, progress=None,
+                spending=None):
+    # Returns (rows imported, skipped rows as (line, message), seconds taken)
+    errors = []
+    with open(path, newline='', encoding='utf-8-sig') as csv_file:
+        rows = read_rows(csv_file, mapping, date_format, errors, spending)
+        imported, seconds = import_expenses(user_id, rows, batch_size, progress)
+    # Credits in the sampled rows are reported after parse errors further on
+    errors.sort()
+    return imported, errors, seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import expenses from a bank or CSV statement.")
+    parser.add_argument("csv_file", help="CSV file with a header row")
+    parser.add_argument("--user", required=True, help="username that owns the imported expenses")
+    parser.add_argument("--map", action="append", default=[], metavar="FIELD=COLUMN",
+                        help="use COLUMN for FIELD (amount, description, category or date)")
+    parser.add_argument("--date-format", help="strptime format of the date column, e.g. %%d/%%m/%%Y")
+    parser.add_argument("--spending", choices=SPENDING_SIGNS,
+                        help="sign of money going out in this statement; rows with the other sign are "
+                             "credits and are skipped (default: the sign most of the first rows have)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows per transaction")
+    parser.add_argument("--db", default=db.DB_NAME, help="database file (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    db.use_database(args.db)
+    user_id = db.find_user_id(args.user)
+    if user_id is None:
+        print(f"No user named '{args.user}'.")
+        return 1
+
+    mapping = {}
+    for item in args.map:
+        field, _, column = item.partition("=")
+        if field not in COLUMN_ALIASES or not column:
+            parser.error(f"invalid --map value '{item}'")
+        mapping[field] = column
+
+    def progress(imported, rate):
+        print(f"\r{imported:,} rows imported ({rate:,.0f} rows/s)", end="", flush=True)
+
+    try:
+        imported, errors, seconds = import_file(args.csv_file, user_id, mapping, args.date_format,
+                                                args.batch_size, progress, args.spending)
+    except StatementError as error:
+        print(error)
+        return 1
+    except (csv.Error, OSError, UnicodeDecodeError, sqlite3.Error) as error:
+        # Batches before the failing one are already committed
+        print(f"\nImport stopped: {error}")
+        return 1
+    print(f"\nImported {imported:,} rows in {seconds:.2f}s ({imported / max(seconds, 1e-9):,.0f} rows/s).")
+    if errors:
+        print(f"Skipped {len(errors):,} rows (credits or invalid), first few:")
+        for line, message in errors[:10]:
+            print(f"    line {line}: {message}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+import argparse
+import atexit
+import collections
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import db
+
+# Instrumentation is off unless this environment variable is set, either to
+# the log file to write or to 1 for DEFAULT_LOG:
+#
+#     EXPENSE_METRICS=1 python login.py
+METRICS_ENV = "EXPENSE_METRICS"
+DEFAULT_LOG = "metrics.jsonl"
+MAX_LOG_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+# Statements slower than this are logged again with their EXPLAIN QUERY PLAN
+SLOW_QUERY_MS = 50.0
+# The Tk heartbeat runs every HEARTBEAT_MS; arriving STALL_MS late is a stall
+HEARTBEAT_MS = 50
+STALL_MS = 150
+# Recent durations kept per metric for the summary written at exit
+SAMPLE_LIMIT = 10000
+
+_logger = logging.getLogger("expense_tracker.metrics")
+_logger.propagate = False
+_samples = {}
+_lock = threading.Lock()
+_enabled = False
+_slow_query_ms = SLOW_QUERY_MS
+
+
+def enabled():
+    return _enabled
+
+
+def enable(path=DEFAULT_LOG, slow_query_ms=SLOW_QUERY_MS):
+    # Starts writing metrics to a rotating JSON-lines file. Connections opened
+    # from now on are timed, so the open ones are closed and reopened lazily.
+    global _enabled, _slow_query_ms
+    if _enabled:
+        return
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=MAX_LOG_BYTES, backupCount=LOG_BACKUPS,
+                                                   encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    _logger.addHandler(handler)
+    _logger.setLevel(logging.INFO)
+    _slow_query_ms = slow_query_ms
+    db.connection_factory = TimedConnection
+    db.close_all_connections()
+    atexit.register(write_summary)
+    _enabled = True
+
+
+def enable_from_environment():
+    value = os.environ.get(METRICS_ENV)
+    if value:
+        enable(DEFAULT_LOG if value == "1" else value)
+
+
+def record(kind, name, ms, **fields):
+    if not _enabled:
+        return
+    entry = {"ts": round(time.time(), 3), "kind": kind, "name": name, "ms": round(ms, 3)}
+    entry.update(fields)
+    _logger.info(json.dumps(entry))
+    with _lock:
+        samples = _samples.setdefault((kind, name), collections.deque(maxlen=SAMPLE_LIMIT))
+        samples.append(ms)
+
+
+def percentile(ordered, fraction):
+    # Nearest-rank percentile of an already sorted list
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(durations):
+    ordered = sorted(durations)
+    return {"count": len(ordered), "p50": round(percentile(ordered, 0.50), 3),
+            "p95": round(percentile(ordered, 0.95), 3), "p99": round(percentile(ordered, 0.99), 3),
+            "max": round(ordered[-1], 3)}
+
+
+def write_summary():
+    # One summary line per metric for this run, written at exit
+    with _lock:
+        samples = {key: list(values) for key, values in _samples.items()}
+    for (kind, name), durations in sorted(samples.items()):
+        entry = {"ts": round(time.time(), 3), "kind": "summary", "of": kind, "name": name}
+        entry.update(summarize(durations))
+        _logger.info(json.dumps(entry))
+
+
+def _explain(connection, sql, parameters):
+    words = sql.split(None, 1)
+    if not words or words[0].upper() not in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE"):
+        return None
+    try:
+        # A plain cursor, so the EXPLAIN itself is not timed
+        cursor = sqlite3.Cursor(connection)
+        return [row[3] for row in cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+    except sqlite3.Error:
+        return None
+
+
+class TimedCursor(sqlite3.Cursor):
+    # Times each statement from execute() until its rows run out, so the steps
+    # SQLite does lazily while rows are fetched count towards the query that
+    # caused them. Statements without rows are recorded as soon as they finish.
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self._pending = None
+
+    def _start(self, sql, parameters, run):
+        # parameters is called only if the statement turns out to be slow
+        self._finish()
+        statements = self.connection.statements
+        started = time.perf_counter()
+        run()
+        self._pending = [sql, parameters, time.perf_counter() - started, statements]
+        if self.description is None:
+            self._finish()
+        return self
+
+    def _add(self, started):
+        if self._pending is not None:
+            self._pending[2] += time.perf_counter() - started
+
+    def _finish(self):
+        if getattr(self, "_pending", None) is None:
+            return
+        sql, parameters, seconds, statements = self._pending
+        self._pending = None
+        name = " ".join(sql.split())
+        ms = seconds * 1000
+        # Statements seen by the trace callback, including those run by triggers
+        record("sql", name, ms, statements=self.connection.statements - statements)
+        if ms >= _slow_query_ms:
+            record("slow_query", name, ms, plan=_explain(self.connection, sql, parameters()))
+
+    def execute(self, sql, parameters=()):
+        return self._start(sql, lambda: parameters, lambda: super(TimedCursor, self).execute(sql, parameters))
+
+    def executemany(self, sql, seq_of_parameters):
+        # Keep the first row of parameters for the EXPLAIN of a slow statement
+        first = []
+
+        def rows():
+            for parameters in seq_of_parameters:
+                if not first:
+                    first.append(parameters)
+                yield parameters
+
+        return self._start(sql, lambda: first[0] if first else (),
+                           lambda: super(TimedCursor, self).executemany(sql, rows()))
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._add(started)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._add(started)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._add(started)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._add(started)
+            self._finish()
+            raise
+        self._add(started)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # Cursors dropped after a single fetchone() still get recorded
+        self._finish()
+
+
+class TimedConnection(sqlite3.Connection):
+    # Connection.execute() does not go through cursor(), so both shortcuts are
+    # routed through a TimedCursor here
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = 0
+        self.set_trace_callback(self._trace)
+
+    def _trace(self, statement):
+        self.statements += 1
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def timed_screen(method):
+    # Records how long a screen takes from the click until it is drawn: until
+    # the database jobs it started (and those their callbacks started) have
+    # been delivered and Tk has finished the resulting geometry and redraw
+    # work. Unrelated jobs still running, such as an import, are not waited on.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not _enabled:
+            return method(self, *args, **kwargs)
+        started = time.perf_counter()
+        with self.worker.tracking() as jobs:
+            result = method(self, *args, **kwargs)
+
+        def rendered():
+            if jobs:
+                self.after(5, rendered)
+                return
+            self.update_idletasks()
+            record("screen", method.__name__, (time.perf_counter() - started) * 1000)
+
+        self.after_idle(rendered)
+        return result
+    return wrapper
+
+
+def watch_event_loop(widget):
+    # Schedules a heartbeat on the Tk event loop and records a stall whenever
+    # it runs STALL_MS or more behind, i.e. the loop was blocked that long
+    if not _enabled:
+        return
+    expected = time.perf_counter() + HEARTBEAT_MS / 1000
+
+    def beat():
+        nonlocal expected
+        now = time.perf_counter()
+        late = (now - expected) * 1000
+        if late >= STALL_MS:
+            record("stall", widget.title(), late)
+        expected = now + HEARTBEAT_MS / 1000
+        widget.after(HEARTBEAT_MS, beat)
+
+    widget.after(HEARTBEAT_MS, beat)
+
+
+def read_log(path):
+    # Entries from the log and its rotated backups, oldest first
+    paths = [f"{path}.{n}" for n in range(LOG_BACKUPS, 0, -1)] + [path]
+    for name in paths:
+        if not os.path.exists(name):
+            continue
+        with open(name, encoding="utf-8") as log_file:
+            for line in log_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarise the metrics log written with EXPENSE_METRICS set.")
+    parser.add_argument("--log", default=DEFAULT_LOG, help="metrics file (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    summary = commands.add_parser("summary", help="p50/p95/p99 per statement, screen and stall")
+    summary.add_argument("--kind", choices=["sql", "screen", "stall", "slow_query"])
+    slow = commands.add_parser("slow", help="the slowest logged statements with their query plans")
+    slow.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    entries = [entry for entry in read_log(args.log) if entry.get("kind") != "summary"]
+    if not entries:
+        print(f"No metrics in {args.log}.")
+        return 1
+
+    if args.command == "summary":
+        durations = {}
+        for entry in entries:
+            if args.kind is None or entry["kind"] == args.kind:
+                durations.setdefault((entry["kind"], entry["name"]), []).append(entry["ms"])
+        print(f"{'kind':<10} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}  name")
+        for (kind, name), values in sorted(durations.items(), key=lambda item: -sorted(item[1])[-1]):
+            stats = summarize(values)
+            print(f"{kind:<10} {stats['count']:>7} {stats['p50']:>9.2f} {stats['p95']:>9.2f} "
+                  f"{stats['p99']:>9.2f} {stats['max']:>9.2f}  {name[:80]}")
+        return 0
+
+    if args.command == "slow":
+        slowest = sorted((entry for entry in entries if entry["kind"] == "slow_query"), key=lambda entry: -entry["ms"])
+        for entry in slowest[:args.limit]:
+            print(f"{entry['ms']:.1f} ms  {entry['name']}")
+            for step in entry.get("plan") or []:
+                print(f"    {step}")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,26 @@
+import argparse
 from tkinter import messagebox
 from customtkinter import CTk, CTkLabel, CTkEntry, CTkButton, CTkFrame
 import db
-from track_main import ExpenseTrackerClass
+import instrumentation
+import remote
+from db_worker import DatabaseWorker
+from repository import ExpenseRepository
+from session import Session
 
 class LoginRegisterClass(CTk):
-    def __init__(self):
+    def __init__(self, server=None):
         super().__init__()
         self.title("MyMoney")
         self.geometry("600x450")
         self.current_user_id = None
+        self.repository = None
+        self.session = None
+        # With a server URL every operation goes through server.py instead of the database file
+        self.client = remote.Client(server) if server else None
         self.create_widgets()
+        self.worker = DatabaseWorker(self, on_busy=self.show_busy)
+        instrumentation.watch_event_loop(self)
 
     def create_widgets(self):
         self.label = CTkLabel(self, text="Welcome to Expense Tracker", font=("Helvetica", 20, "bold"))
@@ -37,53 +48,91 @@ class LoginRegisterClass(CTk):
         self.register_button = CTkButton(self, text="Register", command=self.register_user, font=("Helvetica", 14), height=32, width=100)
         self.register_button.pack()
 
+        self.status_label = CTkLabel(self, text="", font=("Helvetica", 12))
+        self.status_label.pack(pady=5)
+
+    def show_busy(self, busy):
+        state = "disabled" if busy else "normal"
+        self.login_button.configure(state=state)
+        self.register_button.configure(state=state)
+        self.status_label.configure(text="Please wait..." if busy else "")
+
     def register_user(self):
         username = self.username_entry.get()
         password = self.password_entry.get()
 
         if username and password:
-            conn, cursor = db.connect_to_database()
-            cursor.execute("SELECT * FROM users WHERE username=?", (username,))
-            existing_user = cursor.fetchone()
-
-            if existing_user:
-                messagebox.showwarning("Warning", "Username already exists. Please choose a different username.")
-            else:
-                cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
-                conn.commit()
-                messagebox.showinfo("Success", "Registration successful!")
-                self.username_entry.delete(0, 'end')
-                self.password_entry.delete(0, 'end')
+            self.worker.submit(self.register, username, password, callback=self.on_registered)
         else:
             messagebox.showwarning("Warning", "Please enter both username and password.")
 
+    def register(self, username, password):
+        # Runs on the database worker thread
+        if self.client is None:
+            return db.register_user(username, password)
+        try:
+            return self.client.register_user(username, password)
+        except remote.RemoteError as error:
+            return error
+
+    def on_registered(self, registered):
+        if isinstance(registered, Exception):
+            messagebox.showerror("Error", str(registered))
+        elif not registered:
+            messagebox.showwarning("Warning", "Username already exists. Please choose a different username.")
+        else:
+            messagebox.showinfo("Success", "Registration successful!")
+            self.username_entry.delete(0, 'end')
+            self.password_entry.delete(0, 'end')
+
     def login_user(self):
         username = self.username_entry.get()
         password = self.password_entry.get()
         if username and password:
-            conn, cursor = db.connect_to_database()
-            cursor.execute("SELECT * FROM users WHERE username=? AND password=?", (username, password))
-            user = cursor.fetchone()
-            if user:
-                self.current_user_id = user[0]
-                self.load_expenses()  # Load expenses for the current user
-                self.create_expense_tracker()
-            else:
-                messagebox.showerror("Error", "Invalid username or password.")
+            self.worker.submit(self.log_in, username, password, callback=self.on_login, key="login")
         else:
             messagebox.showwarning("Warning", "Please enter both username and password.")
 
-    def load_expenses(self):
-        conn, cursor = db.connect_to_database()
-        cursor.execute("SELECT amount, description, category, date FROM expenses WHERE user_id=?", (self.current_user_id,))
-        self.expenses = cursor.fetchall()
-        conn.close()
+    def log_in(self, username, password):
+        # Runs on the database worker thread; returns the user's repository, or
+        # None for a wrong username or password
+        if self.client is None:
+            user = db.authenticate(username, password)
+            return ExpenseRepository(user[0]) if user else None
+        try:
+            return self.client.login(username, password)
+        except remote.RemoteError as error:
+            return error
+
+    def on_login(self, repository):
+        if isinstance(repository, Exception):
+            messagebox.showerror("Error", str(repository))
+        elif repository:
+            import track_main
+            track_main.warm_up_imports()  # Load the chart libraries while the tracker window opens
+            self.current_user_id = repository.user_id
+            self.repository = repository
+            # The first screens' queries and the cache load start now, while
+            # the tracker window is built. The cache reads the database file,
+            # so there is none to load against a server.
+            self.session = Session(repository, load_cache=isinstance(repository, ExpenseRepository)).start()
+            # Open the tracker once this result callback has returned
+            self.after_idle(self.create_expense_tracker)
+        else:
+            messagebox.showerror("Error", "Invalid username or password.")
 
     def create_expense_tracker(self):
+        from track_main import ExpenseTrackerClass
+
         self.withdraw()  # Hide login window
-        expense_tracker = ExpenseTrackerClass(current_user_id=self.current_user_id)
+        expense_tracker = ExpenseTrackerClass(current_user_id=self.current_user_id, repository=self.repository,
+                                              session=self.session)
         expense_tracker.mainloop()
 
 if __name__ == "__main__":
-    app = LoginRegisterClass()
+    parser = argparse.ArgumentParser(description="Expense Tracker")
+    parser.add_argument("--server", help="URL of a server.py to use instead of the local database file")
+    args = parser.parse_args()
+    instrumentation.enable_from_environment()
+    app = LoginRegisterClass(args.server)
     app.mainloop()
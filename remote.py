@@ -0,0 +1,184 @@
+import http.client
+import json
+import threading
+from urllib.parse import urlencode, urlsplit
+
+from repository import PAGE_SIZE
+
+
+class RemoteError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Client:
+    # Talks to server.py, keeping one HTTP connection open per thread so the
+    # Tk thread and the database worker never share one
+    def __init__(self, url, timeout=10):
+        parts = urlsplit(url if "//" in url else "http://" + url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, query=None, token=None):
+        if query:
+            path += "?" + urlencode({name: value for name, value in query.items() if value is not None})
+        headers = {"Content-Type": "application/json"}
+        if token is not None:
+            headers["Authorization"] = f"Bearer {token}"
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+            response = conn.getresponse()
+            payload = json.loads(response.read() or b"{}")
+        except (OSError, http.client.HTTPException, ValueError) as error:
+            conn.close()
+            self._local.conn = None
+            raise RemoteError(None, f"server unavailable: {error}") from None
+        if response.status >= 400:
+            raise RemoteError(response.status, payload.get("error", response.reason))
+        return payload
+
+    def register_user(self, username, password):
+        # Returns False when the username is already taken, like db.register_user
+        return self.request("POST", "/register", {"username": username, "password": password})["registered"]
+
+    def login(self, username, password):
+        # The user's RemoteRepository, or None for a wrong username or password
+        try:
+            session = self.request("POST", "/login", {"username": username, "password": password})
+        except RemoteError as error:
+            if error.status == 401:
+                return None
+            raise
+        return RemoteRepository(self, session["user_id"], session["token"])
+
+
+def _rows(rows):
+    return [tuple(row) for row in rows]
+
+
+class RemoteRepository:
+    # ExpenseRepository's methods and results, answered by server.py
+    def __init__(self, client, user_id, token):
+        self.client = client
+        self.user_id = user_id
+        self.token = token
+
+    def _call(self, method, path, body=None, **query):
+        return self.client.request(method, path, body, query, self.token)
+
+    def _after(self, after):
+        return json.dumps(list(after)) if after is not None else None
+
+    def add(self, amount, description, category, date):
+        return self._call("POST", "/expenses", {"amount": amount, "description": description,
+                                                "category": category, "date": date})["id"]
+
+    def update(self, expense_id, amount, description, category, date):
+        try:
+            self._call("PUT", f"/expenses/{expense_id}", {"amount": amount, "description": description,
+                                                          "category": category, "date": date})
+        except RemoteError as error:
+            if error.status == 404:
+                return False
+            raise
+        return True
+
+    def delete(self, expense_id):
+        try:
+            self._call("DELETE", f"/expenses/{expense_id}")
+        except RemoteError as error:
+            if error.status == 404:
+                return False
+            raise
+        return True
+
+    def list_expenses(self, month=None, year=None, after=None, limit=PAGE_SIZE):
+        return _rows(self._call("GET", "/expenses", month=month, year=year, after=self._after(after),
+                                limit=limit)["rows"])
+
+    def list_filtered(self, expense_filter, sort="date", descending=False, after=None, limit=PAGE_SIZE):
+        return _rows(self._call("GET", "/expenses", filter=json.dumps(expense_filter.to_dict()), sort=sort,
+                                descending=int(descending), after=self._after(after), limit=limit)["rows"])
+
+    def filtered_total(self, expense_filter):
+        return self._call("GET", "/total", filter=json.dumps(expense_filter.to_dict()))["total"]
+
+    def search_available(self):
+        return self._call("GET", "/search")["available"]
+
+    def list_matching(self, text, month=None, year=None, after=None, limit=PAGE_SIZE):
+        return _rows(self._call("GET", "/search", q=text, month=month, year=year, after=self._after(after),
+                                limit=limit)["rows"])
+
+    def total(self, month=None, year=None, search=None):
+        return self._call("GET", "/total", month=month, year=year, search=search)["total"]
+
+    def category_breakdown(self, month=None, year=None):
+        return _rows(self._call("GET", "/categories", month=month, year=year)["rows"])
+
+    def daily_series(self, above=None, month=None, year=None):
+        return _rows(self._call("GET", "/daily", above=above, month=month, year=year)["rows"])
+
+    def budget_targets(self):
+        return _rows(self._call("GET", "/budget")["rows"])
+
+    def budget_target(self, time_period="daily", category=None):
+        for period, target_category, target_amount in self.budget_targets():
+            if period == time_period and target_category == category:
+                return target_amount
+        return None
+
+    def set_budget_target(self, target_amount, time_period="daily", category=None):
+        return self._call("PUT", "/budget", {"target_amount": target_amount, "time_period": time_period,
+                                             "category": category})["replaced"]
+
+    def delete_budget_target(self, time_period, category=None):
+        try:
+            self._call("DELETE", "/budget", time_period=time_period, category=category)
+        except RemoteError as error:
+            if error.status == 404:
+                return False
+            raise
+        return True
+
+    def budget_check(self, date, category):
+        return _rows(self._call("GET", "/budget/check", date=date, category=category)["rows"])
+
+    def budget_exceedances(self):
+        return [(time_period, category, target_amount, _rows(periods))
+                for time_period, category, target_amount, periods in
+                self._call("GET", "/budget/exceedances")["targets"]]
+
+    def recurring_expenses(self):
+        return _rows(self._call("GET", "/recurring")["rows"])
+
+    def add_recurring(self, amount, description, category, start_date, unit="month", every=1, end_date=None):
+        try:
+            return self._call("POST", "/recurring", {"amount": amount, "description": description,
+                                                     "category": category, "start_date": start_date, "unit": unit,
+                                                     "every": every, "end_date": end_date})["id"]
+        except RemoteError as error:
+            if error.status == 400:
+                raise ValueError(str(error)) from None
+            raise
+
+    def delete_recurring(self, rule_id):
+        try:
+            self._call("DELETE", f"/recurring/{rule_id}")
+        except RemoteError as error:
+            if error.status == 404:
+                return False
+            raise
+        return True
+
+    def catch_up_recurring(self):
+        return self._call("POST", "/recurring/catch-up")["added"]
+
+    def forecast_recurring(self, until, start=None):
+        return _rows(self._call("GET", "/recurring/forecast", until=until, start=start)["rows"])
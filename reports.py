@@ -0,0 +1,165 @@
+# Monthly statements without a display: for each user and month, the Expense
+# Analysis pie and the Expense Flow line of charts.py rendered on matplotlib's
+# Agg canvas to PNG or PDF files. Jobs fan out across a process pool, each
+# worker with its own read-only connection. A report whose data is the same
+# as at the last run, per the manifest kept next to the reports, is skipped.
+#
+#     python reports.py reports/ --month 2024-05 --workers 8
+#     python reports.py reports/ --user alice --format pdf --per user
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+import charts
+import db
+from repository import ExpenseRepository
+
+# Fingerprint of each report's data as of the last run, in the output directory
+MANIFEST = "manifest.json"
+FORMATS = ("png", "pdf")
+# Each worker process keeps one chart of each kind and reuses it for every report
+_charts = None
+
+
+def report_paths(output, username, month, fmt):
+    # The category and daily flow files of one user's month
+    folder = os.path.join(output, re.sub(r"[^\w.-]", "_", username))
+    return (os.path.join(folder, f"{month}-categories.{fmt}"),
+            os.path.join(folder, f"{month}-daily.{fmt}"))
+
+
+def report_key(username, month, fmt):
+    return f"{username}/{month}.{fmt}"
+
+
+def list_reports(usernames=None, months=None):
+    # (user_id, username, yyyy-mm) for every month a user has expenses in,
+    # archived years included, optionally only the given users and months.
+    # daily_totals has a row per user and day, so this never reads expenses.
+    rows = db.get_connection().execute(
+        "SELECT DISTINCT d.user_id, u.username, substr(d.date, 1, 7) FROM daily_totals d "
+        "JOIN users u ON u.id = d.user_id ORDER BY d.user_id, 3").fetchall()
+    return [row for row in rows
+            if (not usernames or row[1] in usernames) and (not months or row[2] in months)]
+
+
+def _start_worker(path):
+    db.use_database(path, read_only=True)
+
+
+def render_reports(reports, output, fmt, previous, force=False):
+    # Runs in a worker process. Renders (user_id, username, month) reports and
+    # returns (key, fingerprint, rendered) for each; previous holds the
+    # fingerprints of the last run, and a report that matches one and whose
+    # files are still there is not drawn again.
+    global _charts
+    results = []
+    for user_id, username, month in reports:
+        year, number = (int(part) for part in month.split("-"))
+        repository = ExpenseRepository(user_id)
+        categories = repository.category_breakdown(number, year)
+        daily = repository.daily_series(month=number, year=year)
+        key = report_key(username, month, fmt)
+        fingerprint = hashlib.sha1(json.dumps([categories, daily]).encode()).hexdigest()
+        paths = report_paths(output, username, month, fmt)
+        if not force and previous.get(key) == fingerprint and all(os.path.exists(path) for path in paths):
+            results.append((key, fingerprint, False))
+            continue
+        if _charts is None:
+            _charts = charts.CategoryPieChart(offscreen=True), charts.DailyFlowChart(offscreen=True)
+        pie, flow = _charts
+        os.makedirs(os.path.dirname(paths[0]), exist_ok=True)
+        # Refunds can leave a category below zero, which a pie cannot show
+        pie.update({category: total for category, total in categories if total > 0})
+        pie.figure.suptitle(f"{username}, {month}")
+        pie.save(paths[0])
+        flow.update([date for date, total in daily], [total / 100 for date, total in daily])
+        flow.figure.suptitle(f"{username}, {month}")
+        flow.save(paths[1])
+        results.append((key, fingerprint, True))
+    return results
+
+
+def read_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST), encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(output, manifest):
+    # Written aside and renamed, so an interrupted run leaves the old manifest whole
+    path = os.path.join(output, MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=0, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def generate(path, output, usernames=None, months=None, fmt="png", per="month", workers=None, force=False):
+    # Renders the reports of path's users and months into output and returns
+    # (rendered, skipped, seconds). Jobs are one report each with per="month",
+    # or all of a user's reports with per="user".
+    db.use_database(path)
+    db.init_database()
+    reports = list_reports(usernames, months)
+    # The workers open their own connections; none is handed over from here
+    db.close_all_connections()
+    jobs = {}
+    for report in reports:
+        jobs.setdefault(report[0] if per == "user" else report, []).append(report)
+    os.makedirs(output, exist_ok=True)
+    manifest = read_manifest(output)
+    rendered = skipped = 0
+    started = time.perf_counter()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=_start_worker,
+                                                    initargs=(path,)) as pool:
+            futures = []
+            for job in jobs.values():
+                keys = [report_key(username, month, fmt) for _, username, month in job]
+                previous = {key: manifest[key] for key in keys if key in manifest}
+                futures.append(pool.submit(render_reports, job, output, fmt, previous, force))
+            for future in concurrent.futures.as_completed(futures):
+                for key, fingerprint, drawn in future.result():
+                    manifest[key] = fingerprint
+                    rendered += drawn
+                    skipped += not drawn
+    finally:
+        write_manifest(output, manifest)
+    return rendered, skipped, time.perf_counter() - started
+
+
+def month_argument(value):
+    if not re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", value):
+        raise argparse.ArgumentTypeError(f"'{value}' is not a yyyy-mm month")
+    return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render monthly expense statements to PNG or PDF files.")
+    parser.add_argument("output", help="directory the reports are written to, one folder per user")
+    parser.add_argument("--db", default=db.DB_NAME, help="database file (default: %(default)s)")
+    parser.add_argument("--user", action="append", help="only this username (repeatable)")
+    parser.add_argument("--month", action="append", type=month_argument, help="only this yyyy-mm month (repeatable)")
+    parser.add_argument("--format", choices=FORMATS, default="png")
+    parser.add_argument("--per", choices=("month", "user"), default="month",
+                        help="one job per report, or per user with all of their months")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--force", action="store_true", help="render reports whose data has not changed too")
+    args = parser.parse_args(argv)
+
+    rendered, skipped, seconds = generate(args.db, args.output, args.user, args.month, args.format, args.per,
+                                          args.workers, args.force)
+    print(f"Rendered {rendered:,} reports ({2 * rendered:,} charts) in {seconds:.1f}s, "
+          f"{rendered / max(seconds, 1e-9):,.1f} reports/s; {skipped:,} unchanged reports skipped.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
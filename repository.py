@@ -0,0 +1,322 @@
+import heapq
+from datetime import date as Date
+
+import db
+
+# Rows per page for list_expenses and list_matching
+PAGE_SIZE = 200
+# Searches matching more of a user's expenses than this are not ranked
+SEARCH_RANK_LIMIT = 1000
+# Targets for all categories first, then by category; days before weeks before months
+TARGET_ORDER = ("ORDER BY category IS NOT NULL, category, "
+                "CASE time_period WHEN 'daily' THEN 0 WHEN 'weekly' THEN 1 ELSE 2 END")
+
+
+def _page(sql, params, schemas, order, limit, merged_order=None):
+    # (sql, params) for one page of sql, which names its tables {schema}.,
+    # over the live database and the archives in schemas. With archives each
+    # schema's own first page is read and the pages are merged, so every
+    # schema still pages along its index. merged_order is order in terms of
+    # the result columns, when order uses table names.
+    if len(schemas) == 1:
+        return f"{sql.format(schema=schemas[0])} ORDER BY {order} LIMIT ?", params + [limit]
+    pages = " UNION ALL ".join(f"SELECT * FROM ({sql.format(schema=schema)} ORDER BY {order} LIMIT ?)"
+                               for schema in schemas)
+    return f"{pages} ORDER BY {merged_order or order} LIMIT ?", (params + [limit]) * len(schemas) + [limit]
+
+
+def _sum(sql, params, schemas):
+    # (sql, params) adding up the amount column of sql across schemas
+    branches = " UNION ALL ".join(sql.format(schema=schema) for schema in schemas)
+    return f"SELECT COALESCE(SUM(amount), 0) FROM ({branches})", params * len(schemas)
+
+
+class ExpenseRepository:
+    # Every expense operation the screens need, for one user, with no Tk
+    # involved, so it can be driven from the GUI, scripts and benchmarks alike.
+    # Each call uses the calling thread's connection from db.get_connection(),
+    # so one repository can be shared between the Tk thread and the worker.
+    # Amounts, totals and targets are integer cents in and out; convert with
+    # db.to_cents and db.format_cents at the screen. Writes commit unless
+    # called with commit=False inside a transaction the caller owns.
+    # Listings and totals take in the archived years their filter covers;
+    # archived expenses are read-only, so update and delete do not find them.
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def add(self, amount, description, category, date, commit=True):
+        conn = db.get_connection()
+        with db.transaction(conn, commit):
+            cursor = conn.execute("INSERT INTO expenses (user_id, amount, description, category, date) "
+                                  "VALUES (?, ?, ?, ?, ?)", (self.user_id, amount, description, category, date))
+        return cursor.lastrowid
+
+    def update(self, expense_id, amount, description, category, date, commit=True):
+        conn = db.get_connection()
+        with db.transaction(conn, commit):
+            cursor = conn.execute("UPDATE expenses SET amount=?, description=?, category=?, date=? "
+                                  "WHERE id=? AND user_id=?",
+                                  (amount, description, category, date, expense_id, self.user_id))
+        # False when the user has no such expense
+        return cursor.rowcount > 0
+
+    def delete(self, expense_id, commit=True):
+        conn = db.get_connection()
+        with db.transaction(conn, commit):
+            cursor = conn.execute("DELETE FROM expenses WHERE id=? AND user_id=?", (expense_id, self.user_id))
+        return cursor.rowcount > 0
+
+    def list_expenses(self, month=None, year=None, after=None, limit=PAGE_SIZE):
+        # One page of (id, amount, description, category, date) rows in (date, id)
+        # order. Pass the (date, id) of the last row seen as after for the next page;
+        # keyset pagination keeps every page as cheap as the first.
+        date_clause, date_params = db.date_filter(month, year)
+        sql = "SELECT id, amount, description, category, date FROM {schema}.expenses WHERE user_id=?" + date_clause
+        params = [self.user_id] + date_params
+        if after is not None:
+            sql += " AND (date, id) > (?, ?)"
+            params += list(after)
+        conn = db.get_connection()
+        return conn.execute(*_page(sql, params, db.expense_schemas(conn, year), "date, id", limit)).fetchall()
+
+    def list_filtered(self, expense_filter, sort="date", descending=False, after=None, limit=PAGE_SIZE):
+        # One page of (id, amount, description, category, date) rows meeting a
+        # db.ExpenseFilter, in the order of a db.SORT_KEYS column. The filtering
+        # and sorting run in SQLite; pass db.sort_key(last row, sort) as after
+        # for the next page.
+        clause, params = expense_filter.where()
+        if after is not None:
+            clause += db.after_clause(sort, descending)
+            params += list(after)
+        conn = db.get_connection()
+        return conn.execute(*_page("SELECT id, amount, description, category, date FROM {schema}.expenses "
+                                   "WHERE user_id=?" + clause, [self.user_id] + params,
+                                   self._filter_schemas(conn, expense_filter), db.order_by(sort, descending),
+                                   limit)).fetchall()
+
+    def filtered_total(self, expense_filter):
+        clause, params = expense_filter.where()
+        conn = db.get_connection()
+        return conn.execute(*_sum("SELECT amount FROM {schema}.expenses WHERE user_id=?" + clause,
+                                  [self.user_id] + params, self._filter_schemas(conn, expense_filter))).fetchone()[0]
+
+    def _filter_schemas(self, conn, expense_filter):
+        schemas = db.expense_schemas(conn, years=expense_filter.years())
+        if expense_filter.search() is not None:
+            schemas = [schema for schema in schemas if db.search_available(conn, schema)]
+        return schemas
+
+    def search_available(self):
+        return db.search_available(db.get_connection())
+
+    def _search_schemas(self, conn, year):
+        return [schema for schema in db.expense_schemas(conn, year) if db.search_available(conn, schema)]
+
+    def list_matching(self, text, month=None, year=None, after=None, limit=PAGE_SIZE):
+        # Full-text search over description and category, as rows of
+        # (id, amount, description, category, date, rank). A search matching at
+        # most SEARCH_RANK_LIMIT of the user's expenses comes best match first.
+        # bm25 has to score every match, so broader searches (a whole category,
+        # a first letter) come newest first with rank None, which FTS5 can
+        # stream. Pass the (rank, id) of the last row seen as after for the next page.
+        query = db.search_query(text)
+        if query is None:
+            return []
+        date_clause, date_params = db.date_filter(month, year)
+        source = ("FROM {schema}.expenses_fts f CROSS JOIN {schema}.expenses e ON e.id = f.rowid "
+                  "WHERE f.expenses_fts MATCH ? AND e.user_id=?" + date_clause)
+        params = [query, self.user_id] + date_params
+        conn = db.get_connection()
+        schemas = self._search_schemas(conn, year)
+        if after is None:
+            branches = " UNION ALL ".join(f"SELECT 1 {source.format(schema=schema)}" for schema in schemas)
+            matches = conn.execute(f"SELECT COUNT(*) FROM ({branches} LIMIT ?)",
+                                   params * len(schemas) + [SEARCH_RANK_LIMIT + 1]).fetchone()[0]
+            ranked = matches <= SEARCH_RANK_LIMIT
+        else:
+            ranked = after[0] is not None
+        sql = "SELECT e.id, e.amount, e.description, e.category, e.date, "
+        if ranked:
+            sql += "f.rank AS rank " + source
+            if after is not None:
+                sql += " AND (f.rank, e.id) > (?, ?)"
+                params += list(after)
+            return conn.execute(*_page(sql, params, schemas, "f.rank, e.id", limit, "rank, id")).fetchall()
+        sql += "NULL AS rank " + source
+        if after is not None:
+            sql += " AND f.rowid < ?"
+            params.append(after[1])
+        return conn.execute(*_page(sql, params, schemas, "f.rowid DESC", limit, "id DESC")).fetchall()
+
+    def total(self, month=None, year=None, search=None):
+        conn = db.get_connection()
+        query = db.search_query(search) if search else None
+        date_clause, date_params = db.date_filter(month, year)
+        if query is not None:
+            row = conn.execute(*_sum("SELECT e.amount AS amount "
+                                     "FROM {schema}.expenses_fts f CROSS JOIN {schema}.expenses e ON e.id = f.rowid "
+                                     "WHERE f.expenses_fts MATCH ? AND e.user_id=?" + date_clause,
+                                     [query, self.user_id] + date_params, self._search_schemas(conn, year))).fetchone()
+            return row[0]
+        if month is None and year is None:
+            # category_totals counts archived expenses too
+            row = conn.execute("SELECT COALESCE(SUM(total), 0) FROM category_totals WHERE user_id=?",
+                               (self.user_id,)).fetchone()
+            return row[0]
+        row = conn.execute(*_sum("SELECT amount FROM {schema}.expenses WHERE user_id=?" + date_clause,
+                                 [self.user_id] + date_params, db.expense_schemas(conn, year))).fetchone()
+        return row[0]
+
+    def category_breakdown(self, month=None, year=None):
+        # (category, total) pairs in category order. For a month or year they
+        # are summed from the category index; otherwise read from category_totals.
+        conn = db.get_connection()
+        if month is None and year is None:
+            return conn.execute("SELECT category, total FROM category_totals WHERE user_id=? "
+                                "ORDER BY category", (self.user_id,)).fetchall()
+        date_clause, date_params = db.date_filter(month, year)
+        schemas = db.expense_schemas(conn, year)
+        branches = " UNION ALL ".join(f"SELECT category, amount FROM {schema}.expenses WHERE user_id=?{date_clause}"
+                                      for schema in schemas)
+        return conn.execute(f"SELECT category, SUM(amount) FROM ({branches}) GROUP BY category ORDER BY category",
+                            ([self.user_id] + date_params) * len(schemas)).fetchall()
+
+    def daily_series(self, above=None, month=None, year=None):
+        # Per-day totals in date order, optionally only the days whose total is
+        # above a limit or those in a month or year
+        date_clause, date_params = db.date_filter(month, year)
+        sql = "SELECT date, total FROM daily_totals WHERE user_id=?" + date_clause
+        params = [self.user_id] + date_params
+        if above is not None:
+            sql += " AND total > ?"
+            params.append(above)
+        return db.get_connection().execute(sql + " ORDER BY date", params).fetchall()
+
+    # Spending targets are per time_period (one of db.BUDGET_PERIODS) and per
+    # category, where category None covers all of them. The running total of
+    # each target's periods is kept in budget_totals by the expense triggers.
+
+    def budget_targets(self):
+        # (time_period, category, target_amount) for every target
+        return db.get_connection().execute(
+            "SELECT time_period, category, target_amount FROM spending_targets WHERE user_id=? " + TARGET_ORDER,
+            (self.user_id,)).fetchall()
+
+    def budget_target(self, time_period="daily", category=None):
+        row = db.get_connection().execute("SELECT target_amount FROM spending_targets "
+                                          "WHERE user_id=? AND time_period=? AND category IS ?",
+                                          (self.user_id, time_period, category)).fetchone()
+        return row[0] if row else None
+
+    def set_budget_target(self, target_amount, time_period="daily", category=None, commit=True):
+        # Returns True when an existing target was replaced. A new target's
+        # period totals are computed once here; the triggers keep them after.
+        if time_period not in db.BUDGET_PERIODS:
+            raise ValueError(f"time_period must be one of {db.BUDGET_PERIODS}")
+        conn = db.get_connection()
+        # A new target's totals take in the archives, attached before the transaction opens
+        db.expense_schemas(conn)
+        with db.transaction(conn, commit):
+            updated = conn.execute("UPDATE spending_targets SET target_amount=? "
+                                   "WHERE user_id=? AND time_period=? AND category IS ?",
+                                   (target_amount, self.user_id, time_period, category)).rowcount
+            if not updated:
+                cursor = conn.execute("INSERT INTO spending_targets (user_id, target_amount, time_period, category) "
+                                      "VALUES (?, ?, ?, ?)", (self.user_id, target_amount, time_period, category))
+                db.fill_budget_totals(conn.cursor(), cursor.lastrowid)
+        return bool(updated)
+
+    def delete_budget_target(self, time_period, category=None, commit=True):
+        # Its period totals go with it (ON DELETE CASCADE)
+        conn = db.get_connection()
+        with db.transaction(conn, commit):
+            cursor = conn.execute("DELETE FROM spending_targets WHERE user_id=? AND time_period=? AND category IS ?",
+                                  (self.user_id, time_period, category))
+        return cursor.rowcount > 0
+
+    def budget_check(self, date, category):
+        # The targets an expense on date in category counts towards that are
+        # now over, as (time_period, category, target_amount, period total).
+        # One primary key lookup per target, however many expenses there are.
+        return db.get_connection().execute(
+            f"SELECT t.time_period, t.category, t.target_amount, COALESCE(b.total, 0) "
+            f"FROM spending_targets t LEFT JOIN budget_totals b "
+            f"ON b.target_id = t.id AND b.period_start = {db.period_start_sql(':date', 't.time_period')} "
+            f"WHERE t.user_id = :user AND (t.category IS NULL OR t.category = :category) "
+            f"AND COALESCE(b.total, 0) > t.target_amount",
+            {"date": date, "user": self.user_id, "category": category}).fetchall()
+
+    def budget_exceedances(self):
+        # (time_period, category, target_amount, [(period start, total), ...]) for
+        # every target, listing the periods that went over it
+        conn = db.get_connection()
+        targets = conn.execute("SELECT id, time_period, category, target_amount FROM spending_targets "
+                               "WHERE user_id=? " + TARGET_ORDER, (self.user_id,)).fetchall()
+        return [(time_period, category, target_amount,
+                 conn.execute("SELECT period_start, total FROM budget_totals "
+                              "WHERE target_id=? AND total > ? ORDER BY period_start",
+                              (target_id, target_amount)).fetchall())
+                for target_id, time_period, category, target_amount in targets]
+
+    # Recurring expenses repeat every `every` units (one of db.RECURRING_UNITS).
+    # Occurrences up to today become ordinary expenses when catch_up_recurring
+    # runs; later ones exist only as forecast_recurring generates them.
+
+    def recurring_expenses(self):
+        # (id, amount, description, category, start_date, unit, every, end_date,
+        # next_date) for every rule, next due first; next_date is None once a rule has ended
+        return db.get_connection().execute(
+            "SELECT id, amount, description, category, start_date, unit, every, end_date, next_date "
+            "FROM recurring_expenses WHERE user_id=? ORDER BY next_date IS NULL, next_date, id",
+            (self.user_id,)).fetchall()
+
+    def add_recurring(self, amount, description, category, start_date, unit="month", every=1, end_date=None,
+                      commit=True):
+        # Returns the new rule's id. Its occurrences up to today are added by
+        # the next catch_up_recurring. Raises ValueError for a rule that cannot repeat.
+        if unit not in db.RECURRING_UNITS:
+            raise ValueError(f"unit must be one of {db.RECURRING_UNITS}")
+        if not isinstance(every, int) or every < 1:
+            raise ValueError("every must be a positive whole number")
+        start = Date.fromisoformat(start_date).isoformat()
+        if end_date is not None:
+            end_date = Date.fromisoformat(end_date).isoformat()
+        if end_date is not None and end_date < start:
+            raise ValueError("end_date is before start_date")
+        conn = db.get_connection()
+        with db.transaction(conn, commit):
+            cursor = conn.execute("INSERT INTO recurring_expenses (user_id, amount, description, category, "
+                                  "start_date, unit, every, end_date, next_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                  (self.user_id, amount, description, category, start, unit, every, end_date, start))
+        return cursor.lastrowid
+
+    def delete_recurring(self, rule_id, commit=True):
+        # Stops the rule; the expenses it already added stay
+        conn = db.get_connection()
+        with db.transaction(conn, commit):
+            cursor = conn.execute("DELETE FROM recurring_expenses WHERE id=? AND user_id=?", (rule_id, self.user_id))
+        return cursor.rowcount > 0
+
+    def catch_up_recurring(self, today=None, commit=True):
+        # Adds the user's occurrences due up to today in one transaction; returns how many
+        return db.materialize_recurring(today, self.user_id, commit)
+
+    def forecast_recurring(self, until, start=None):
+        # Lazily yields (date, amount, description, category) for the
+        # occurrences not added yet, dated from start (default: the next one
+        # due) up to and including until, in date order. Nothing is stored.
+        rules = db.get_connection().execute(
+            "SELECT amount, description, category, start_date, unit, every, end_date, materialized "
+            "FROM recurring_expenses WHERE user_id=? AND next_date <= ?", (self.user_id, until)).fetchall()
+        return heapq.merge(*(_occurrences(rule, start, until) for rule in rules), key=lambda occurrence: occurrence[0])
+
+
+def _occurrences(rule, start, until):
+    # One rule's part of ExpenseRepository.forecast_recurring
+    amount, description, category, start_date, unit, every, end_date, materialized = rule
+    for date in db.recurring_dates(start_date, unit, every, end_date, materialized):
+        if date > until:
+            return
+        if start is None or date >= start:
+            yield date, amount, description, category
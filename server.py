@@ -0,0 +1,500 @@
+# Serves one expense database to several desktop clients over HTTP/JSON, so
+# only this process writes to the file and the clients never see "database is
+# locked":
+#
+#     python server.py --db ohhwow.db --port 8765
+#     python login.py --server http://127.0.0.1:8765
+#
+# Reads run on a pool of threads, each with its own connection. Writes go to a
+# single writer thread, which takes every write queued while the previous
+# commit ran, gives each its own savepoint and commits them together.
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import re
+import secrets
+import sqlite3
+import sys
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+
+import db
+from repository import ExpenseRepository, PAGE_SIZE
+
+DEFAULT_PORT = 8765
+READERS = 4
+# Most writes committed in one transaction
+MAX_BATCH = 256
+MAX_BODY_BYTES = 1024 * 1024
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class BatchWriter:
+    # Group commit: one thread owns the write connection, and every write that
+    # queued up while a commit was running goes into the next transaction. A
+    # failing write only rolls back its own savepoint.
+
+    def __init__(self, max_batch=MAX_BATCH):
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.thread = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="writer")
+        self.batches = 0
+        self.writes = 0
+
+    async def submit(self, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((func, args, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                outcomes = await loop.run_in_executor(self.thread, self._commit, [item[:2] for item in batch])
+            except Exception as error:
+                # The commit itself failed, so none of the batch was written
+                outcomes = [(None, error)] * len(batch)
+            self.batches += 1
+            self.writes += len(batch)
+            for (_, _, future), (result, error) in zip(batch, outcomes):
+                if future.cancelled():
+                    continue
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    @staticmethod
+    def _commit(batch):
+        # Runs on the writer thread; returns a (result, error) pair per write
+        conn = db.get_connection()
+        outcomes = []
+        # Setting a budget target reads the archives; they cannot be attached inside the transaction
+        db.expense_schemas(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for func, args in batch:
+                conn.execute("SAVEPOINT request")
+                try:
+                    outcomes.append((func(*args), None))
+                except Exception as error:
+                    conn.execute("ROLLBACK TO request")
+                    outcomes.append((None, error))
+                conn.execute("RELEASE request")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return outcomes
+
+    def stop(self):
+        self.thread.submit(db.close_connection).result()
+        self.thread.shutdown()
+
+
+class Request:
+    def __init__(self, method, target, headers, body):
+        self.method = method
+        url = urlsplit(target)
+        self.path = url.path
+        self.query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        self.headers = headers
+        self.body = body
+        self.match = None
+        self.user_id = None
+
+    def json(self):
+        try:
+            value = json.loads(self.body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "body is not valid JSON") from None
+        if not isinstance(value, dict):
+            raise HTTPError(400, "body must be a JSON object")
+        return value
+
+    def field(self, data, name, kind):
+        value = data.get(name)
+        if not isinstance(value, kind) or isinstance(value, bool):
+            raise HTTPError(400, f"'{name}' is missing or not a {kind.__name__}")
+        return value
+
+    def amount_field(self, data, name):
+        # Cents within the range db.to_cents accepts, so the totals' SUMs cannot overflow
+        value = self.field(data, name, int)
+        if not -db.MAX_CENTS <= value <= db.MAX_CENTS:
+            raise HTTPError(400, f"'{name}' is out of range")
+        return value
+
+    def date_field(self, data, name, required=True):
+        # A real yyyy-mm-dd date, zero-padded as stored so the date filters match it
+        value = data.get(name)
+        if value is None and not required:
+            return None
+        if not isinstance(value, str):
+            raise HTTPError(400, f"'{name}' is {'missing or ' if required else ''}not a str")
+        try:
+            return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+        except ValueError:
+            raise HTTPError(400, f"'{name}' must be a yyyy-mm-dd date") from None
+
+    def int_param(self, name):
+        value = self.query.get(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise HTTPError(400, f"'{name}' must be an integer") from None
+
+    def after_param(self):
+        # The keyset of the last row seen, as a JSON array of its values
+        value = self.query.get("after")
+        if value is None:
+            return None
+        try:
+            after = json.loads(value)
+        except ValueError:
+            after = None
+        if not isinstance(after, list) or len(after) < 2:
+            raise HTTPError(400, "'after' must be a JSON array of at least two values")
+        return after
+
+    def filter_param(self):
+        # A db.ExpenseFilter sent as a JSON object of its fields
+        value = self.query.get("filter")
+        if value is None:
+            return None
+        try:
+            values = json.loads(value)
+            if not isinstance(values, dict):
+                raise ValueError("'filter' must be a JSON object")
+            return db.ExpenseFilter.from_dict(values)
+        except (TypeError, ValueError) as error:
+            raise HTTPError(400, f"bad filter: {error}") from None
+
+
+class ExpenseServer:
+    # The operations of LoginRegisterClass and ExpenseTrackerClass as routes.
+    # Amounts are integer cents, as in ExpenseRepository, and rows are arrays
+    # in the repository's column order. Log in with POST /login and send the
+    # token it returns as "Authorization: Bearer <token>".
+
+    ROUTES = [
+        ("POST", r"/register", "register"),
+        ("POST", r"/login", "login"),
+        ("GET", r"/expenses", "list_expenses"),
+        ("POST", r"/expenses", "add_expense"),
+        ("PUT", r"/expenses/(\d+)", "update_expense"),
+        ("DELETE", r"/expenses/(\d+)", "delete_expense"),
+        ("GET", r"/search", "search"),
+        ("GET", r"/total", "total"),
+        ("GET", r"/categories", "category_breakdown"),
+        ("GET", r"/daily", "daily_series"),
+        ("GET", r"/budget", "budget_targets"),
+        ("PUT", r"/budget", "set_budget_target"),
+        ("DELETE", r"/budget", "delete_budget_target"),
+        ("GET", r"/budget/check", "budget_check"),
+        ("GET", r"/budget/exceedances", "budget_exceedances"),
+        ("GET", r"/recurring", "recurring_expenses"),
+        ("POST", r"/recurring", "add_recurring"),
+        ("DELETE", r"/recurring/(\d+)", "delete_recurring"),
+        ("POST", r"/recurring/catch-up", "catch_up_recurring"),
+        ("GET", r"/recurring/forecast", "forecast_recurring"),
+        ("GET", r"/stats", "stats"),
+    ]
+
+    def __init__(self, readers=READERS, max_batch=MAX_BATCH):
+        self.readers = concurrent.futures.ThreadPoolExecutor(readers, thread_name_prefix="reader")
+        self.writer = BatchWriter(max_batch)
+        self.sessions = {}
+        self.requests = 0
+        self.routes = [(method, re.compile(pattern + "$"), getattr(self, name))
+                       for method, pattern, name in self.ROUTES]
+
+    async def read(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.readers, func, *args)
+
+    async def write(self, func, *args):
+        return await self.writer.submit(func, *args)
+
+    def repository(self, request):
+        return ExpenseRepository(request.user_id)
+
+    async def serve(self, host="127.0.0.1", port=DEFAULT_PORT, ready=None):
+        writer_task = asyncio.create_task(self.writer.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        if ready is not None:
+            ready(server)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            writer_task.cancel()
+            self.writer.stop()
+            self.readers.shutdown()
+
+    async def handle(self, reader, writer):
+        # One client connection; requests on it are answered in order (HTTP/1.1 keep-alive)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                keep_alive = True
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                    headers = {}
+                    while True:
+                        line = await reader.readline()
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                        name, _, value = line.decode("latin-1").partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                    length = int(headers.get("content-length", 0))
+                    if length > MAX_BODY_BYTES:
+                        raise HTTPError(413, "request body too large")
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = await self.dispatch(Request(method, target, headers, body))
+                except HTTPError as error:
+                    status, payload = error.status, {"error": str(error)}
+                    keep_alive = keep_alive and status not in (400, 413)
+                except ValueError:
+                    status, payload, keep_alive = 400, {"error": "malformed request"}, False
+                except Exception as error:
+                    status, payload = 500, {"error": f"{type(error).__name__}: {error}"}
+                data = json.dumps(payload).encode()
+                connection = "" if keep_alive else "Connection: close\r\n"
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                             f"Content-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n{connection}\r\n".encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, request):
+        self.requests += 1
+        allowed = False
+        for method, pattern, handler in self.routes:
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            allowed = True
+            if method != request.method:
+                continue
+            request.match = match
+            if handler not in (self.register, self.login, self.stats):
+                self.authenticate(request)
+            try:
+                return 200, await handler(request)
+            except sqlite3.IntegrityError as error:
+                raise HTTPError(400, str(error)) from None
+            except sqlite3.OperationalError as error:
+                # e.g. the file is locked by a desktop app still writing to it directly
+                raise HTTPError(503, str(error)) from None
+            except sqlite3.Error as error:
+                raise HTTPError(500, str(error)) from None
+        if allowed:
+            raise HTTPError(405, f"{request.method} is not allowed on {request.path}")
+        raise HTTPError(404, f"no route for {request.path}")
+
+    def authenticate(self, request):
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        user_id = self.sessions.get(token) if scheme.lower() == "bearer" else None
+        if user_id is None:
+            raise HTTPError(401, "log in first")
+        request.user_id = user_id
+
+    async def register(self, request):
+        data = request.json()
+        username, password = request.field(data, "username", str), request.field(data, "password", str)
+        return {"registered": await self.write(db.register_user, username, password, False)}
+
+    async def login(self, request):
+        data = request.json()
+        user = await self.read(db.authenticate, request.field(data, "username", str),
+                               request.field(data, "password", str))
+        if user is None:
+            raise HTTPError(401, "invalid username or password")
+        token = secrets.token_urlsafe(24)
+        self.sessions[token] = user[0]
+        return {"token": token, "user_id": user[0]}
+
+    def _expense_fields(self, request):
+        data = request.json()
+        return (request.amount_field(data, "amount"), request.field(data, "description", str),
+                request.field(data, "category", str), request.date_field(data, "date"))
+
+    async def list_expenses(self, request):
+        # With a filter, the rows are sorted by the sort column (descending=1 reverses it)
+        expense_filter = request.filter_param()
+        if expense_filter is not None:
+            sort = request.query.get("sort", "date")
+            if sort not in db.SORT_KEYS:
+                raise HTTPError(400, f"'sort' must be one of {', '.join(db.SORT_KEYS)}")
+            rows = await self.read(self.repository(request).list_filtered, expense_filter, sort,
+                                   bool(request.int_param("descending")), request.after_param(),
+                                   request.int_param("limit") or PAGE_SIZE)
+            return {"rows": rows}
+        rows = await self.read(self.repository(request).list_expenses, request.int_param("month"),
+                               request.int_param("year"), request.after_param(),
+                               request.int_param("limit") or PAGE_SIZE)
+        return {"rows": rows}
+
+    async def add_expense(self, request):
+        amount, description, category, date = self._expense_fields(request)
+        return {"id": await self.write(self.repository(request).add, amount, description, category, date, False)}
+
+    async def update_expense(self, request):
+        amount, description, category, date = self._expense_fields(request)
+        expense_id = int(request.match.group(1))
+        if not await self.write(self.repository(request).update, expense_id, amount, description, category,
+                                date, False):
+            raise HTTPError(404, f"no expense {expense_id}")
+        return {"id": expense_id}
+
+    async def delete_expense(self, request):
+        expense_id = int(request.match.group(1))
+        if not await self.write(self.repository(request).delete, expense_id, False):
+            raise HTTPError(404, f"no expense {expense_id}")
+        return {"id": expense_id}
+
+    async def search(self, request):
+        repository = self.repository(request)
+        text = request.query.get("q")
+        if text is None:
+            return {"available": await self.read(repository.search_available)}
+        rows = await self.read(repository.list_matching, text, request.int_param("month"),
+                               request.int_param("year"), request.after_param(),
+                               request.int_param("limit") or PAGE_SIZE)
+        return {"rows": rows}
+
+    async def total(self, request):
+        expense_filter = request.filter_param()
+        if expense_filter is not None:
+            return {"total": await self.read(self.repository(request).filtered_total, expense_filter)}
+        return {"total": await self.read(self.repository(request).total, request.int_param("month"),
+                                         request.int_param("year"), request.query.get("search"))}
+
+    async def category_breakdown(self, request):
+        return {"rows": await self.read(self.repository(request).category_breakdown, request.int_param("month"),
+                                        request.int_param("year"))}
+
+    async def daily_series(self, request):
+        return {"rows": await self.read(self.repository(request).daily_series, request.int_param("above"),
+                                        request.int_param("month"), request.int_param("year"))}
+
+    def _target(self, data):
+        # The (time_period, category) a budget request is about
+        time_period = data.get("time_period", "daily")
+        if time_period not in db.BUDGET_PERIODS:
+            raise HTTPError(400, f"'time_period' must be one of {', '.join(db.BUDGET_PERIODS)}")
+        category = data.get("category")
+        if category is not None and not isinstance(category, str):
+            raise HTTPError(400, "'category' must be a str")
+        return time_period, category
+
+    async def budget_targets(self, request):
+        return {"rows": await self.read(self.repository(request).budget_targets)}
+
+    async def set_budget_target(self, request):
+        data = request.json()
+        target_amount = request.amount_field(data, "target_amount")
+        return {"replaced": await self.write(self.repository(request).set_budget_target, target_amount,
+                                             *self._target(data), False)}
+
+    async def delete_budget_target(self, request):
+        if not await self.write(self.repository(request).delete_budget_target, *self._target(request.query), False):
+            raise HTTPError(404, "no such target")
+        return {}
+
+    async def budget_check(self, request):
+        date, category = request.query.get("date"), request.query.get("category")
+        if date is None or category is None:
+            raise HTTPError(400, "'date' and 'category' are required")
+        return {"rows": await self.read(self.repository(request).budget_check, date, category)}
+
+    async def budget_exceedances(self, request):
+        return {"targets": await self.read(self.repository(request).budget_exceedances)}
+
+    async def recurring_expenses(self, request):
+        return {"rows": await self.read(self.repository(request).recurring_expenses)}
+
+    async def add_recurring(self, request):
+        data = request.json()
+        amount, description, category = (request.amount_field(data, "amount"),
+                                         request.field(data, "description", str),
+                                         request.field(data, "category", str))
+        start_date, unit = request.date_field(data, "start_date"), data.get("unit", "month")
+        every, end_date = data.get("every", 1), request.date_field(data, "end_date", required=False)
+        try:
+            rule_id = await self.write(self.repository(request).add_recurring, amount, description, category,
+                                       start_date, unit, every, end_date, False)
+        except ValueError as error:
+            raise HTTPError(400, str(error)) from None
+        return {"id": rule_id}
+
+    async def delete_recurring(self, request):
+        rule_id = int(request.match.group(1))
+        if not await self.write(self.repository(request).delete_recurring, rule_id, False):
+            raise HTTPError(404, f"no recurring expense {rule_id}")
+        return {"id": rule_id}
+
+    async def catch_up_recurring(self, request):
+        # Runs in the writer's transaction, so clients catching up together add each occurrence once
+        return {"added": await self.write(self.repository(request).catch_up_recurring, None, False)}
+
+    async def forecast_recurring(self, request):
+        until, start = request.query.get("until"), request.query.get("start")
+        if until is None:
+            raise HTTPError(400, "'until' is required")
+        repository = self.repository(request)
+        return {"rows": await self.read(lambda: list(repository.forecast_recurring(until, start)))}
+
+    async def stats(self, request):
+        writer = self.writer
+        return {"requests": self.requests, "writes": writer.writes, "commits": writer.batches,
+                "writes_per_commit": round(writer.writes / max(writer.batches, 1), 2)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve an expense database to desktop clients over HTTP/JSON.")
+    parser.add_argument("--db", default=db.DB_NAME, help="database file (default: %(default)s)")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--readers", type=int, default=READERS, help="read connections (default: %(default)s)")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH, help="most writes per commit")
+    args = parser.parse_args(argv)
+
+    db.use_database(args.db)
+    db.init_database()
+    server = ExpenseServer(args.readers, args.max_batch)
+
+    def ready(listener):
+        host, port = listener.sockets[0].getsockname()[:2]
+        print(f"Serving {args.db} on http://{host}:{port}", flush=True)
+
+    try:
+        asyncio.run(server.serve(args.host, args.port, ready))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import threading
+import time
+
+import db
+import instrumentation
+from repository import PAGE_SIZE
+
+
+class Session:
+    # Login's head start on the tracker window. As soon as a user logs in, one
+    # background thread makes the repository calls the window's first screens
+    # make and loads the expense cache, while the window is still being
+    # built. Each screen then gets its first result from here, waiting for it
+    # if it is still on its way, instead of querying again. Later calls, and
+    # every call after discard(), go to the repository.
+
+    def __init__(self, repository, load_cache=True):
+        self.repository = repository
+        self.load_cache = load_cache
+        # (method, args) of each prefetched call, in the order they run. Due
+        # recurring expenses are added first so everything after has them.
+        self.calls = [
+            ("catch_up_recurring", ()),
+            ("list_filtered", (db.ExpenseFilter(), "date", False, None, PAGE_SIZE)),
+            ("filtered_total", (db.ExpenseFilter(),)),
+            ("category_breakdown", ()),
+            ("daily_series", ()),
+            ("budget_exceedances", ()),
+        ]
+        # Index in calls -> (result, error), until taken
+        self.results = {}
+        self.taken = set()
+        self.cache = None
+        self.finished = False
+        self.discarded = False
+        self.thread = None
+        self.condition = threading.Condition()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="session-prefetch", daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        started = time.perf_counter()
+        try:
+            for index, (name, args) in enumerate(self.calls):
+                try:
+                    outcome = getattr(self.repository, name)(*args), None
+                except Exception as error:
+                    outcome = None, error
+                with self.condition:
+                    self.results[index] = outcome
+                    self.condition.notify_all()
+            if self.load_cache:
+                # Imported here, as NumPy is not needed to show the login window
+                from expense_cache import ExpenseCache
+                try:
+                    cache = ExpenseCache.load(self.repository.user_id)
+                except Exception:
+                    # take_cache returns None, and the tracker's own load reports the error
+                    cache = None
+                with self.condition:
+                    self.cache = cache
+        finally:
+            db.close_connection()
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+            instrumentation.record("session", "prefetch", (time.perf_counter() - started) * 1000)
+
+    def call(self, name, *args):
+        # repository.name(*args), answered from the prefetch when it made this
+        # very call and nobody has taken its result yet. Waits for the
+        # prefetch, so call it from a worker thread rather than the Tk one.
+        with self.condition:
+            index = self._prefetched(name, args)
+            if index is not None:
+                self.taken.add(index)
+                self.condition.wait_for(lambda: index in self.results or self.finished)
+                outcome = self.results.pop(index, None)
+                if outcome is not None and outcome[1] is None and not self.discarded:
+                    return outcome[0]
+        return getattr(self.repository, name)(*args)
+
+    def _prefetched(self, name, args):
+        if self.thread is None or self.discarded:
+            return None
+        for index, call in enumerate(self.calls):
+            if index not in self.taken and call == (name, args):
+                return index
+        return None
+
+    def take_cache(self):
+        # The ExpenseCache the prefetch loaded, waiting for it; None when there
+        # is none to take, and the caller loads its own
+        with self.condition:
+            if self.thread is None:
+                return None
+            self.condition.wait_for(lambda: self.finished)
+            cache, self.cache = self.cache, None
+        return cache
+
+    def discard(self):
+        # After a write: what was prefetched may no longer be current. The
+        # cache is kept; it replays the edits made while it loaded.
+        with self.condition:
+            self.discarded = True
+            self.results.clear()
@@ -1,28 +1,95 @@
+import bisect
+import importlib
+import threading
 import tkinter as tk
-from tkcalendar import DateEntry
-from tkinter import ttk, messagebox
-from datetime import datetime
+from tkinter import ttk, messagebox, filedialog
+from datetime import date as Date, datetime, timedelta
 import customtkinter as ctk
 from customtkinter import CTk, CTkLabel, CTkFrame, CTkEntry, CTkComboBox, CTkButton, CTkToplevel
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import mplcursors
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+import analytics
+import backup
 import db
+import importer
+import instrumentation
+import remote
+from db_worker import DatabaseWorker
+from expense_cache import ExpenseCache
+from repository import ExpenseRepository, PAGE_SIZE
+from session import Session
+
+# The charting and calendar stacks take most of the start-up time, so they are
+# imported inside the screens that use them (and warmed early by
+# warm_up_imports) rather than at the top of this module.
+DEFERRED_MODULES = [
+    "charts",
+    "matplotlib.dates",
+    "matplotlib.backends.backend_tkagg",
+    "mplcursors",
+    "tkcalendar",
+]
+
+
+def warm_up_imports():
+    # Imports the deferred modules on a background thread so the first chart or
+    # calendar the user opens does not pay for them
+    def run():
+        for name in DEFERRED_MODULES:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+    thread = threading.Thread(target=run, name="warm-up-imports", daemon=True)
+    thread.start()
+    return thread
 
 months = [
     "All", "January", "February", "March", "April", "May", "June",
     "July", "August", "September", "October", "November", "December"
 ]
 years = ["All"] + [str(year) for year in range(2020, datetime.now().year + 1)]
+# Typing pauses this long before the records search runs
+SEARCH_DELAY_MS = 250
+ALL_CATEGORIES = "All categories"
+# Expense Records columns, their headings and the db.SORT_KEYS column each sorts by
+RECORD_HEADINGS = {"Amount": "Amount($)", "Description": "Description", "Category": "Category", "Date": "Date"}
+RECORD_SORTS = {"Amount": "amount", "Description": "description", "Category": "category", "Date": "date"}
+# Add Expense's repeat choices and the db.RECURRING_UNITS unit of each
+REPEAT_CHOICES = {"Does not repeat": None, "Every day": "day", "Every week": "week", "Every month": "month",
+                  "Every year": "year"}
+# How often recurring expenses are checked for while the app stays open
+RECURRING_CHECK_MS = 60 * 60 * 1000
+# Days ahead the Recurring screen forecasts
+FORECAST_DAYS = 30
+# How often the app checks whether backup.INTERVAL has passed since the last snapshot
+BACKUP_CHECK_MS = 60 * 60 * 1000
+# Seconds the app's snapshots sleep between backup steps, so the cache load and
+# screens' queries get the disk in between
+BACKUP_STEP_PAUSE = 0.01
 
 class ExpenseTrackerClass(CTk):
-    def __init__(self, current_user_id):
+    def __init__(self, current_user_id, repository=None, session=None):
         super().__init__()
         self.title("Expense Tracker")
         self.geometry("600x450")
         self.current_user_id = current_user_id
-        self.expenses = []
+        # An ExpenseRepository, or a remote.RemoteRepository when running against server.py
+        self.repository = repository or ExpenseRepository(current_user_id)
+        # Import, export and the cache read the database file directly
+        self.local = isinstance(self.repository, ExpenseRepository)
+        # What login prefetched for the first screens; an unstarted session
+        # passes every call straight to the repository
+        self.session = session or Session(self.repository, load_cache=False)
+        # Set once the start-up catch-up has reported back
+        self.recurring_checked = False
+        # Columnar copy of the user's expenses for totals and breakdowns
+        self.cache = ExpenseCache()
+        self.charts = {}
+        self.search_job = None
+        self.importing = False
+        # Whether the repository can search, once asked
+        self.search_supported = None
+        # The Expense Records tree, while that screen is open
+        self.tree = None
         self.categories = [
             "Food",
             "Transportation",
@@ -32,6 +99,23 @@ class ExpenseTrackerClass(CTk):
             "Other",
         ]
         self.create_widgets()
+        self.worker = DatabaseWorker(self, on_busy=self.show_loading)
+        # The cache load reads every expense, so it gets a thread and connection
+        # of its own instead of holding up the screens' queries on self.worker
+        self.cache_loader = DatabaseWorker(self)
+        # Recurring expenses that came due while the app was closed are added
+        # first, so the cache load queued behind them already has them
+        self.check_recurring()
+        if self.local:
+            self.reload_cache()
+            # Statement imports run for as long as the file takes, so they get
+            # a thread and connection of their own and never queue the screens'
+            # queries on self.worker behind them
+            self.imports = DatabaseWorker(self)
+            # Snapshots of the database file, on a thread of their own
+            self.backups = DatabaseWorker(self)
+            self.check_backup()
+        instrumentation.watch_event_loop(self)
 
     def create_widgets(self):
         # Left side menu buttons
@@ -42,6 +126,7 @@ class ExpenseTrackerClass(CTk):
             ("Add Expense", self.add_expense),
             ("Expense Records", self.data_records),
             ("Budget Control", self.manage_expense_setting),
+            ("Recurring", self.recurring_expenses),
             ("Expense Analysis", self.data_analysis),
             ("Expense Flow", self.daily_expenses)
         ]
@@ -50,6 +135,10 @@ class ExpenseTrackerClass(CTk):
             button = CTkButton(self.menu_frame, text=text, height=35, command=command)
             button.pack(pady=10, padx=5)
 
+        # Shown while a database query is running in the background
+        self.loading_label = CTkLabel(self.menu_frame, text="", text_color="white")
+        self.loading_label.pack(side='bottom', pady=10)
+
         # Right side frame for changing content
         self.window_frame = tk.Frame(self, bg ="white")
         self.window_frame.pack(side="right", fill="both", expand=True)
@@ -80,12 +169,29 @@ class ExpenseTrackerClass(CTk):
 
         self.date_label = CTkLabel(self.window_frame, text="Date:", font=("Helvetica", 14))
         self.date_label.pack() 
+        from tkcalendar import DateEntry
         self.date_entry = DateEntry(self.window_frame, font=("Helvetica", 14), width=24, date_pattern='yyyy-mm-dd')
         self.date_entry.pack()
 
+        # A repeating expense becomes a rule; its occurrences up to today are added at once
+        repeat_frame = CTkFrame(self.window_frame, fg_color="transparent")
+        repeat_frame.pack(pady=(5, 0))
+        self.repeat_dropdown = CTkComboBox(repeat_frame, values=list(REPEAT_CHOICES), state="readonly", width=140)
+        self.repeat_dropdown.set("Does not repeat")
+        self.repeat_dropdown.pack(side="left", padx=5)
+        self.repeat_until_entry = CTkEntry(repeat_frame, placeholder_text="until yyyy-mm-dd", width=120)
+        self.repeat_until_entry.pack(side="left", padx=5)
+
         self.button_add = CTkButton(self.window_frame, text="Add", command=self.add_to_list, width=80)
         self.button_add.pack(pady =10)  
 
+        # Bulk import from a bank or CSV statement
+        self.button_import = CTkButton(self.window_frame, text="Import CSV...", command=self.import_statement, width=80)
+        if self.local:
+            self.button_import.pack()
+        self.import_label = CTkLabel(self.window_frame, text="", font=("Helvetica", 12))
+        self.import_label.pack()
+
     def add_to_list(self):
         # Gather input data
         amount = self.expense_entry.get()
@@ -99,41 +205,228 @@ class ExpenseTrackerClass(CTk):
             return
 
         try:
-            amount = float(amount)
+            amount = db.to_cents(amount)
         except ValueError:
             messagebox.showwarning("Invalid Amount", "Please enter a valid number for the amount.")
             return
 
-        # Save the expense to the database
-        conn, cursor = db.connect_to_database()
-        cursor.execute("INSERT INTO expenses (user_id, amount, description, category, date) VALUES (?, ?, ?, ?, ?)",
-                    (self.current_user_id, amount, description, category, date))
-        conn.commit()
+        unit = REPEAT_CHOICES[self.repeat_dropdown.get()]
+        if unit is not None:
+            repeats = self.repeat_dropdown.get().lower()
+            self.worker.submit(self.add_recurring_rule, amount, description, category, date, unit, 1,
+                               self.repeat_until_entry.get().strip() or None,
+                               callback=lambda result: self.recurring_added(result, description, repeats))
+            return
 
-        # Check if the expense exceeds the target limit
-        cursor.execute("SELECT target_amount FROM spending_targets WHERE user_id=?", (self.current_user_id,))
-        target = cursor.fetchone()
+        # Saved and checked on the worker; a slow disk or server never holds up the window
+        self.worker.submit(self.add_expense, amount, description, category, date,
+                           callback=lambda result: self.expense_added(result, amount, description, category, date))
 
-        if target:
-            target_amount = target[0]
-            exceed_amount = amount - target_amount
-            if exceed_amount > 0:
-                messagebox.showinfo("Exceed Expense Target",
-                                    f"Your expense is exceed ${exceed_amount:.2f} from target amount ${target_amount:2f}")
+    def write(self, func, *args):
+        # Runs on the database worker thread: a change, after which what the
+        # session prefetched is out of date for the jobs queued behind it
+        result = func(*args)
+        self.session.discard()
+        return result
 
-        # Append the expense to the list of expenses
-        self.expenses.append((amount, description, category, date))
+    def add_recurring_rule(self, *args):
+        # Runs on the database worker thread; a rule that cannot repeat comes back as its ValueError
+        try:
+            return self.write(self.repository.add_recurring, *args)
+        except ValueError as error:
+            return error
 
-        # Clear the input fields
+    def recurring_added(self, result, description, repeats):
+        if isinstance(result, ValueError):
+            messagebox.showwarning("Invalid Repeat", str(result))
+            return
+        self.catch_up_recurring()
+        messagebox.showinfo("Recurring Expense", f"{description} will be added {repeats}.")
+        if self.repeat_dropdown.winfo_exists():
+            self.repeat_dropdown.set("Does not repeat")
+            self.repeat_until_entry.delete(0, tk.END)
+            self.clear_expense_entries()
+
+    def add_expense(self, amount, description, category, date):
+        # Runs on the database worker thread. Returns the new id and the day's,
+        # week's and month's targets the expense took over their limit.
+        expense_id = self.write(self.repository.add, amount, description, category, date)
+        return expense_id, self.repository.budget_check(date, category)
+
+    def expense_added(self, result, amount, description, category, date):
+        expense_id, exceeded = result
+        self.cache.add(expense_id, amount, category, date)
+        if self.records_open():
+            self.record_added((expense_id, amount, description, category, date))
+        if exceeded:
+            lines = [f"Your {time_period} spending{f' on {target_category}' if target_category else ''} "
+                     f"is ${db.format_cents(total)}, ${db.format_cents(total - target_amount)} over the "
+                     f"${db.format_cents(target_amount)} target."
+                     for time_period, target_category, target_amount, total in exceeded]
+            messagebox.showinfo("Exceed Expense Target", "\n".join(lines))
+        if self.expense_entry.winfo_exists():
+            self.clear_expense_entries()
+
+    def clear_expense_entries(self):
         self.expense_entry.delete(0, tk.END)
         self.item_entry.delete(0, tk.END)
         self.category_dropdown.set("")  # Clear the selection
         self.date_entry.set_date(datetime.now())  # Set date to current date
 
+    def report_callback_exception(self, exc, value, traceback):
+        # A server that is down or turns a request away is reported to the
+        # user, whether the call failed on a worker or in a Tk callback
+        if isinstance(value, remote.RemoteError):
+            messagebox.showerror("Server Error", str(value))
+            return
+        super().report_callback_exception(exc, value, traceback)
+
+    def import_statement(self):
+        path = filedialog.askopenfilename(title="Import Statement",
+                                          filetypes=[("CSV files", "*.csv"), ("All files", "*.*")])
+        if not path:
+            return
+        if self.importing:
+            messagebox.showinfo("Import Running", "Wait for the statement being imported to finish.")
+            return
+        self.start_import(path)
+
+    def start_import(self, path, date_format=None):
+        self.import_progress = (0, 0.0)
+        self.importing = True
+        # No key: the import keeps going and reports back even if the user changes screen
+        self.imports.submit(self.run_import, path, date_format,
+                            callback=lambda result: self.finish_import(result, path))
+        self.show_import_progress()
+
+    def run_import(self, path, date_format=None):
+        # Runs on the import thread
+        def progress(imported, rate):
+            self.import_progress = (imported, rate)
+        # Any failure is handed back as the result so finish_import always runs;
+        # batches committed before it stay imported
+        try:
+            return importer.import_file(path, self.current_user_id, date_format=date_format, progress=progress)
+        except Exception as error:
+            return error
+        finally:
+            if self.import_progress[0]:
+                # Here rather than in finish_import, so no screen query gets a
+                # prefetched result from before the import in between
+                self.session.discard()
+
+    def show_import_progress(self):
+        if not self.importing:
+            return
+        imported, rate = self.import_progress
+        if self.import_label.winfo_exists():
+            self.import_label.configure(text=f"Imported {imported:,} rows ({rate:,.0f} rows/s)")
+        self.after(200, self.show_import_progress)
+
+    def finish_import(self, result, path):
+        self.importing = False
+        if self.import_label.winfo_exists():
+            self.import_label.configure(text="")
+        if isinstance(result, importer.AmbiguousDatesError):
+            # Nothing was imported; the user says how the file's dates are written
+            for date_format in result.formats:
+                if messagebox.askyesno("Date Format", f"The dates in this statement could be read more "
+                                                      f"than one way. Are they {importer.format_label(date_format)}?"):
+                    self.start_import(path, date_format)
+                    return
+            messagebox.showinfo("Import Cancelled", "Nothing was imported.")
+            return
+        if isinstance(result, Exception):
+            committed = self.import_progress[0]
+            message = str(result) or type(result).__name__
+            if committed:
+                message += f"\n{committed:,} expenses from earlier batches were already imported."
+            messagebox.showerror("Import Failed", message)
+            if committed:
+                self.reload_cache()
+            return
+        imported, errors, seconds = result
+        message = f"Imported {imported:,} expenses in {seconds:.1f}s ({imported / max(seconds, 1e-9):,.0f} rows/s)."
+        if errors:
+            message += (f"\nSkipped {len(errors):,} rows, credits or invalid "
+                        f"(first at line {errors[0][0]}: {errors[0][1]}).")
+        messagebox.showinfo("Import Complete", message)
+        if imported:
+            self.reload_cache()
+
+    def reload_cache(self):
+        # Screen changes never cancel the loader's jobs; a newer load supersedes
+        # an older one. Edits made meanwhile are queued by the cache and
+        # replayed when the loaded arrays arrive.
+        self.cache.invalidate()
+        self.cache_loader.submit(self.load_cache, callback=self.cache.install, key="cache")
+
+    def load_cache(self):
+        # Runs on the cache loader's thread. The first load is usually the one
+        # login's session already made.
+        return self.session.take_cache() or ExpenseCache.load(self.current_user_id)
+
+    def check_recurring(self):
+        # At start-up and then every RECURRING_CHECK_MS while the app is open
+        self.catch_up_recurring()
+        self.after(RECURRING_CHECK_MS, self.check_recurring)
+
+    def catch_up_recurring(self):
+        # On the cache loader's thread, ahead of any cache load queued after it
+        self.cache_loader.submit(self.session.call, "catch_up_recurring", callback=self.recurring_caught_up)
+
+    def recurring_caught_up(self, added):
+        # The start-up catch-up ran ahead of everything the session prefetched,
+        # so only later ones make its results out of date
+        first, self.recurring_checked = not self.recurring_checked, True
+        if not added:
+            return
+        if not first:
+            self.session.discard()
+        # A load already on its way started after the occurrences were committed
+        if self.local and not self.cache.loading:
+            self.reload_cache()
+        if self.records_open():
+            self.reset_records(self.records_filter)
+            self.update_total_label()
+
+    def check_backup(self):
+        self.backups.submit(backup.scheduled_snapshot, backup.BACKUP_DIR, backup.INTERVAL, backup.KEEP,
+                            BACKUP_STEP_PAUSE, callback=self.backup_taken)
+        self.after(BACKUP_CHECK_MS, self.check_backup)
+
+    def backup_taken(self, result):
+        if result is not None:
+            path, pages, seconds = result
+            instrumentation.record("backup", "snapshot", seconds * 1000, pages=pages,
+                                   pages_per_second=round(pages / max(seconds, 1e-9)))
+
+    def show_loading(self, busy):
+        self.loading_label.configure(text="Loading..." if busy else "")
+
     def clear_window_frame(self):
+        # Results still on their way belong to the screen being replaced
+        self.worker.cancel()
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+            self.search_job = None
+        # Chart canvases are hidden and reused; everything else is rebuilt
+        chart_widgets = {chart.widget for chart in self.charts.values()}
         for widget in self.window_frame.winfo_children():
-            widget.destroy()
+            if widget in chart_widgets:
+                widget.pack_forget()
+            else:
+                widget.destroy()
 
+    def chart(self, name):
+        # One figure and canvas per chart screen, created on first use
+        if name not in self.charts:
+            import charts
+            chart_types = {"categories": charts.CategoryPieChart, "daily": charts.DailyFlowChart}
+            self.charts[name] = chart_types[name](self.window_frame)
+        return self.charts[name]
+
+    @instrumentation.timed_screen
     def data_records(self):
         self.clear_window_frame()
 
@@ -169,7 +462,44 @@ class ExpenseTrackerClass(CTk):
         year_dropdown = tk.OptionMenu(select_monthyear_frame, self.year_var, *years, command=self.filter_expenses)
         year_dropdown.grid(row=1, column=4, padx=5)
 
-        self.tree = ttk.Treeview(self.window_frame, height=25)
+        # Search as you type, over description and category
+        search_label = CTkLabel(select_monthyear_frame, text="Search:")
+        search_label.grid(row=2, column=1, padx=5, pady=5)
+        self.search_var = tk.StringVar(select_monthyear_frame)
+        if self.search_supported is None:
+            self.worker.submit(self.repository.search_available, key="screen",
+                               callback=lambda available: self.show_search(select_monthyear_frame, available))
+        else:
+            self.show_search(select_monthyear_frame, self.search_supported)
+
+        # Date range, category and amount range, applied together with the above
+        CTkLabel(select_monthyear_frame, text="From:").grid(row=3, column=1, padx=5)
+        self.filter_start = CTkEntry(select_monthyear_frame, placeholder_text="yyyy-mm-dd", width=110)
+        self.filter_start.grid(row=3, column=2, padx=5, pady=2)
+        CTkLabel(select_monthyear_frame, text="To:").grid(row=3, column=3, padx=5)
+        self.filter_end = CTkEntry(select_monthyear_frame, placeholder_text="yyyy-mm-dd", width=110)
+        self.filter_end.grid(row=3, column=4, padx=5, pady=2)
+        CTkLabel(select_monthyear_frame, text="Category:").grid(row=4, column=1, padx=5)
+        self.filter_category = CTkComboBox(select_monthyear_frame, values=[ALL_CATEGORIES] + self.categories,
+                                           command=self.filter_expenses, width=150)
+        self.filter_category.set(ALL_CATEGORIES)
+        self.filter_category.grid(row=4, column=2, padx=5, pady=2)
+        CTkLabel(select_monthyear_frame, text="Amount ($):").grid(row=4, column=3, padx=5)
+        amount_frame = CTkFrame(select_monthyear_frame, fg_color="transparent")
+        amount_frame.grid(row=4, column=4, padx=5, pady=2)
+        self.filter_min = CTkEntry(amount_frame, placeholder_text="min", width=60)
+        self.filter_min.pack(side="left")
+        self.filter_max = CTkEntry(amount_frame, placeholder_text="max", width=60)
+        self.filter_max.pack(side="left", padx=(5, 0))
+        for entry in (self.filter_start, self.filter_end, self.filter_min, self.filter_max):
+            entry.bind("<Return>", self.filter_expenses)
+        CTkButton(select_monthyear_frame, text="Apply", command=self.filter_expenses,
+                  width=80).grid(row=5, column=1, columnspan=4, pady=5)
+
+        tree_frame = tk.Frame(self.window_frame)
+        tree_frame.pack(padx=20, pady=20)
+
+        self.tree = ttk.Treeview(tree_frame, height=25)
         self.tree["columns"]=("Amount","Description","Category","Date")
         self.tree.column("#0", width=0, stretch=tk.NO)
         self.tree.column("Amount", width=100, anchor=tk.CENTER)
@@ -178,23 +508,23 @@ class ExpenseTrackerClass(CTk):
         self.tree.column("Date", width=200, anchor=tk.CENTER)
         
         self.tree.heading("#0", text="", anchor=tk.CENTER)
-        self.tree.heading("Amount", text="Amount($)", anchor=tk.CENTER)
-        self.tree.heading("Description", text="Description", anchor=tk.CENTER)
-        self.tree.heading("Category", text="Category", anchor=tk.CENTER)
-        self.tree.heading("Date", text="Date", anchor=tk.CENTER)
-
-        conn, cursor = db.connect_to_database()
-        cursor.execute("SELECT id, amount, description, category, date FROM expenses WHERE user_id=?", (self.current_user_id,))
-        expenses = cursor.fetchall()
+        # Clicking a heading sorts by that column in SQLite; clicking it again reverses the order
+        for column, sort in RECORD_SORTS.items():
+            self.tree.heading(column, anchor=tk.CENTER, command=lambda sort=sort: self.sort_records(sort))
+        self.records_sort = None
+        self.records_descending = False
+
         # Color tags
         self.tree.tag_configure('evenrow', background='#f0f0ff')
         self.tree.tag_configure('oddrow', background='#ffffff')
 
-        for i, expense in enumerate(expenses, start=1):
-            tag = 'evenrow' if i % 2 == 0 else 'oddrow'
-            self.tree.insert("", "end", text="", values=(expense[1], expense[2], expense[3], expense[4]), tags=(tag,))
+        # Rows are fetched a page at a time as the user scrolls towards the end
+        scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscrollcommand=lambda first, last: self.on_records_scroll(scrollbar, first, last))
+        self.tree.pack(side="left")
+        scrollbar.pack(side="right", fill="y")
 
-        self.tree.pack(padx=20, pady=20)
+        self.reset_records()
 
         main_button = CTkFrame(self.window_frame)
         main_button.pack(padx=5, pady=5)
@@ -206,10 +536,9 @@ class ExpenseTrackerClass(CTk):
                 messagebox.showwarning("Warning", "Please select an expense to edit.")
                 return
 
-            # Get the index of the selected item
-            selected_index = int(self.tree.index(selected_item[0]))
-            # Get the expense details from the selected item
-            expense_id = expenses[selected_index][0]
+            # Items are keyed by expense id
+            expense_id = int(selected_item[0])
+            expense = self.records[expense_id]
 
             # Create a separate edit window
             edit_window = CTkToplevel()
@@ -218,25 +547,25 @@ class ExpenseTrackerClass(CTk):
             # Create labels and entry fields for editing
             amount_label =CTkLabel(edit_window, text="Amount:")
             amount_entry =CTkEntry(edit_window)
-            amount_entry.insert(0, expenses[selected_index][1])
+            amount_entry.insert(0, db.format_cents(expense[1]))
             amount_label.grid(row=0, column=0, padx=5, pady=5)
             amount_entry.grid(row=0, column=1, padx=5, pady=5)
 
             description_label =CTkLabel(edit_window, text="Description:")
             description_entry =CTkEntry(edit_window)
-            description_entry.insert(0, expenses[selected_index][2])
+            description_entry.insert(0, expense[2])
             description_label.grid(row=1, column=0, padx=5, pady=5)
             description_entry.grid(row=1, column=1, padx=5, pady=5)
 
             category_label =CTkLabel(edit_window, text="Category:")
             category_entry =CTkEntry(edit_window)
-            category_entry.insert(0, expenses[selected_index][3])
+            category_entry.insert(0, expense[3])
             category_label.grid(row=2, column=0, padx=5, pady=5)
             category_entry.grid(row=2, column=1, padx=5, pady=5)
 
             date_label =CTkLabel(edit_window, text="Date (yyyy-mm-dd):")
             date_entry =CTkEntry(edit_window)
-            date_entry.insert(0, expenses[selected_index][4])
+            date_entry.insert(0, expense[4])
             date_label.grid(row=3, column=0, padx=5, pady=5)
             date_entry.grid(row=3, column=1, padx=5, pady=5)
 
@@ -249,20 +578,30 @@ class ExpenseTrackerClass(CTk):
 
                 if new_amount and new_description and new_category and new_date:
                     try:
-                        datetime.strptime(new_date, '%Y-%m-%d')
+                        new_amount = db.to_cents(new_amount)
+                    except ValueError:
+                        messagebox.showwarning("Invalid Amount", "Please enter a valid number for the amount.")
+                        return
+                    try:
+                        # Store zero-padded dates so the date range filters match
+                        new_date = datetime.strptime(new_date, '%Y-%m-%d').strftime('%Y-%m-%d')
                     except ValueError:
                         messagebox.showwarning("Warning", "Invalid date format. Please use yyyy-mm-dd.")
                         return
 
-                    conn, cursor = db.connect_to_database()
-                    cursor.execute("UPDATE expenses SET amount=?, description=?, category=?, date=? WHERE id=?",
-                                (new_amount, new_description, new_category, new_date, expense_id))
-                    conn.commit()  # Commit changes to the database
-
-                    # Refresh the treeview with updated data
-                    self.data_records()  # Refresh the expenses from the database
-
-                    edit_window.destroy()
+                    def updated(changed):
+                        if not changed:
+                            messagebox.showwarning("Warning", "This expense is in an archived year and cannot be "
+                                                              "changed. Unarchive the year with db.py first.")
+                            return
+                        self.cache.update(expense_id, new_amount, new_category, new_date)
+                        if self.records_open():
+                            self.record_updated((expense_id, new_amount, new_description, new_category, new_date))
+                        if edit_window.winfo_exists():
+                            edit_window.destroy()
+
+                    self.worker.submit(self.write, self.repository.update, expense_id, new_amount, new_description,
+                                       new_category, new_date, callback=updated)
                 else:
                     messagebox.showwarning("Warning", "Please fill in all fields.")
 
@@ -280,82 +619,291 @@ class ExpenseTrackerClass(CTk):
                 messagebox.showwarning("Warning", "Please select an expense to delete.")
                 return
             
-            # Get the index of the selected item
-            selected_index = int(self.tree.index(selected_item[0]))
-            # Get the expense details from the selected item
-            expense_id = expenses[selected_index][0]
+            expense_id = int(selected_item[0])
 
-            if messagebox.askyesno("Confirmation", "Are you sure you want to delete this expense?"):
-                conn, cursor = db.connect_to_database()
-                cursor.execute("DELETE FROM expenses WHERE id=?", (expense_id,))  
-                conn.commit()
+            def deleted(removed):
+                if not removed:
+                    messagebox.showwarning("Warning", "This expense is in an archived year and cannot be "
+                                                      "deleted. Unarchive the year with db.py first.")
+                    return
+                self.cache.delete(expense_id)
+                if self.records_open() and expense_id in self.records:
+                    self.record_deleted(self.records[expense_id])
 
-                # Refresh the treeview with updated data
-                self.data_records()  # Refresh the expenses from the database
+            if messagebox.askyesno("Confirmation", "Are you sure you want to delete this expense?"):
+                self.worker.submit(self.write, self.repository.delete, expense_id, callback=deleted)
 
         delete_button = CTkButton(main_button, text="Delete", command=delete_expense_command)
         delete_button.grid(row=0, column=1, padx=5, pady=5)  
 
+        export_button = CTkButton(main_button, text="Export", command=self.export_records)
+        if self.local:
+            export_button.grid(row=0, column=2, padx=5, pady=5)
+
         self.total_label = CTkLabel(main_button, text="Total Expenses:", font=("Helvetica", 14))
-        self.total_label.grid(row=1, columnspan=2) 
+        self.total_label.grid(row=1, columnspan=3) 
         self.update_total_label()
-        self.load_expenses()
 
+    @instrumentation.timed_screen
     def filter_expenses(self, *args):
-        # Get selected month and year
+        try:
+            expense_filter = self.read_filter()
+        except ValueError as error:
+            messagebox.showwarning("Invalid Filter", str(error))
+            return
+        self.reset_records(expense_filter)
+        self.update_total_label()
+
+    def read_filter(self):
+        # The db.ExpenseFilter the filter controls describe; ValueError if one is not valid
         selected_month = self.month_var.get()
         selected_year = self.year_var.get()
-        # Clear existing Treeview items
+        search = self.search_var.get()
+        category = self.filter_category.get()
+        amounts = [db.to_cents(entry.get()) if entry.get().strip() else None
+                   for entry in (self.filter_min, self.filter_max)]
+        return db.ExpenseFilter(month=None if selected_month == "All" else months.index(selected_month),
+                                year=None if selected_year == "All" else selected_year,
+                                start=self.filter_start.get().strip() or None,
+                                end=self.filter_end.get().strip() or None,
+                                categories=[category] if category and category != ALL_CATEGORIES else [],
+                                min_amount=amounts[0], max_amount=amounts[1],
+                                text=search if db.search_query(search) else None)
+
+    @instrumentation.timed_screen
+    def sort_records(self, sort):
+        if self.records_sort == sort:
+            self.records_descending = not self.records_descending
+        else:
+            self.records_sort, self.records_descending = sort, False
+        self.reset_records(self.records_filter)
+
+    def show_search(self, frame, available):
+        self.search_supported = available
+        if not frame.winfo_exists():
+            return
+        if available:
+            search_entry = CTkEntry(frame, textvariable=self.search_var, width=250)
+            self.search_var.trace_add("write", self.schedule_search)
+        else:
+            search_entry = CTkLabel(frame, text="Not available: SQLite was built without FTS5")
+        search_entry.grid(row=2, column=2, columnspan=3, padx=5, pady=5)
+
+    def schedule_search(self, *args):
+        # Debounce: only the last keystroke in a burst starts a search
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        self.search_job = self.after(SEARCH_DELAY_MS, self.run_search)
+
+    def run_search(self):
+        self.search_job = None
+        self.filter_expenses()
+
+    def reset_records(self, expense_filter=None):
+        # Clear existing Treeview items and start paging from the first row again
         self.tree.delete(*self.tree.get_children())
-        # Filter expenses based on selected month and year
-        conn, cursor = db.connect_to_database()
-        if selected_month == "All" and selected_year == "All":
-            cursor.execute("SELECT id, amount, description, category, date FROM expenses WHERE user_id=?", (self.current_user_id,))
-        elif selected_month == "All":
-            cursor.execute("SELECT id, amount, description, category, date FROM expenses WHERE user_id=? AND strftime('%Y', date)=?", (self.current_user_id, selected_year))
-        elif selected_year == "All":
-            cursor.execute("SELECT id, amount, description, category, date FROM expenses WHERE user_id=? AND strftime('%m', date)=?", (self.current_user_id, str(months.index(selected_month)).zfill(2)))
+        self.records_filter = expense_filter or db.ExpenseFilter()
+        # A search on its own comes best match first, until a heading is clicked
+        self.records_ranked = bool(self.records_filter.text and not self.records_filter.beyond_month_year()
+                                   and self.records_sort is None)
+        for column, sort in RECORD_SORTS.items():
+            arrow = (" \u25bc" if self.records_descending else " \u25b2") if sort == self.records_sort else ""
+            self.tree.heading(column, text=RECORD_HEADINGS[column] + arrow)
+        # (id, amount, description, category, date) of every row shown, by id,
+        # which is also the row's item id in the tree
+        self.records = {}
+        # The db.sort_key of every row shown, lowest first; not kept for ranked
+        # searches. A descending view shows them from the end.
+        self.record_keys = []
+        # Where the next page starts: the sort key or (rank, id) of the last row paged in
+        self.records_after = None
+        self.records_total = None
+        self.records_exhausted = False
+        self.page_pending = False
+        self.load_next_page()
+
+    def load_next_page(self):
+        if self.records_exhausted:
+            return
+        self.page_pending = True
+        # Submitting under the same key drops a page still loading for an older filter or search
+        expense_filter = self.records_filter
+        if self.records_ranked:
+            self.worker.submit(self.repository.list_matching, expense_filter.text, expense_filter.month,
+                               expense_filter.year, self.records_after, PAGE_SIZE, callback=self.show_page,
+                               key="records")
+            return
+        self.worker.submit(self.session.call, "list_filtered", expense_filter, self.records_sort or "date",
+                           self.records_descending, self.records_after, PAGE_SIZE, callback=self.show_page,
+                           key="records")
+
+    def show_page(self, page):
+        self.page_pending = False
+        if len(page) < PAGE_SIZE:
+            self.records_exhausted = True
+        if page:
+            last = page[-1]
+            self.records_after = (last[5], last[0]) if self.records_ranked else self.record_key(last)
+
+        keys = []
+        for expense in page:
+            # An edit can have moved a row past the loaded pages; it comes back with its page
+            if expense[0] in self.records:
+                continue
+            tag = 'evenrow' if len(self.records) % 2 else 'oddrow'
+            self.tree.insert("", "end", iid=expense[0], text="", values=self.record_values(expense), tags=(tag,))
+            self.records[expense[0]] = expense[:5]
+            keys.append(self.record_key(expense))
+        if self.records_ranked:
+            return
+        if self.records_descending:
+            self.record_keys[0:0] = reversed(keys)
         else:
-            # Modify the SQL query to filter by both year and month
-            cursor.execute("SELECT id, amount, description, category, date FROM expenses WHERE user_id=? AND strftime('%Y-%m', date)=?", (self.current_user_id, f"{selected_year}-{str(months.index(selected_month)).zfill(2)}"))
-        
-        expenses = cursor.fetchall()
+            self.record_keys.extend(keys)
+
+    # Edits, deletes and additions patch the one row they touch and move the
+    # total by the amount that changed, instead of reloading the screen.
+    # Stripes can be off by one row after an in-place change until the next filter.
+
+    def record_values(self, expense):
+        return db.format_cents(expense[1]), expense[2], expense[3], expense[4]
+
+    def records_open(self):
+        return self.tree is not None and self.tree.winfo_exists()
 
-        # Insert filtered expenses into Treeview
-        for i, expense in enumerate(expenses, start=1):
-            self.tree.insert("", i, values=(expense[1], expense[2], expense[3], expense[4]))
+    def record_key(self, expense):
+        return db.sort_key(expense, self.records_sort or "date")
 
+    def record_in_filter(self, expense):
+        return self.records_filter.matches(expense[1], expense[3], expense[4])
+
+    def place_record(self, expense):
+        # Inserts a row at its position in the sort order, unless that is past
+        # the pages loaded so far: paging will bring it when the user gets there
+        key = self.record_key(expense)
+        if not self.records_exhausted and (self.records_after is None or (
+                key < self.records_after if self.records_descending else key > self.records_after)):
+            return
+        index = bisect.bisect(self.record_keys, key)
+        self.record_keys.insert(index, key)
+        position = len(self.record_keys) - 1 - index if self.records_descending else index
+        self.tree.insert("", position, iid=expense[0], text="", values=self.record_values(expense),
+                         tags=('evenrow' if position % 2 else 'oddrow',))
+        self.records[expense[0]] = expense
+
+    def remove_record(self, expense_id):
+        expense = self.records.pop(expense_id)
+        self.tree.delete(expense_id)
+        if not self.records_ranked:
+            del self.record_keys[bisect.bisect_left(self.record_keys, self.record_key(expense))]
+
+    def adjust_total(self, delta):
+        if self.records_total is None:
+            # The total is still being worked out; ask again so it includes the change
+            self.update_total_label()
+        elif delta:
+            self.show_total(self.records_total + delta)
+
+    def record_added(self, expense):
+        if self.records_filter.text:
+            # Only FTS5 can tell whether the new expense matches the search
+            self.update_total_label()
+        elif self.record_in_filter(expense):
+            self.place_record(expense)
+            self.adjust_total(expense[1])
+
+    def record_updated(self, new):
+        # The dialog can outlive the screen it was opened from
+        old = self.records.get(new[0]) if self.records_open() else None
+        if old is None:
+            return
+        if self.records_filter.text:
+            # The row stays where it is until the next search, which may rank it elsewhere or drop it
+            if not self.records_ranked:
+                del self.record_keys[bisect.bisect_left(self.record_keys, self.record_key(old))]
+                bisect.insort(self.record_keys, self.record_key(new))
+            self.records[new[0]] = new
+            self.tree.item(new[0], values=self.record_values(new))
+            self.update_total_label()
+            return
+        matches = self.record_in_filter(new)
+        if matches and self.record_key(new) == self.record_key(old):
+            self.records[new[0]] = new
+            self.tree.item(new[0], values=self.record_values(new))
+        else:
+            self.remove_record(old[0])
+            if matches:
+                self.place_record(new)
+        self.adjust_total((new[1] if matches else 0) - old[1])
+
+    def record_deleted(self, expense):
+        self.remove_record(expense[0])
+        self.adjust_total(-expense[1])
+
+    def export_records(self):
+        # Exports the expenses meeting every filter the records screen shows
+        path = filedialog.asksaveasfilename(title="Export Expenses", defaultextension=".csv",
+                                            filetypes=[("CSV file", "*.csv"), ("Columnar binary", "*.expcol")])
+        if not path:
+            return
+        export = db.export_columnar if path.endswith(".expcol") else db.export_csv
+        self.worker.submit(export, path, self.current_user_id, self.records_filter,
+                           callback=lambda count: messagebox.showinfo(
+                               "Export Complete", f"Exported {count:,} expenses to {path}."))
+
+    def on_records_scroll(self, scrollbar, first, last):
+        scrollbar.set(first, last)
+        # Fetch the next page once the view gets close to the last loaded row
+        if float(last) >= 0.9 and not self.records_exhausted and not self.page_pending:
+            self.load_next_page()
+
+    @instrumentation.timed_screen
     def manage_expense_setting(self):
+        def selected_target():
+            category = self.budget_category_dropdown.get()
+            return self.budget_period_dropdown.get(), None if category == ALL_CATEGORIES else category
+
         def confirm_or_update_target():
-            target_amount = float(self.budgets_entry.get())
-            if target_amount >= 0:
-                conn, cursor = db.connect_to_database()
-                cursor.execute("SELECT target_amount FROM spending_targets WHERE user_id=?", (self.current_user_id,))
-                existing_target = cursor.fetchone()
-                if existing_target:
-                    cursor.execute("UPDATE spending_targets SET target_amount=? WHERE user_id=?",
-                                (target_amount, self.current_user_id))
-                    messagebox.showinfo("Success", "Expense budgets updated successfully.")
-                else:
-                    cursor.execute("INSERT INTO spending_targets (user_id, target_amount) VALUES (?, ?)",
-                                (self.current_user_id, target_amount))
-                    messagebox.showinfo("Success", "Expense budgets set successfully.")
-                conn.commit()
-                self.update_set_target()  # Call the method to update the target label
-                self.manage_expense_setting() #load manange expense window
+            try:
+                target_amount = db.to_cents(self.budgets_entry.get())
+            except ValueError:
+                target_amount = None
+            if target_amount is not None and target_amount >= 0:
+                self.worker.submit(self.write, self.repository.set_budget_target, target_amount, *selected_target(),
+                                   callback=target_set)
             else:
                 messagebox.showwarning("Invalid Input", "Please enter a valid positive number for the budget.")
 
+        def target_set(updated):
+            if updated:
+                messagebox.showinfo("Success", "Expense budgets updated successfully.")
+            else:
+                messagebox.showinfo("Success", "Expense budgets set successfully.")
+            self.manage_expense_setting() #load manange expense window
+
+        def remove_target():
+            time_period, category = selected_target()
+
+            def removed(found):
+                if found:
+                    self.manage_expense_setting()
+                else:
+                    messagebox.showinfo("No Target Set", f"There is no {time_period} target for "
+                                                         f"{category or ALL_CATEGORIES.lower()}.")
+
+            self.worker.submit(self.write, self.repository.delete_budget_target, time_period, category,
+                               callback=removed)
+
         def check_target_amount():
-            conn, cursor = db.connect_to_database()
-            cursor.execute("SELECT target_amount FROM spending_targets WHERE user_id=?", (self.current_user_id,))
-            target = cursor.fetchone()
+            self.worker.submit(self.repository.budget_targets, callback=show_targets)
 
-            if target:
-                target_amount = target[0]
-                messagebox.showinfo("Target Amount", f"Your daily expense target is ${target_amount:.2f}")
+        def show_targets(targets):
+            if targets:
+                messagebox.showinfo("Target Amount", "\n".join(
+                    f"{time_period.capitalize()} target for {category or ALL_CATEGORIES.lower()}: "
+                    f"${db.format_cents(target_amount)}" for time_period, category, target_amount in targets))
             else:
-                messagebox.showinfo("No Target Set", "You have not set a daily expense target yet.")
+                messagebox.showinfo("No Target Set", "You have not set an expense target yet.")
 
         self.clear_window_frame()
 
@@ -371,11 +919,24 @@ class ExpenseTrackerClass(CTk):
         self.budgets_label.grid(row=0, column=1, columnspan=3, pady=5, padx=10)
 
         self.budgets_entry = CTkEntry(limit_expense_frame, font=("Helvetica", 14), width=120)
-        self.budgets_entry.grid(row=1, column=1, columnspan=3, pady=5, padx=10)
+        self.budgets_entry.grid(row=1, column=1, pady=5, padx=10)
+
+        self.budget_period_dropdown = CTkComboBox(limit_expense_frame, values=list(db.BUDGET_PERIODS),
+                                                  state="readonly", width=110)
+        self.budget_period_dropdown.set("daily")
+        self.budget_period_dropdown.grid(row=1, column=2, pady=5, padx=5)
+
+        self.budget_category_dropdown = CTkComboBox(limit_expense_frame, values=[ALL_CATEGORIES] + self.categories,
+                                                    state="readonly", width=140)
+        self.budget_category_dropdown.set(ALL_CATEGORIES)
+        self.budget_category_dropdown.grid(row=1, column=3, pady=5, padx=5)
 
         confirm_button = CTkButton(limit_expense_frame, text="Confirm/Update", width=100,
                                 command=confirm_or_update_target)
-        confirm_button.grid(row=2, column=1, columnspan=2, padx =10, pady=10)
+        confirm_button.grid(row=2, column=1, padx =10, pady=10)
+
+        remove_button = CTkButton(limit_expense_frame, text="Remove", width=80, command=remove_target)
+        remove_button.grid(row=2, column=2, padx=5, pady=10)
 
         check_button = CTkButton(limit_expense_frame, text="Check Limit Amount", command=check_target_amount)
         check_button.grid(row=2, column=3, pady=10, padx=10)
@@ -383,21 +944,61 @@ class ExpenseTrackerClass(CTk):
         self.target_label = CTkLabel(limit_expense_frame, text="", font=("Helvetica", 14))
         self.target_label.grid(row=3, column=1, columnspan=3, pady=10)
 
-        conn, cursor = db.connect_to_database()
-        cursor.execute("SELECT target_amount FROM spending_targets WHERE user_id=?", (self.current_user_id,))
-        target = cursor.fetchone()
+        self.worker.submit(self.session.call, "budget_exceedances", callback=self.show_budget_status, key="screen")
 
-        if not target:
-            messagebox.showinfo("No Spending Target", "You have not set a spending target yet.")
-        else:
-            target_amount = target[0]
+    @instrumentation.timed_screen
+    def recurring_expenses(self):
+        self.clear_window_frame()
+
+        CTkLabel(self.window_frame, text="Recurring Expenses", font=("Helvetica", 16, "bold")).pack(pady=10)
 
-            # Fetch expenses exceeding the spending target
-            cursor.execute(
-                "SELECT date, SUM(amount) FROM expenses WHERE user_id=? GROUP BY date HAVING SUM(amount) > ?",
-                (self.current_user_id, target_amount))
-            exceeded_expenses = cursor.fetchall()
+        self.recurring_tree = ttk.Treeview(self.window_frame, height=10, show="headings",
+                                           columns=("Description", "Amount", "Category", "Repeats", "Next", "Ends"))
+        for column, width in (("Description", 140), ("Amount", 80), ("Category", 100), ("Repeats", 100),
+                              ("Next", 90), ("Ends", 90)):
+            self.recurring_tree.column(column, width=width, anchor=tk.CENTER)
+            self.recurring_tree.heading(column, text=column, anchor=tk.CENTER)
+        self.recurring_tree.pack(padx=10)
 
+        def delete_rule():
+            selected = self.recurring_tree.selection()
+            if not selected:
+                messagebox.showwarning("Warning", "Please select a recurring expense to stop.")
+                return
+            if messagebox.askyesno("Stop Repeating", "Stop this expense repeating? Expenses already added stay."):
+                self.worker.submit(self.write, self.repository.delete_recurring, int(selected[0]), callback=stopped)
+
+        def stopped(removed):
+            if self.recurring_tree.winfo_exists():
+                self.recurring_expenses()
+
+        CTkButton(self.window_frame, text="Stop Repeating", command=delete_rule).pack(pady=10)
+        self.forecast_label = CTkLabel(self.window_frame, text="", font=("Helvetica", 14))
+        self.forecast_label.pack()
+
+        self.worker.submit(self.load_recurring, callback=self.show_recurring, key="screen")
+
+    def load_recurring(self):
+        # The rules and the occurrences due in the next FORECAST_DAYS days, generated rather than stored
+        today = Date.today()
+        upcoming = self.repository.forecast_recurring((today + timedelta(days=FORECAST_DAYS)).isoformat(),
+                                                      (today + timedelta(days=1)).isoformat())
+        return self.repository.recurring_expenses(), list(upcoming)
+
+    def show_recurring(self, result):
+        rules, upcoming = result
+        for rule_id, amount, description, category, start_date, unit, every, end_date, next_date in rules:
+            repeats = f"every {unit}" if every == 1 else f"every {every} {unit}s"
+            self.recurring_tree.insert("", "end", iid=rule_id, values=(
+                description, db.format_cents(amount), category, repeats, next_date or "ended", end_date or ""))
+        total = sum(occurrence[1] for occurrence in upcoming)
+        self.forecast_label.configure(text=f"Due in the next {FORECAST_DAYS} days: ${db.format_cents(total)} "
+                                           f"({len(upcoming)} expenses)")
+
+    def show_budget_status(self, targets):
+        if not targets:
+            messagebox.showinfo("No Spending Target", "You have not set a spending target yet.")
+        else:
             exceed_list_frame = CTkFrame(self.window_frame)
             exceed_list_frame.pack(padx=5, pady=5)
 
@@ -405,93 +1006,86 @@ class ExpenseTrackerClass(CTk):
             list_label.pack(side="top", fill="both", expand=True)
 
             tree = ttk.Treeview(exceed_list_frame)
-            tree["columns"] = ("Amount", "Date", "Exceed Amount")  # Add "Exceed Amount" column
+            tree["columns"] = ("Target", "Amount", "Date", "Exceed Amount")  # Add "Exceed Amount" column
             tree.column("#0", width=0, stretch=tk.NO)
-            tree.column("Amount", width=200, anchor=tk.CENTER)
-            tree.column("Date", width=300, anchor=tk.CENTER)
-            tree.column("Exceed Amount", width=200, anchor=tk.CENTER)  # Define width for new column
+            tree.column("Target", width=200, anchor=tk.CENTER)
+            tree.column("Amount", width=150, anchor=tk.CENTER)
+            tree.column("Date", width=150, anchor=tk.CENTER)
+            tree.column("Exceed Amount", width=150, anchor=tk.CENTER)  # Define width for new column
 
             tree.heading("#0", text="", anchor=tk.CENTER)
+            tree.heading("Target", text="Target", anchor=tk.CENTER)
             tree.heading("Amount", text="Total Amount($)", anchor=tk.CENTER)
-            tree.heading("Date", text="Date", anchor=tk.CENTER)
+            tree.heading("Date", text="Period Starting", anchor=tk.CENTER)
             tree.heading("Exceed Amount", text="Exceed Amount($)", anchor=tk.CENTER)  # Set heading for new column
 
-            for expense in exceeded_expenses:
-                # Calculate exceed amount
-                exceed_amount = expense[1] - target_amount
-                tree.insert("", "end", text="", values=(expense[1], expense[0], exceed_amount))
+            for time_period, category, target_amount, periods in targets:
+                name = f"{time_period} {category or 'total'} ${db.format_cents(target_amount)}"
+                for period_start, total in periods:
+                    # Calculate exceed amount
+                    tree.insert("", "end", text="", values=(name, db.format_cents(total), period_start,
+                                                            db.format_cents(total - target_amount)))
 
             tree.pack()
         
 
     def update_total_label(self):
-        total_expenses = sum(float(expense[0]) for expense in self.expenses)
-        self.total_label.configure(text=f"Total Expenses: USD {total_expenses:.2f}")
+        # Total for the current filter; the cache answers at once when it is
+        # loaded and only month and year are chosen, otherwise the worker asks
+        # the database
+        expense_filter = self.records_filter
+        if self.cache.ready and not expense_filter.text and not expense_filter.beyond_month_year():
+            self.show_total(self.cache.filtered_total(expense_filter.month, expense_filter.year))
+        else:
+            self.worker.submit(self.session.call, "filtered_total", expense_filter, callback=self.show_total,
+                               key="total")
 
-    def load_expenses(self):
-        conn, cursor = db.connect_to_database()
-        cursor.execute("SELECT amount, description, category, date FROM expenses WHERE user_id=?", (self.current_user_id,))
-        self.expenses = cursor.fetchall()
+    def show_total(self, total_expenses):
+        self.records_total = total_expenses
+        self.total_label.configure(text=f"Total Expenses: USD {db.format_cents(total_expenses)}")
 
+    @instrumentation.timed_screen
     def data_analysis(self):
         self.clear_window_frame()
 
         data_analysis_label = CTkLabel(self.window_frame, text = "Expense Analysis of Category", font=("Helvetica", 16, "bold"))
         data_analysis_label.pack()
 
-        category_totals = {}
-
-        # Calculate category totals
-        for expense in self.expenses:
-            category = expense[2]
-            amount = float(expense[0])
-            category_totals[category] = category_totals.get(category, 0) + amount
+        if self.cache.ready:
+            self.show_data_analysis(self.cache.category_breakdown())
+        else:
+            self.worker.submit(self.session.call, "category_breakdown", callback=self.show_data_analysis,
+                               key="screen")
 
+    def show_data_analysis(self, totals):
         # Plot the pie chart for category distribution
-        fig, ax = plt.subplots(figsize=(8, 6))
-        ax.pie(category_totals.values(), labels=category_totals.keys(), autopct='%1.1f%%', startangle=140)
-        ax.set_title('Expense Categories Distribution')
-
-        # Add the pie chart to the combined window
-        canvas = FigureCanvasTkAgg(fig, master=self.window_frame)
-        canvas.draw()
-        canvas.get_tk_widget().pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-        self.window_frame.mainloop()
+        chart = self.chart("categories")
+        chart.update(dict(totals))
+        chart.show()
 
+    @instrumentation.timed_screen
     def daily_expenses(self):
         self.clear_window_frame()
 
         data_analysis_label = CTkLabel(self.window_frame, text="Daily Expense Flow", font=("Helvetica", 16, "bold"))
         data_analysis_label.pack()
-
-        daily_totals = {}
-        conn, cursor = db.connect_to_database()
-        cursor.execute("SELECT date, SUM(amount) FROM expenses WHERE user_id=? GROUP BY date", (self.current_user_id,))
-        expenses_data = cursor.fetchall()
-
-        for date, total_amount in expenses_data:
-            # Convert date to datetime object to ensure correct formatting
-            formatted_date = datetime.strptime(date, '%Y-%m-%d')
-            daily_totals[formatted_date] = total_amount
-
-        sorted_dates = sorted(daily_totals.keys())
-
-        # Plot the line chart for daily expenses
-        fig, ax = plt.subplots(figsize=(10, 6))
-        ax.plot(sorted_dates, [daily_totals[date] for date in sorted_dates], marker='o', linestyle='-')
-        ax.set_title('Daily Expenses Trend')
-        ax.set_xlabel('Date')
-        ax.set_ylabel('Total Expenses ($)')
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))  # Format the x-axis as dates
-        plt.xticks(rotation=45)  # Rotate x-axis labels for better readability
-
-        # Add cursor hover functionality using mplcursors
-        mplcursors.cursor(ax, hover=True)
-
-        # Add the line chart to the combined window
-        canvas = FigureCanvasTkAgg(fig, master=self.window_frame)
-        canvas.draw()
-        canvas.get_tk_widget().pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-        self.window_frame.mainloop()
\ No newline at end of file
+        self.pace_label = CTkLabel(self.window_frame, text="", font=("Helvetica", 14))
+        self.pace_label.pack()
+
+        self.worker.submit(self.load_daily_flow, callback=self.show_daily_expenses, key="screen")
+
+    def load_daily_flow(self):
+        # Runs on the database worker thread
+        return analytics.DailyAnalysis(self.session.call("daily_series"))
+
+    def show_daily_expenses(self, analysis):
+        self.pace_label.configure(
+            text=f"This month: USD {db.format_cents(analysis.month_spent)} so far, "
+                 f"USD {db.format_cents(round(analysis.month_pace))} a day; "
+                 f"on course for USD {db.format_cents(round(analysis.month_forecast))}")
+
+        # Plot the line chart for daily expenses, cents to dollars for the axis
+        averages = {f"{window}-day average": analysis.means[window] / 100 for window in analytics.ROLLING_WINDOWS}
+        chart = self.chart("daily")
+        chart.update(analysis.days, analysis.cents / 100, averages, analysis.anomalies)
+        chart.show()
\ No newline at end of file